@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+import sys
+import os
+import time
+import json
+import shlex
+import subprocess
+import logging as log
+from argparse import ArgumentParser, SUPPRESS, RawTextHelpFormatter
+import numpy as np
+
+# 合成モデル/合成動画の作成
+from make_synthetic import make_synthetic, SYNTHETIC_MODELS
+
+# 全パイプライン(ssd / face / person)のベンチマーク
+# 合成モデルと合成動画で各パイプラインを非表示(--no_disp)で実行し、
+#   ・FPS(処理時間記録(--time)のフレーム処理時間から算出)
+#   ・フレーム処理時間の分布(p50/p90/p99)
+#   ・処理区間毎の処理時間の分布(プロファイラ(--profile_json)の集計)
+#   ・最大メモリ使用量(子プロセスの最大RSS)
+# を表示する
+# 実モデルのIRファイルや表示環境がなくても、CPUだけのLinux環境で処理時間の変化を比較できる
+
+# 対象パイプライン ===============================================================
+# パイプライン名 : (ディレクトリ, メインスクリプト, [(モデル指定オプション, 合成モデルのファイル名)])
+PIPELINES = {
+    "ssd"    : ("ssd",    "ov_object_detection_ssd.py", [("-m", "ssd.xml")]),
+    "face"   : ("face",   "ov_face_detection.py",       [("-m", "face.xml"), ("-m_lm5", "lm5.xml"), ("-m_lm35", "lm35.xml"), ("-m_hp", "hp.xml")]),
+    "person" : ("person", "ov_person_detection.py",     [("-m", "person.xml"), ("-m_reid", "reid.xml"), ("-m_attr", "attr.xml")]),
+}
+# ================================================================================
+
+# コマンドラインパーサの構築 =====================================================
+def build_argparser():
+    bench_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = ArgumentParser(add_help=False, formatter_class=RawTextHelpFormatter)
+    parser.add_argument('-h', '--help', action='help', default=SUPPRESS,
+                        help='Show this help message and exit.')
+    parser.add_argument("-p", "--pipelines", default=list(PIPELINES.keys()), nargs='+', choices=list(PIPELINES.keys()),
+                        help="Optional.\n"
+                             "Pipelines to run\n"
+                             "Default is all pipelines")
+    parser.add_argument("-d", "--device", default="CPU", type=str,
+                        help="Optional.\n"
+                             "Specify the target device to infer on; \n"
+                             "CPU, GPU, FPGA, HDDL or MYRIAD is acceptable. \n"
+                             "Default value is CPU")
+    parser.add_argument("--synthetic_dir", default=os.path.join(bench_dir, "_synthetic"), type=str,
+                        help="Optional.\n"
+                             "Directory of synthetic models and video\n"
+                             "(created by make_synthetic.py if not exist)\n"
+                             "Default is ./_synthetic")
+    parser.add_argument("--result_dir", default=os.path.join(bench_dir, "_result"), type=str,
+                        help="Optional.\n"
+                             "Directory to save console logs, time logs and profiles of each run\n"
+                             "Default is ./_result")
+    parser.add_argument("-i", "--input", default=None, type=str,
+                        help="Optional.\n"
+                             "Path to a video file used instead of synthetic video")
+    parser.add_argument("--warmup", default=5, type=int,
+                        help="Optional.\n"
+                             "Number of first frames excluded from FPS and frame time\n"
+                             "Default value is 5")
+    parser.add_argument("--top", default=15, type=int,
+                        help="Optional.\n"
+                             "Number of spans shown per pipeline (sorted by total time)\n"
+                             "0 = all spans\n"
+                             "Default value is 15")
+    parser.add_argument("--ssd_args", default="", type=str,
+                        help="Optional.\n"
+                             "Extra options passed to ssd pipeline (e.g. \"--decode_mode loop\")")
+    parser.add_argument("--face_args", default="", type=str,
+                        help="Optional.\n"
+                             "Extra options passed to face pipeline (e.g. \"-b_lm5 4\")")
+    parser.add_argument("--person_args", default="", type=str,
+                        help="Optional.\n"
+                             "Extra options passed to person pipeline (e.g. \"--detect_interval 3\")")
+    parser.add_argument("--json", default=None, type=str,
+                        help="Optional.\n"
+                             "Save results to specified JSON file")
+    parser.add_argument("--baseline", default=None, type=str,
+                        help="Optional.\n"
+                             "JSON file saved by --json to compare with")
+    return parser
+# ================================================================================
+
+# 合成モデル/合成動画の準備 ======================================================
+# なければ作成する
+# 戻り値 : 合成動画のファイル名
+def prepare_synthetic(synthetic_dir) :
+    video_file = os.path.join(synthetic_dir, "video.avi")
+    files = [os.path.join(synthetic_dir, filename) for filename in SYNTHETIC_MODELS.keys()] + [video_file]
+    if not all(os.path.isfile(filename) for filename in files) :
+        log.info(f'make synthetic models and video : {synthetic_dir}')
+        make_synthetic(synthetic_dir)
+    return video_file
+# ================================================================================
+
+# 処理時間記録の読み込み =========================================================
+# 戻り値 : フレーム処理時間(msec)の配列
+def read_frame_times(time_file) :
+    frame_times = []
+    with open(time_file) as f :
+        for line in f :
+            fields = line.split(",")
+            if fields[0].strip().isdigit() :             # ヘッダ行(コマンドラインなど)は読み飛ばす
+                frame_times.append(float(fields[1]))
+    return np.array(frame_times)
+# ================================================================================
+
+# 1パイプラインの実行 ============================================================
+# 戻り値 : 結果の辞書
+def run_pipeline(name, args, synthetic_dir, input_file, extra_args) :
+    directory, script, model_options = PIPELINES[name]
+    script_dir   = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", directory)
+    time_file    = os.path.abspath(os.path.join(args.result_dir, f'{name}_time.txt'))
+    profile_file = os.path.abspath(os.path.join(args.result_dir, f'{name}_profile.json'))
+    console_file = os.path.abspath(os.path.join(args.result_dir, f'{name}_console.txt'))
+
+    command = [sys.executable, script, "-i", input_file, "-d", args.device]
+    for option, filename in model_options :
+        command += [option, os.path.join(synthetic_dir, filename)]
+    command += ["--no_disp", "--time", time_file, "--profile_json", profile_file]
+    command += shlex.split(extra_args)
+
+    # 子プロセスで実行 (メインスクリプトはスクリプトのディレクトリで実行する前提)
+    log.info(f'run {name} : {" ".join(command)}')
+    start = time.perf_counter()
+    with open(console_file, mode='w') as console_f :
+        proc = subprocess.Popen(command, cwd=script_dir, stdout=console_f, stderr=subprocess.STDOUT)
+        # wait4 で子プロセス自身のリソース使用量を取得
+        _, status, rusage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+    wall_time = time.perf_counter() - start
+    if proc.returncode != 0 :
+        raise RuntimeError(f'{name} failed (exit code {proc.returncode}). see {console_file}')
+
+    # フレーム処理時間(最初の warmup フレームを除く)
+    frame_times = read_frame_times(time_file)
+    measured = frame_times[args.warmup:] if len(frame_times) > args.warmup else frame_times
+    p50, p90, p99 = np.percentile(measured, (50, 90, 99))
+
+    with open(profile_file) as f :
+        spans = json.load(f)["summary"]
+
+    return {"frames": len(frame_times), "wall_time": wall_time,
+            "fps": len(measured) / measured.sum() * 1000,
+            "frame_time": {"mean": float(measured.mean()), "p50": float(p50), "p90": float(p90), "p99": float(p99), "max": float(measured.max())},
+            "max_rss": rusage.ru_maxrss / 1024,                 # MB単位 (ru_maxrss は KB単位)
+            "spans": spans}
+# ================================================================================
+
+# 結果の表示 =====================================================================
+def print_result(name, result, top, baseline=None) :
+    frame_time = result["frame_time"]
+    print(f'==== {name} ====')
+    print(f'frames : {result["frames"]}   wall : {result["wall_time"]:.2f} s   max RSS : {result["max_rss"]:.1f} MB')
+    fps_str = f'FPS : {result["fps"]:.2f}'
+    if baseline :
+        fps_str += f' (baseline {baseline["fps"]:.2f}, {(result["fps"] / baseline["fps"] - 1) * 100:+.1f}%)'
+    print(f'{fps_str}   frame time[ms] mean : {frame_time["mean"]:.3f}   p50 : {frame_time["p50"]:.3f}   p90 : {frame_time["p90"]:.3f}   p99 : {frame_time["p99"]:.3f}   max : {frame_time["max"]:.3f}')
+
+    # 処理区間毎の処理時間 (合計時間の大きい順)
+    spans = sorted(result["spans"].items(), key=lambda item : item[1]["total"], reverse=True)
+    if top > 0 :
+        spans = spans[:top]
+    width = max([len(span_name) for span_name, _ in spans] + [len("span")])
+    print(f'{"span":{width}} {"count":>7} {"total[ms]":>11} {"p50":>9} {"p90":>9} {"p99":>9}' + (f' {"p50(base)":>10}' if baseline else ''))
+    for span_name, s in spans :
+        line = f'{span_name:{width}} {s["count"]:7d} {s["total"]:11.3f} {s["p50"]:9.3f} {s["p90"]:9.3f} {s["p99"]:9.3f}'
+        if baseline :
+            base = baseline["spans"].get(span_name)
+            line += f' {base["p50"]:10.3f}' if base else f' {"-":>10}'
+        print(line)
+    print()
+# ================================================================================
+
+# メイン処理 =====================================================================
+def main():
+    log.basicConfig(format="[ %(levelname)s ] %(message)s", level=log.INFO, stream=sys.stdout)
+
+    # コマンドラインオプションの解析
+    args = build_argparser().parse_args()
+
+    if args.warmup < 0 :
+        log.warning("warmup option must be greater than or equal to 0. use default value(5)")
+        args.warmup = 5
+
+    synthetic_dir = os.path.abspath(args.synthetic_dir)
+    input_file = prepare_synthetic(synthetic_dir)
+    if args.input :
+        input_file = os.path.abspath(args.input)
+        assert os.path.isfile(input_file), "Specified input file doesn't exist"
+    os.makedirs(args.result_dir, exist_ok=True)
+
+    baselines = {}
+    if args.baseline :
+        with open(args.baseline) as f :
+            baselines = json.load(f)["results"]
+
+    results = {}
+    for name in args.pipelines :
+        extra_args = getattr(args, f'{name}_args')
+        results[name] = run_pipeline(name, args, synthetic_dir, input_file, extra_args)
+
+    print()
+    for name, result in results.items() :
+        print_result(name, result, args.top, baselines.get(name))
+
+    if args.json :
+        with open(args.json, mode='w') as f :
+            json.dump({"command": " ".join(sys.argv), "device": args.device, "input": input_file, "results": results}, f, indent=1)
+        log.info(f'results saved : {args.json}')
+# ================================================================================
+
+if __name__ == '__main__':
+    sys.exit(main() or 0)
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+import sys
+import os
+import logging as log
+from argparse import ArgumentParser, SUPPRESS, RawTextHelpFormatter
+import cv2
+import numpy as np
+
+# openVINOモジュール
+from openvino.runtime import Model              as ov_Model
+from openvino.runtime import opset8             as ov_opset
+try :
+    from openvino.runtime import serialize      as ov_serialize
+except ImportError :
+    # openVINO 2022.1 では offline_transformations にある
+    from openvino.offline_transformations import serialize as ov_serialize
+
+# ベンチマーク用の合成モデル/合成動画の作成
+# 各モデルクラスが期待する入出力(名前とshape)だけを合わせた小さなモデルを作成する
+# 推論結果は固定値(入力に依存する項を0倍で加えて定数畳み込みで消されないようにしている)なので
+# 精度の評価には使えない(処理時間の計測専用)
+
+# 作成するモデル =================================================================
+# ファイル名 : (種類, 入力shape(NCHW), 出力 [(出力名, 出力shape)], 対応するモデルクラス)
+# 入力サイズは実際に使うモデル(test.sh で指定しているもの)に合わせている
+SYNTHETIC_MODELS = {
+    "ssd.xml"    : ("detect", (1, 3, 300, 300), [("detection_out", None)],                    "model_ssd_detect"),
+    "face.xml"   : ("detect", (1, 3, 384, 672), [("detection_out", None)],                    "model_face_detect"),
+    "lm5.xml"    : ("head",   (1, 3,  48,  48), [("landmark5",  (1, 5 * 2, 1, 1))],           "model_face_landmark5"),
+    "lm35.xml"   : ("head",   (1, 3,  60,  60), [("landmark35", (1, 35 * 2))],                "model_face_landmark35"),
+    "hp.xml"     : ("head",   (1, 3,  60,  60), [("angle_r_fc", (1, 1)),
+                                                 ("angle_p_fc", (1, 1)),
+                                                 ("angle_y_fc", (1, 1))],                     "model_face_headpose"),
+    "person.xml" : ("detect", (1, 3, 320, 544), [("detection_out", None)],                    "model_person_detect"),
+    "reid.xml"   : ("head",   (1, 3, 256, 128), [("reid_embedding", (1, 256))],               "model_person_reid"),
+    "attr.xml"   : ("head",   (1, 3, 160,  80), [("attributes", (1, 7))],                     "model_person_attr"),
+}
+# ================================================================================
+
+# コマンドラインパーサの構築 =====================================================
+def build_argparser():
+    parser = ArgumentParser(add_help=False, formatter_class=RawTextHelpFormatter)
+    parser.add_argument('-h', '--help', action='help', default=SUPPRESS,
+                        help='Show this help message and exit.')
+    parser.add_argument("-o", "--output_dir", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "_synthetic"), type=str,
+                        help="Optional.\n"
+                             "Output directory\n"
+                             "Default is ./_synthetic")
+    parser.add_argument("--detections", default=20, type=int,
+                        help="Optional.\n"
+                             "Number of detections per frame output by detection models\n"
+                             "Default value is 20")
+    parser.add_argument("--frames", default=100, type=int,
+                        help="Optional.\n"
+                             "Number of frames of synthetic video\n"
+                             "Default value is 100")
+    parser.add_argument("--width", default=1280, type=int,
+                        help="Optional.\n"
+                             "Width of synthetic video\n"
+                             "Default value is 1280")
+    parser.add_argument("--height", default=720, type=int,
+                        help="Optional.\n"
+                             "Height of synthetic video\n"
+                             "Default value is 720")
+    parser.add_argument("--seed", default=0, type=int,
+                        help="Optional.\n"
+                             "Random seed\n"
+                             "Default value is 0")
+    return parser
+# ================================================================================
+
+# 入力に依存する特徴量 ===========================================================
+# 畳み込みと平均で (N,) の値を作る(推論時間が0にならないようにするための負荷)
+def input_feature(rng, input_shape) :
+    data = ov_opset.parameter(list(input_shape), np.float32, name="data")
+    data.output(0).get_tensor().set_names({"data"})
+    weights = ov_opset.constant(rng.standard_normal((8, input_shape[1], 3, 3)).astype(np.float32))
+    conv = ov_opset.convolution(data, weights, [1, 1], [1, 1], [1, 1], [1, 1])
+    feature = ov_opset.reduce_mean(conv, ov_opset.constant(np.array([1, 2, 3])), keep_dims=False)
+    return data, feature
+    
+# 定数に入力依存の項(0倍)を加えた出力
+def const_output(value, feature, name) :
+    shape = [-1] + [1] * (value.ndim - 1)           # バッチ方向にブロードキャスト
+    zero  = ov_opset.multiply(ov_opset.reshape(feature, ov_opset.constant(np.array(shape)), False), ov_opset.constant(np.float32(0)))
+    output = ov_opset.add(ov_opset.constant(value), zero)
+    output.output(0).get_tensor().set_names({name})
+    return output
+# ================================================================================
+
+# 検出モデル(DetectionOutput形式) ================================================
+# 出力は (1,1,バッチサイズ*N,7) の [image_id, label, conf, x_min, y_min, x_max, y_max]
+# バッチサイズを変更(reshape)しても image_id が画像毎に振られるようにしている
+def make_detect_model(rng, input_shape, output_name, detections) :
+    data, feature = input_feature(rng, input_shape)
+    
+    # 1画像分の検出結果 (閾値0.5で半分程度が残るconfidence)
+    objs = np.zeros((1, detections, 7), dtype=np.float32)
+    objs[0, :, 1]   = rng.integers(1, 20, detections)
+    objs[0, :, 2]   = rng.uniform(0.3, 1.0, detections)
+    xy = rng.random((detections, 2)) * 0.7
+    wh = rng.random((detections, 2)) * 0.25 + 0.05
+    objs[0, :, 3:5] = xy
+    objs[0, :, 5:7] = xy + wh
+    
+    # 画像毎に image_id を加える
+    batch     = ov_opset.gather(ov_opset.shape_of(data), ov_opset.constant(np.array([0])), ov_opset.constant(np.array(0)))
+    image_ids = ov_opset.convert(ov_opset.range(ov_opset.constant(np.int64(0)), ov_opset.squeeze(batch, ov_opset.constant(np.array([0]))), ov_opset.constant(np.int64(1)), "i64"), np.float32)
+    id_col = np.zeros((1, 1, 7), dtype=np.float32)
+    id_col[..., 0] = 1
+    output = ov_opset.add(ov_opset.constant(objs), ov_opset.multiply(ov_opset.reshape(image_ids, ov_opset.constant(np.array([-1, 1, 1])), False), ov_opset.constant(id_col)))
+    output = ov_opset.add(output, ov_opset.multiply(ov_opset.reshape(feature, ov_opset.constant(np.array([-1, 1, 1])), False), ov_opset.constant(np.float32(0))))
+    output = ov_opset.reshape(output, ov_opset.constant(np.array([1, 1, -1, 7])), False)
+    output.output(0).get_tensor().set_names({output_name})
+    return ov_Model([output], [data], "synthetic_detect")
+# ================================================================================
+
+# 二次推論モデル(切り取り画像から固定長のベクトルを出力) =========================
+def make_head_model(rng, input_shape, outputs) :
+    data, feature = input_feature(rng, input_shape)
+    results = [const_output(rng.random(shape).astype(np.float32), feature, name) for name, shape in outputs]
+    return ov_Model(results, [data], "synthetic_head")
+# ================================================================================
+
+# 合成動画 =======================================================================
+# 背景の上を複数の円が移動する動画(MJPG)
+def make_video(rng, filename, frames, width, height) :
+    writer = cv2.VideoWriter(filename, cv2.VideoWriter_fourcc(*"MJPG"), 30, (width, height))
+    num_objects = 8
+    pos    = rng.random((num_objects, 2)) * (width, height)
+    vel    = (rng.random((num_objects, 2)) - 0.5) * 20
+    colors = rng.integers(0, 256, (num_objects, 3))
+    radius = rng.integers(height // 20, height // 8, num_objects)
+    background = np.tile(np.linspace(30, 90, width, dtype=np.uint8)[None, :, None], (height, 1, 3))
+    for _ in range(frames) :
+        image = background.copy()
+        for (x, y), color, r in zip(pos.astype(int), colors.tolist(), radius.tolist()) :
+            cv2.circle(image, (x, y), r, color, -1)
+        writer.write(image)
+        pos = (pos + vel) % (width, height)
+    writer.release()
+# ================================================================================
+
+# 合成モデル/合成動画の作成 ======================================================
+# 戻り値 : 合成動画のファイル名
+def make_synthetic(output_dir, detections=20, frames=100, width=1280, height=720, seed=0) :
+    os.makedirs(output_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    for filename, (kind, input_shape, outputs, class_name) in SYNTHETIC_MODELS.items() :
+        if kind == "detect" :
+            model = make_detect_model(rng, input_shape, outputs[0][0], detections)
+        else :
+            model = make_head_model(rng, input_shape, outputs)
+        model_xml = os.path.join(output_dir, filename)
+        ov_serialize(model, model_xml, os.path.splitext(model_xml)[0] + ".bin")
+        log.info(f'{class_name:22} : {model_xml}')
+        
+    video_file = os.path.join(output_dir, "video.avi")
+    make_video(rng, video_file, frames, width, height)
+    log.info(f'{"video":22} : {video_file} ({width}x{height}, {frames} frames)')
+    return video_file
+# ================================================================================
+
+# メイン処理 =====================================================================
+def main():
+    log.basicConfig(format="[ %(levelname)s ] %(message)s", level=log.INFO, stream=sys.stdout)
+    
+    # コマンドラインオプションの解析
+    args = build_argparser().parse_args()
+    
+    make_synthetic(args.output_dir, args.detections, args.frames, args.width, args.height, args.seed)
+# ================================================================================
+
+if __name__ == '__main__':
+    sys.exit(main() or 0)
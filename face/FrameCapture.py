@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+import sys
+import os
+import time
+import threading
+import logging as log
+from collections import deque, namedtuple
+import cv2
+
+from Profiler import profiler
+
+# キャプチャしたフレーム
+#   image        : キャプチャした画像
+#   frame_number : 入力のフレーム番号(1から。カメラ入力で破棄したフレームも数える)
+#   capture_time : キャプチャ完了時刻(time.perf_counter)
+#   decode_time  : キャプチャ(デコード)にかかった時間(msec)
+CapturedFrame = namedtuple("CapturedFrame", ["image", "frame_number", "capture_time", "decode_time"])
+
+# フレームキャプチャクラス ========================================================
+# cv2.VideoCapture のデコードをキャプチャスレッドで行い、
+# キャプチャしたフレームを最大 buffer_size 個までバッファに溜めておく。
+# バッファが一杯のとき
+#   drop=True  : 最も古いフレームを破棄する(カメラ入力用。常に最新のフレームを処理する)
+#   drop=False : 空きができるまでキャプチャを待つ(ファイル入力用。全フレームを処理する)
+# buffer_size が 0 ならスレッドを使わず、read() の中でキャプチャする
+class FrameCapture() :
+    def __init__(self, input_file, buffer_size=4, drop=False) :
+        self.cap = cv2.VideoCapture(input_file)
+        self.buffer_size = buffer_size
+        self.drop        = drop
+        
+        # 幅と高さ、フレームレート、フレーム数
+        # (キャプチャスレッドの開始後は cap にアクセスしないように、ここで取得しておく)
+        self.img_height  = int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        self.img_width   = int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        self.frame_rate  = self.cap.get(cv2.CAP_PROP_FPS)
+        self.frame_count = int(self.cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        
+        # フレームバッファ
+        self.buffer      = deque()
+        self.cond        = threading.Condition()
+        self.end_flag    = False        # 入力の終わりに達した
+        self.stop_flag   = False        # キャプチャの中止
+        self.thread      = None
+        
+        self.frame_number = 0           # キャプチャしたフレーム数
+        self.drop_count   = 0           # 破棄したフレーム数
+        
+    # キャプチャスレッドの開始
+    def start(self) :
+        if self.buffer_size > 0 and self.thread is None :
+            self.thread = threading.Thread(target=self.capture_loop, daemon=True)
+            self.thread.start()
+            
+    # 1フレームのキャプチャ(キャプチャできなければNone)
+    def capture(self) :
+        start_time = time.perf_counter()
+        ret, image = self.cap.read()
+        end_time = time.perf_counter()
+        if not ret :
+            return None
+        self.frame_number += 1
+        profiler.record("capture/decode", start_time, end_time, frame=self.frame_number)
+        return CapturedFrame(image, self.frame_number, end_time, (end_time - start_time) * 1000)   # msec単位に変換
+        
+    # キャプチャスレッド
+    def capture_loop(self) :
+        while not self.stop_flag :
+            frame = self.capture()
+            with self.cond :
+                if frame is None :
+                    self.end_flag = True
+                    self.cond.notify_all()
+                    break
+                if len(self.buffer) >= self.buffer_size :
+                    if self.drop :
+                        # 最も古いフレームを破棄
+                        self.buffer.popleft()
+                        self.drop_count += 1
+                    else :
+                        # 空きができるまで待つ
+                        self.cond.wait_for(lambda : len(self.buffer) < self.buffer_size or self.stop_flag)
+                        if self.stop_flag :
+                            break
+                self.buffer.append(frame)
+                self.cond.notify_all()
+                
+    # フレームの取り出し ===============================================
+    # キャプチャ済みのフレームがなければキャプチャされるまで待つ(最大 timeout 秒。Noneなら無制限)
+    # 取り出せるフレームがなければNoneを返す(入力の終わりに達したかは is_end() で確認する)
+    def read(self, timeout=None) :
+        if self.thread is None :
+            frame = self.capture()
+            if frame is None :
+                self.end_flag = True
+            return frame
+        with self.cond :
+            self.cond.wait_for(lambda : len(self.buffer) > 0 or self.end_flag, timeout)
+            if len(self.buffer) == 0 :
+                return None
+            frame = self.buffer.popleft()
+            self.cond.notify_all()
+        return frame
+    
+    # 入力の終わりに達し、取り出していないフレームも残っていない
+    def is_end(self) :
+        with self.cond :
+            return self.end_flag and len(self.buffer) == 0
+        
+    # キャプチャの終了 ================================================
+    def release(self) :
+        if self.thread :
+            with self.cond :
+                self.stop_flag = True
+                self.cond.notify_all()
+            self.thread.join()
+            self.thread = None
+        self.cap.release()
+        if self.drop_count > 0 :
+            log.info(f"capture : {self.drop_count} frames dropped")
+# ================================================================================
@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+import sys
+import os
+import time
+import threading
+import logging as log
+
+from Profiler import profiler
+
+# カスケード推論スケジューラ ======================================================
+# 検出モデルの結果(detection_batch の切り出し画像)を二次モデル群で非同期に推論する。
+# 次フレームの検出と現フレームの二次推論が同時に実行され、
+# 結果は async_model_base.get_infer_result と同様にフレーム番号順に取り出す。
+# 二次モデル同士は互いに依存しないので、1フレーム分の全切り出し画像を
+# 全二次モデルにまとめて投入し、完了順に結果を受け取る。
+# フレーム間で状態を持つ処理(reidの照合など)は、取り出し時に
+# analyze_result_ordered でフレーム番号順に実行する。
+# tracker(box_tracker)を指定すると、検出しないフレーム(skip_detect)の検出枠を
+# フレーム番号順に追跡で補間してから二次推論を投入する。
+# さらに refresh_interval を指定すると、二次推論はトラック毎に
+#   ・新しいトラック
+#   ・見失ってから再検出したトラック
+#   ・前回の二次推論から refresh_interval フレーム経過したトラック
+# に対してだけ行い、それ以外はトラックの前回の二次推論の結果(キャッシュ)を使う。
+# refresh_interval は二次モデル毎に {結果格納キー : フレーム数} でも指定でき、0 のモデルは毎フレーム推論する。
+# 二次推論した結果は二次モデルの merge_track_result でトラックの前回の結果と統合される。
+class cascade_scheduler() :
+    def __init__(self, model_detect, sub_models, tracker=None, refresh_interval=0) :
+        # 検出モデル
+        self.model_detect = model_detect
+        
+        # 二次モデル {結果格納キー : モデル} (Noneのモデルは除外)
+        self.sub_models = {key: model for key, model in sub_models.items() if model}
+        
+        # 結果格納辞書 (キーはフレーム番号)
+        self.lock           = threading.Lock()
+        self.detect_results = {}        # 二次推論投入前の検出結果
+        self.jobs           = {}        # 二次推論中のフレーム
+        self.infer_results  = {}        # 全推論が完了したフレーム
+        
+        # 検出のスキップと追跡(メインスレッドだけで使う)
+        self.tracker            = tracker
+        self.skip_frames        = {}    # 検出しないフレーム {フレーム番号 : (元画像, 表示用フレーム)}
+        self.untracked_results  = {}    # 追跡待ちの検出結果(前のフレームの検出が終わっていない)
+        self.track_frame_number = 1     # 次に追跡するフレーム番号
+        
+        # トラック毎の二次推論の間引き(メインスレッドだけで使う)
+        if not isinstance(refresh_interval, dict) :
+            refresh_interval = {key: refresh_interval for key in self.sub_models}
+        self.refresh_intervals = {key: refresh_interval.get(key, 0) for key in self.sub_models}
+        self.track_states      = {key: {} for key in self.sub_models}   # 投入時のトラックの状態 {結果格納キー : {トラックID : {"seen": 最後に検出されたフレーム, "infer": 最後に二次推論したフレーム}}}
+        self.track_caches      = {key: {} for key in self.sub_models}   # 取り出し時のトラックの結果 {結果格納キー : {トラックID : {"seen": 最後に検出されたフレーム, "result": 結果}}}
+        self.sub_total_count   = 0                                      # 二次推論の対象になり得た検出数(取り出し済みのフレーム)
+        self.sub_infer_counts  = {key: 0 for key in self.sub_models}    # 二次推論した検出数(取り出し済みのフレーム)
+        
+        # callbackの設定
+        self.model_detect.set_result_callback(self.detect_callback)
+        for key, model in self.sub_models.items() :
+            model.set_result_callback(self.make_sub_callback(key))
+            
+    # 検出モデルのcallback (推論スレッドから呼ばれる)
+    def detect_callback(self, params, start, results) :
+        disp_frame = params[1]
+        with self.lock :
+            self.detect_results[disp_frame.frame_number] = {"disp_frame": disp_frame, "result": results}
+            
+    # 二次モデルのcallback (推論スレッドから呼ばれる)
+    def make_sub_callback(self, key) :
+        def sub_callback(params, start, sub_results) :
+            frame_number = params[0]
+            with self.lock :
+                job = self.jobs[frame_number]
+                results = job["result"].results_of(key)
+                for i, sub_result in enumerate(sub_results) :
+                    results[job["targets"][key][start + i]] = sub_result
+                job["remain"] -= len(sub_results)
+                if job["remain"] == 0 :
+                    # 全ての二次推論が完了
+                    self.infer_results[frame_number] = self.jobs.pop(frame_number)
+        return sub_callback
+        
+    # 検出済みフレームの二次推論を投入 (メインスレッドから呼ぶ)
+    def dispatch(self) :
+        with self.lock :
+            detect_results      = self.detect_results
+            self.detect_results = {}
+            
+        if self.tracker :
+            with profiler.span("scheduler/track", count=len(detect_results)) :
+                detect_results = self.track(detect_results)
+            
+        for frame_number in sorted(detect_results.keys()) :
+            job = detect_results[frame_number]
+            results = job["result"]
+            
+            # 二次推論する検出結果のインデックス {結果格納キー : インデックスのリスト}
+            job["targets"] = self.select_targets(frame_number, results)
+            
+            # 残り推論数は推論投入前に設定しておく
+            job["remain"] = sum(len(targets) for targets in job["targets"].values())
+            with self.lock :
+                if job["remain"] == 0 :
+                    # 二次推論不要
+                    self.infer_results[frame_number] = job
+                    continue
+                self.jobs[frame_number] = job
+                
+            # 二次推論する切り出し画像を各二次モデルに投入
+            # 切り出し画像は入力サイズ毎に1回だけリサイズして、入力サイズが同じモデル同士で共有する
+            # (キューに空きがなければここで待つ)
+            for key, model in self.sub_models.items() :
+                if len(job["targets"][key]) == 0 :
+                    continue            # このモデルで二次推論する検出がない
+                with profiler.span("scheduler/crop", frame=frame_number, key=key) :
+                    images = results.crops(job["targets"][key], model.crop_size())
+                model.start_infer_batch(images, (frame_number, ))
+                
+    # 検出結果と検出しないフレームをフレーム番号順に追跡して、追跡済みのフレームの検出結果を返す
+    # (検出が終わっていないフレームがあれば、それ以降のフレームは次回に回す)
+    def track(self, detect_results) :
+        self.untracked_results.update(detect_results)
+        tracked_results = {}
+        while True :
+            frame_number = self.track_frame_number
+            if frame_number in self.untracked_results :
+                # 検出したフレーム
+                job = self.untracked_results.pop(frame_number)
+                job["result"] = self.model_detect.track_result(self.tracker, None, job["result"])
+            elif frame_number in self.skip_frames :
+                # 検出しないフレーム
+                image, disp_frame = self.skip_frames.pop(frame_number)
+                job = {"disp_frame": disp_frame, "result": self.model_detect.track_result(self.tracker, image, None)}
+            else :
+                break
+            tracked_results[frame_number] = job
+            self.track_frame_number += 1
+        return tracked_results
+        
+    # 二次推論する検出結果の選択 (フレーム番号順に呼ぶ)
+    # 戻り値 : {結果格納キー : 二次推論する検出結果のインデックスのリスト}
+    def select_targets(self, frame_number, results) :
+        targets = {}
+        for key, interval in self.refresh_intervals.items() :
+            if interval <= 0 :
+                targets[key] = list(range(len(results)))
+                continue
+            
+            states = self.track_states[key]
+            targets[key] = []
+            for i, track_id in enumerate(results.data["track_id"].tolist()) :
+                state = states.get(track_id)
+                if state is None or state["seen"] < frame_number - 1 or frame_number - state["infer"] >= interval :
+                    # 新しいトラック、見失ってから再検出したトラック、前回の二次推論から一定フレーム経過したトラック
+                    state = {"infer": frame_number}
+                    states[track_id] = state
+                    targets[key].append(i)
+                state["seen"] = frame_number
+            
+            # 前のフレームで検出されなかったトラックは次に検出されたときに再推論するので削除
+            self.track_states[key] = {track_id: state for track_id, state in states.items() if state["seen"] >= frame_number - 1}
+        return targets
+        
+    # トラック毎の結果のキャッシュ (フレーム番号順に呼ぶ)
+    # 二次推論した検出結果はトラックの前回の結果と統合してキャッシュし、
+    # 二次推論しなかった検出結果にはキャッシュした結果を設定する
+    def apply_track_cache(self, key, frame_number, results, targets) :
+        model       = self.sub_models[key]
+        cache       = self.track_caches[key]
+        sub_results = results.results_of(key)
+        targets     = set(targets)
+        for i, track_id in enumerate(results.data["track_id"].tolist()) :
+            entry = cache.get(track_id)
+            if i in targets :
+                if entry :
+                    sub_results[i] = model.merge_track_result(entry["result"], sub_results[i])
+                entry = {"result": sub_results[i]}
+                cache[track_id] = entry
+            else :
+                sub_results[i] = entry["result"]
+            entry["seen"] = frame_number
+        
+        # 前のフレームで検出されなかったトラックは次に検出されたときに再推論されるので削除
+        self.track_caches[key] = {track_id: entry for track_id, entry in cache.items() if entry["seen"] >= frame_number - 1}
+        
+    # 結果をトラック毎にキャッシュする二次モデルの結果格納キー
+    def cached_keys(self) :
+        return [key for key, interval in self.refresh_intervals.items() if interval > 0]
+        
+    # キャッシュのヒット率(%)と二次推論を省略した検出数
+    def cache_stats(self, key) :
+        saved = self.sub_total_count - self.sub_infer_counts[key]
+        ratio = saved / self.sub_total_count * 100 if self.sub_total_count > 0 else 0
+        return ratio, saved
+        
+    # キャッシュの状態(ステータス表示用)
+    def cache_status(self, key) :
+        ratio, saved = self.cache_stats(key)
+        return f'{key + " cache":17}: {ratio:5.1f} % hit ({saved} / {self.sub_total_count} crops saved)'
+        
+    def is_ready(self) :
+        return self.model_detect.is_ready()
+        
+    def start_infer(self, feed_dict, disp_frame, image) :
+        # 検出モデルのparamsは(元画像, 表示用フレーム)
+        self.model_detect.start_infer(feed_dict, (image, disp_frame))
+        
+    # 検出しないフレーム(二次推論は追跡で補間した検出枠に対して行う)
+    def skip_detect(self, disp_frame, image) :
+        self.skip_frames[disp_frame.frame_number] = (image, disp_frame)
+        
+    def get_infer_result(self, disp_frame_number) :
+        # 検出済みのフレームがあれば二次推論を投入
+        self.dispatch()
+        
+        with self.lock :
+            infer_rst = self.infer_results.pop(disp_frame_number, None)     # 辞書から要素を取り出して削除、要素がなければNone
+        
+        if infer_rst :
+            # フレーム番号順の解析
+            results = infer_rst["result"]
+            self.sub_total_count += len(results)
+            for key, model in self.sub_models.items() :
+                targets     = infer_rst["targets"][key]
+                sub_results = results.results_of(key)
+                with model.profile("analyze_result_ordered", frame=disp_frame_number, count=len(targets)) :
+                    for i, sub_result in zip(targets, model.analyze_result_ordered([sub_results[i] for i in targets])) :
+                        sub_results[i] = sub_result
+                self.sub_infer_counts[key] += len(targets)
+                
+                # 二次推論しなかったトラックはキャッシュした結果を使う
+                if self.refresh_intervals[key] > 0 :
+                    self.apply_track_cache(key, disp_frame_number, results, infer_rst["targets"][key])
+        return infer_rst
+        
+    def wait_all(self) :
+        self.model_detect.wait_all()
+        for model in self.sub_models.values() :
+            model.wait_all()
+# ================================================================================
@@ -12,12 +12,13 @@ import numpy as np
 # from openvino.runtime import AsyncInferQueue    as ov_AsyncInferQueue
 
 from .sync_model_base import sync_model_base
+from .detection_batch import detection_batch
 from DispFrame import console_print
 
 class model_face_detect(sync_model_base) :
-    def __init__(self, core, model_xml, device="CPU", threshold=0.5, clip_ratio=1.2, log_f=None) :
+    def __init__(self, core, model_xml, device="CPU", threshold=0.5, clip_ratio=1.2, queue_num=1, log_f=None, ppp=False) :
         # 親クラスの初期化をcall
-        super().__init__(core, model_xml, device=device, threshold=threshold, log_f=log_f)
+        super().__init__(core, model_xml, device=device, threshold=threshold, queue_num=queue_num, log_f=log_f, ppp=ppp)
 
         self.clip_ratio     = clip_ratio
 
@@ -65,51 +66,35 @@ class model_face_detect(sync_model_base) :
         else :
             raise ValueError('output type unknown')
         
-        results = []
-        for obj in res_array:
-            img_size = np.array((img_width,  img_height))
-            if self.output_type == 1 :
-                conf = obj[2]                       # confidence for the predicted class(スコア)
-                pt1 = np.array((obj[3], obj[4])) * img_size    # (left,  top   )
-                pt2 = np.array((obj[5], obj[6])) * img_size    # (right, bottom)
-            elif self.output_type == 2 :
-                input_size = np.array((self.img_input_width, self.img_input_height))
-                conf = obj[4]                       # confidence for the predicted class(スコア)
-                pt1 = np.array((obj[0], obj[1])) / input_size * img_size    # (left,  top   )
-                pt2 = np.array((obj[2], obj[3])) / input_size * img_size    # (right, bottom)
-            else :
-                raise ValueError('output type unknown')
-                
-            if conf > self.threshold:               # 閾値より大きいものだけ処理
-                pt1 = pt1.astype(int)               # 整数化
-                pt2 = pt2.astype(int)               
-                size = pt2 - pt1                    # 範囲のサイズ
-                
-                # 検出範囲の拡張比率で切り取り範囲を決定
-                pt1_ex = (pt1 - (size / 2) * (self.clip_ratio - 1)).astype(int)        # (x1, y1)
-                pt2_ex = (pt2 + (size / 2) * (self.clip_ratio - 1)).astype(int)        # (x2, y2)
-                
-                # 元画像範囲に収まるように調整
-                pt1_ex = np.clip(pt1_ex, (0, 0), (img_width, img_height))
-                pt2_ex = np.clip(pt2_ex, (0, 0), (img_width, img_height))
-                
-                # 顔画像を切り取り
-                cliped_image  = np.array(image[pt1_ex[1]:pt2_ex[1], pt1_ex[0]:pt2_ex[0], :])
-                
-                """
-                cv2.imshow("hoge", image)
-                cv2.waitKey(0)
-                """
-                results.append({"conf":conf, "pt1":pt1, "pt2":pt2, "pt1_ex":pt1_ex, "pt2_ex":pt2_ex, "image":cliped_image})
-        return results
+        # 閾値より大きいものだけ取り出し、座標を画像サイズに変換(float64で計算)
+        img_size = np.array((img_width, img_height, img_width, img_height), dtype=np.float64)
+        if self.output_type == 1 :
+            objs  = res_array[res_array[:, 2] > self.threshold]
+            confs = objs[:, 2]                                          # confidence for the predicted class(スコア)
+            boxes = objs[:, 3:7].astype(np.float64) * img_size          # (left, top, right, bottom)
+        else :
+            objs  = res_array[res_array[:, 4] > self.threshold]
+            input_size = np.array((self.img_input_width, self.img_input_height, self.img_input_width, self.img_input_height), dtype=np.float64)
+            confs = objs[:, 4]                                          # confidence for the predicted class(スコア)
+            boxes = objs[:, 0:4].astype(np.float64) / input_size * img_size     # (left, top, right, bottom)
+        
+        # 切り取り範囲の決定 (顔画像は元画像のビューとして必要なときに作成する)
+        return detection_batch.from_boxes(image, confs, boxes, self.clip_ratio)
+    # ================================================================================
+    
+    # 検出結果の出力用の列 ===========================================
+    # 1フレーム分の検出結果(detection_batch)を ResultWriter に渡す列に変換する
+    # 戻り値 : {"conf" : (N,), "box" : (N,4)の(x1, y1, x2, y2)}
+    def result_columns(self, batch) :
+        return {"conf": batch.data["conf"], "box": batch.data["box"]}
     # ================================================================================
     
     # 後処理 =======================================================
     def post_process(self, disp_frame, result) :
         # 結果を個別の変数にバラす
-        conf     = result["conf"]
-        pt1      = result["pt1"]
-        pt2      = result["pt2"]
+        conf     = result.conf
+        pt1      = result.pt1
+        pt2      = result.pt2
         
         # 結果をログファイルorコンソールに出力
         console_print(self.log_f, f'{disp_frame.frame_number:3}: Confidence={conf:4f} Location=({pt1[0]},{pt1[1]})-({pt2[0]},{pt2[1]})', False)
@@ -119,8 +104,8 @@ class model_face_detect(sync_model_base) :
         
         """
         # 拡張した検出枠の描画
-        pt1_ex   = result["pt1_ex"]
-        pt2_ex   = result["pt2_ex"]
+        pt1_ex   = result.pt1_ex
+        pt2_ex   = result.pt2_ex
         
         disp_frame.draw_box(pt1_ex, pt2_ex, (128, 255, 255))
         """
@@ -15,9 +15,9 @@ from .sync_model_base import sync_model_base
 from DispFrame import console_print
 
 class model_face_headpose(sync_model_base) :
-    def __init__(self, core, model_xml, device="CPU", log_f=None) :
+    def __init__(self, core, model_xml, device="CPU", batch_size=1, queue_num=1, log_f=None, ppp=False) :
         # 親クラスの初期化をcall
-        super().__init__(core, model_xml, device=device, log_f=log_f)
+        super().__init__(core, model_xml, device=device, batch_size=batch_size, queue_num=queue_num, log_f=log_f, ppp=ppp)
         
     # output blobの確認 ===============================================
     def check_output_blob(self) :
@@ -35,19 +35,25 @@ class model_face_headpose(sync_model_base) :
             assert tuple(x.shape) == (1, 1), "each output shape must (1, 1)"
     
     # 結果の解析 ===============================================
-    def analyze_result(self, res, params) :
+    def analyze_result(self, res, params, batch_index=0) :
         # params未使用
         
-        # output tensorの取り出し
-        roll  = res.get_tensor('angle_r_fc').data[0][0]
-        pitch = res.get_tensor('angle_p_fc').data[0][0]
-        yaw   = res.get_tensor('angle_y_fc').data[0][0]
+        # output tensorの取り出し(batch_index番目の画像の結果)
+        roll  = res.get_tensor('angle_r_fc').data[batch_index][0]
+        pitch = res.get_tensor('angle_p_fc').data[batch_index][0]
+        yaw   = res.get_tensor('angle_y_fc').data[batch_index][0]
         
         result = {"roll": roll, "pitch":pitch, "yaw":yaw}
         
         return result
     # ================================================================================
     
+    # 検出結果の出力用の列 ===========================================
+    # 戻り値 : {key : (N,3)の (yaw, pitch, roll)}
+    def result_columns(self, batch, key) :
+        return {key: np.array([(result["yaw"], result["pitch"], result["roll"]) for result in batch.results_of(key)], dtype=np.float32).reshape(-1, 3)}
+    # ================================================================================
+    
     # 後処理 =======================================================
     def post_process(self, cur_frame, result, pt1_ex, pt2_ex) :
         # 顔画像の中心位置
@@ -15,9 +15,9 @@ from .sync_model_base import sync_model_base
 from DispFrame import console_print
 
 class model_face_landmark5(sync_model_base) :
-    def __init__(self, core, model_xml, device="CPU", log_f=None) :
+    def __init__(self, core, model_xml, device="CPU", batch_size=1, queue_num=1, log_f=None, ppp=False) :
         # 親クラスの初期化をcall
-        super().__init__(core, model_xml, device=device, log_f=log_f)
+        super().__init__(core, model_xml, device=device, batch_size=batch_size, queue_num=queue_num, log_f=log_f, ppp=ppp)
         
     # output blobの確認 ===============================================
     def check_output_blob(self) :
@@ -30,14 +30,15 @@ class model_face_landmark5(sync_model_base) :
         assert tuple(self.output_blob_shape) == (1, 5 * 2, 1, 1), f"output shape must be (1, 5 * 2, 1, 1), but it is {self.output_blob_shape}" # 出力レイヤのshape確認
     
     # 結果の解析 ===============================================
-    def analyze_result(self, res, params) :
+    def analyze_result(self, res, params, batch_index=0) :
         # params未使用
         
         # output tensorの取り出し
         res = res.get_tensor(self.output_blob_name).data[:]
         
-        # 結果の取り出し
-        res_array = res[0].reshape((-1, 2))
+        # 結果の取り出し(batch_index番目の画像の結果)
+        # 出力領域は次の推論で上書きされるのでコピーしておく
+        res_array = res[batch_index].reshape((-1, 2)).copy()
         
         result = {
             "right_eye"        : res_array[0],
@@ -49,6 +50,14 @@ class model_face_landmark5(sync_model_base) :
         return result
     # ================================================================================
     
+    # 検出結果の出力用の列 ===========================================
+    # 戻り値 : {key : (N,5,2)の画像座標の特徴点 (右目, 左目, 鼻, 右口角, 左口角)}
+    def result_columns(self, batch, key) :
+        names  = ("right_eye", "left_eye", "nose_top", "right_lip_corner", "left_lip_corner")
+        points = np.array([[result[name] for name in names] for result in batch.results_of(key)], dtype=np.float32).reshape(-1, 5, 2)
+        return {key: batch.crop_to_image(points)}
+    # ================================================================================
+    
     # 後処理 =======================================================
     def post_process(self, cur_frame, result, pt1_ex, pt2_ex) :
         size_ex = pt2_ex - pt1_ex
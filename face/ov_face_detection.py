@@ -17,7 +17,11 @@ from model.model_face_detect import model_face_detect
 from model.model_face_landmark5 import model_face_landmark5
 from model.model_face_landmark35 import model_face_landmark35
 from model.model_face_headpose import model_face_headpose
+from model.cascade_scheduler import cascade_scheduler
 from DispFrame import DispFrame, ImageSave, console_print
+from FrameCapture import FrameCapture
+from Profiler import profiler
+from ResultWriter import ResultWriter
 
 # コマンドラインパーサの構築 =====================================================
 def build_argparser():
@@ -33,6 +37,16 @@ def build_argparser():
                              "Required for CPU custom layers. \n"
                              "Absolute path to a shared library\n"
                              "with the kernels implementations.")
+    parser.add_argument("--ppp", action='store_true', 
+                        help="Optional.\n"
+                             "Embed resize and layout conversion into the model\n"
+                             "with OpenVINO PrePostProcessor\n"
+                             "(captured frames are passed to the model without copy)")
+    parser.add_argument("--capture_buffer", default=4, type=int, 
+                        help="Optional.\n"
+                             "Number of frames buffered by the capture thread\n"
+                             "(for camera input, the oldest frame is dropped when full)\n"
+                             "Specify 0 to capture in the main thread")
     
     face_args = parser.add_argument_group('face detect Options')
     face_args.add_argument("-m", "--model", required=True, type=str, 
@@ -45,6 +59,9 @@ def build_argparser():
                              "The demo will look for a suitable plugin \n"
                              "for device specified.\n"
                              "Default value is CPU")
+    face_args.add_argument("--queue_num", default=2, type=int, 
+                        help="Optional.\n"
+                             "Number of async infer queues")
     face_args.add_argument("-t_detect", "--threshold_detect", default=0.5, type=float, 
                         help="Optional.\n"
                              "Probability threshold for detections filtering")
@@ -60,6 +77,15 @@ def build_argparser():
                         help="Optional\n"
                              "Specify the target device to infer for landmark detection (5points)\n"
                              "Default value is CPU")
+    lm5_args.add_argument("-b_lm5", "--batch_lm5", default=1, type=int, 
+                        help="Optional\n"
+                             "Batch size to infer for landmark detection (5points)\n"
+                             "(all detected faces are inferred in batches of this size)\n"
+                             "Specify 0 to use dynamic batch size\n"
+                             "Default value is 1")
+    lm5_args.add_argument("-q_lm5", "--queue_num_lm5", default=2, type=int, 
+                        help="Optional.\n"
+                             "Number of async infer queues for landmark detection (5points)")
     
     lm35_args = parser.add_argument_group('landmark detect (35points) Options')
     lm35_args.add_argument("-m_lm35", "--model_lm35", default=None, type=str, 
@@ -69,6 +95,15 @@ def build_argparser():
                         help="Optional\n"
                              "Specify the target device to infer for landmark detection (35point)\n"
                              "Default value is CPU")
+    lm35_args.add_argument("-b_lm35", "--batch_lm35", default=1, type=int, 
+                        help="Optional\n"
+                             "Batch size to infer for landmark detection (35point)\n"
+                             "(all detected faces are inferred in batches of this size)\n"
+                             "Specify 0 to use dynamic batch size\n"
+                             "Default value is 1")
+    lm35_args.add_argument("-q_lm35", "--queue_num_lm35", default=2, type=int, 
+                        help="Optional.\n"
+                             "Number of async infer queues for landmark detection (35point)")
     
     hp_args = parser.add_argument_group('head pose estimation Options')
     hp_args.add_argument("-m_hp", "--model_hp", default=None, type=str, 
@@ -78,14 +113,53 @@ def build_argparser():
                         help="Optional\n"
                              "Specify the target device to infer for head pose estimation\n"
                              "Default value is CPU")
+    hp_args.add_argument("-b_hp", "--batch_hp", default=1, type=int, 
+                        help="Optional\n"
+                             "Batch size to infer for head pose estimation\n"
+                             "(all detected faces are inferred in batches of this size)\n"
+                             "Specify 0 to use dynamic batch size\n"
+                             "Default value is 1")
+    hp_args.add_argument("-q_hp", "--queue_num_hp", default=2, type=int, 
+                        help="Optional.\n"
+                             "Number of async infer queues for head pose estimation")
     
     output_args = parser.add_argument_group('Output Options')
     output_args.add_argument("--save", default=None, type=str, 
                         help="Optional.\n"
                              "Save result to specified file")
+    output_args.add_argument("--save_queue", default=8, type=int, 
+                        help="Optional.\n"
+                             "Number of frames queued for the video writer thread\n"
+                             "(the main loop waits only when the queue is full)\n"
+                             "Specify 0 to write in the main thread")
+    output_args.add_argument("--save_overlay", default=None, type=str, 
+                        help="Optional.\n"
+                             "Save overlays (boxes, points, texts, etc.) of each frame\n"
+                             "to specified file in JSON Lines format without drawing")
+    output_args.add_argument("--results", default=None, type=str, 
+                        help="Optional.\n"
+                             "Save detection results of each frame to specified file\n"
+                             "(written by a background thread)")
+    output_args.add_argument("--results_format", default="binary", choices=ResultWriter.FORMATS, 
+                        help="Optional.\n"
+                             "Format of --results file\n"
+                             "  jsonl  : JSON Lines (1 frame per line)\n"
+                             "  binary : length-prefixed binary records\n"
+                             "Default value is binary")
     output_args.add_argument("--time", default=None, type=str, 
                         help="Optional.\n"
                              "Save time log to specified file")
+    output_args.add_argument("--profile", action='store_true', 
+                        help="Optional.\n"
+                             "Record per-stage spans and print p50/p90/p99 at exit")
+    output_args.add_argument("--profile_json", default=None, type=str, 
+                        help="Optional.\n"
+                             "Save profile summary and spans to specified JSON file\n"
+                             "(implies --profile)")
+    output_args.add_argument("--profile_trace", default=None, type=str, 
+                        help="Optional.\n"
+                             "Save spans to specified file in Chrome trace format\n"
+                             "(implies --profile)")
     output_args.add_argument("--log", default=None, type=str,  
                         help="Optional.\n"
                              "Save console log to specified file")
@@ -106,6 +180,24 @@ def main():
     # コマンドラインオプションの解析
     args = build_argparser().parse_args()
     
+    # queue数のチェック
+    for queue_option in ("queue_num", "queue_num_lm5", "queue_num_lm35", "queue_num_hp") :
+        if getattr(args, queue_option) < 1 :
+            log.warning(f"{queue_option} option must be greater than or equal to 1. use default value(2)")
+            setattr(args, queue_option, 2)
+    
+    # キャプチャバッファ数/保存キュー数のチェック
+    if args.capture_buffer < 0 :
+        log.warning("capture_buffer option must be greater than or equal to 0. use default value(4)")
+        args.capture_buffer = 4
+    if args.save_queue < 0 :
+        log.warning("save_queue option must be greater than or equal to 0. use default value(8)")
+        args.save_queue = 8
+    
+    # プロファイラの有効化
+    if args.profile or args.profile_json or args.profile_trace :
+        profiler.enable()
+    
     # 非表示設定
     no_disp = args.no_disp
     
@@ -123,7 +215,7 @@ def main():
         time_f = open(args.time, mode='w')
         print(f'command :          {" ".join(sys.argv)}', file=time_f)
         print(f'openVINO vertion : {ov_vession_str}', file=time_f)
-        print(f' frame_number, frame_time, preprocess_time, infer_time, postprocess_time', file=time_f)
+        print(f' frame_number, frame_time, preprocess_time, infer_time, postprocess_time, decode_time', file=time_f)
 
     log_f = None
     if args.log :
@@ -141,16 +233,17 @@ def main():
         core.add_extension(args.cpu_extension)
     
     # キャプチャデバイス
-    cap = cv2.VideoCapture(input_file)
+    # カメラ入力なら古いフレームを破棄して最新のフレームを処理する
+    cap = FrameCapture(input_file, args.capture_buffer, drop=(input_file == 0))
     
     # 幅と高さを取得
-    img_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-    img_width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    img_height = cap.img_height
+    img_width = cap.img_width
     # フレームレート(1フレームの時間単位はミリ秒)の取得
-    org_frame_rate = int(cap.get(cv2.CAP_PROP_FPS))                 # オリジナルのフレームレート
-    org_frame_time = 1.0 / cap.get(cv2.CAP_PROP_FPS)                # オリジナルのフレーム時間
+    org_frame_rate = int(cap.frame_rate)                            # オリジナルのフレームレート
+    org_frame_time = 1.0 / cap.frame_rate                           # オリジナルのフレーム時間
     # フレーム数
-    all_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    all_frames = cap.frame_count
     all_frames = 1 if all_frames != -1 and all_frames < 0 else all_frames   # -1なら静止画
     
     # 画像保存インスタンスの作成
@@ -161,7 +254,9 @@ def main():
         if all_frames == 1 :
             img_save.set_jpeg(args.save)
         else :
-            img_save.create_writer(args.save, org_frame_rate)
+            img_save.create_writer(args.save, org_frame_rate, args.save_queue)
+    if args.save_overlay :
+        img_save.set_overlay(args.save_overlay)
     
     # 1フレーム表示後の待ち時間
     wait_key_time = 1
@@ -172,129 +267,168 @@ def main():
         wait_key_time = 0           # 永久待ち
     
     # モデルの作成
-    model_fd = model_face_detect(core, args.model, device=args.device, threshold=args.threshold_detect, clip_ratio=args.clip_ratio, log_f=log_f)
+    model_fd = model_face_detect(core, args.model, device=args.device, threshold=args.threshold_detect, clip_ratio=args.clip_ratio, queue_num=args.queue_num, log_f=log_f, ppp=args.ppp)
     
     model_lm5  = None
     model_lm35 = None
     model_hp   = None
     
     if args.model_lm5 :
-        model_lm5 = model_face_landmark5(core, args.model_lm5, device=args.device_lm5, log_f=log_f)
+        model_lm5 = model_face_landmark5(core, args.model_lm5, device=args.device_lm5, batch_size=args.batch_lm5, queue_num=args.queue_num_lm5, log_f=log_f, ppp=args.ppp)
         
     if args.model_lm35 :
-        model_lm35 = model_face_landmark35(core, args.model_lm35, device=args.device_lm35, log_f=log_f)
+        model_lm35 = model_face_landmark35(core, args.model_lm35, device=args.device_lm35, batch_size=args.batch_lm35, queue_num=args.queue_num_lm35, log_f=log_f, ppp=args.ppp)
     
     if args.model_hp :
-        model_hp = model_face_headpose(core, args.model_hp, device=args.device_hp, log_f=log_f)
+        model_hp = model_face_headpose(core, args.model_hp, device=args.device_hp, batch_size=args.batch_hp, queue_num=args.queue_num_hp, log_f=log_f, ppp=args.ppp)
+    
+    # 推論スケジューラの作成
+    # 検出結果に対する二次推論は結果格納キー毎のモデルで非同期に実行される
+    scheduler = cascade_scheduler(model_fd, {"landmark5": model_lm5, "landmark35": model_lm35, "head_pose": model_hp})
+    
+    # 検出結果の出力
+    result_writer = None
+    if args.results :
+        result_writer = ResultWriter(args.results, args.results_format, 
+                                     {"pipeline": "face", "command": " ".join(sys.argv), "input": args.input, 
+                                      "width": img_width, "height": img_height})
     
     # 推論開始
     log.info("Starting inference...")
     print("To close the application, press 'CTRL+C' here or switch to the output window and press ESC key")
     
     # 現在のフレーム番号
-    frame_number = 1
+    infer_frame_number = 1      # 推論用フレーム番号
+    disp_frame_number  = 1      # 表示用フレーム番号
     
     # キャプチャフラグ
     capture_flag = True
     
+    # キャプチャスレッドの開始
+    cap.start()
+    
     # フレーム測定用タイマ
     prev_time = time.perf_counter()
     
     while True:
-        # 画像の前処理 =============================================================================
-        # 現在のフレーム番号表示
-        capture_time = time.perf_counter()
-        if frame_number == 1 :
-            first_capture_time = capture_time
-        capture_time = (capture_time - first_capture_time) * 1000
-        print(f'frame_number: {frame_number:5d} / {all_frames}', end='\r', flush=True)
-        if log_f :
-            console_print(log_f, f'frame_number: {frame_number:5d} / {all_frames}     @{capture_time:10.3f}')
+        if capture_flag and scheduler.is_ready() :
+            # 画像の前処理 =============================================================================
+            # 画像キャプチャ
+            with profiler.span("main/capture") :
+                frame = cap.read()          # キャプチャスレッドでキャプチャ済みのフレームを取り出す
+            if frame is None:
+                # キャプチャ失敗
+                capture_flag = False        # 次からキャプチャしない
+                # キューに残った結果を処理するまでループ継続
+                continue
+            image = frame.image
+            preprocess_start_time = time.perf_counter()                         # 前処理開始時刻        --------------------------------
             
-        # 画像キャプチャ
-        preprocess_start_time = time.perf_counter()                         # 前処理開始時刻        --------------------------------
-        ret, image = cap.read()    # フレームのキャプチャ
-        if not ret:
-            # キャプチャ失敗
-            break;
+            # 現在のフレーム番号表示
+            capture_time = frame.capture_time
+            if infer_frame_number == 1 :
+                first_capture_time = capture_time
+            capture_time = (capture_time - first_capture_time) * 1000
+            print(f'frame_number: {infer_frame_number:5d} / {all_frames}', end='\r', flush=True)
+            if log_f :
+                console_print(log_f, f'frame_number: {infer_frame_number:5d} / {all_frames}     @{capture_time:10.3f}')
+                
+            # 表示用フレームの作成
+            disp_frame = DispFrame(image, infer_frame_number, all_frames)
+            disp_frame.set_decode_time(frame.decode_time)
             
-        # 表示用フレームの作成
-        disp_frame = DispFrame(image, frame_number, all_frames)
-        
-        # 画像キャプチャと表示/入力用画像を作成
-        feed_dict = model_fd.pre_process(image)
-        disp_frame.start_preprocess(preprocess_start_time)
-        disp_frame.end_preprocess()                                 # 前処理終了時刻        --------------------------------
-        
-        disp_frame.start_infer()                                    # 推論処理開始時刻      --------------------------------
-        results = model_fd.infer_sync(feed_dict, (image, ))
-        
-        for result in results :
-            if model_lm5 :
-                feed_dict = model_lm5.pre_process(result["image"])
-                lm5_result = model_lm5.infer_sync(feed_dict, None)
-                result["landmark5"] = lm5_result
+            # 画像キャプチャと表示/入力用画像を作成
+            feed_dict = model_fd.pre_process(image)
+            disp_frame.start_preprocess(preprocess_start_time)
+            disp_frame.end_preprocess()                                 # 前処理終了時刻        --------------------------------
             
-            if model_lm35 :
-                feed_dict = model_lm35.pre_process(result["image"])
-                lm35_result = model_lm35.infer_sync(feed_dict, None)
-                result["landmark35"] = lm35_result
-        
-            if model_hp :
-                feed_dict = model_hp.pre_process(result["image"])
-                hp_result = model_hp.infer_sync(feed_dict, None)
-                result["head_pose"] = hp_result
-
-        disp_frame.end_infer()                                      # 推論処理開始時刻      --------------------------------
-
-        # 検出結果の解析 =============================================================================
-        disp_frame.start_postprocess()                              # 後処理開始時刻            --------------------------------
+            disp_frame.start_infer()                                    # 推論処理開始時刻      --------------------------------
+            scheduler.start_infer(feed_dict, disp_frame, image)
+            
+            # フレーム番号更新
+            infer_frame_number += 1
         
-        for result in results :
-            model_fd.post_process(disp_frame, result)
+        # 推論結果待ち =============================================================================
+        # 検出が終わったフレームの二次推論もここで投入される
+        # (結果が出たときだけ区間を記録する)
+        infer_rst = profiler.poll("main/get_result", scheduler.get_infer_result, disp_frame_number, frame=disp_frame_number)   # まだ結果が出てなければNoneが返る
+        if infer_rst :
+            disp_frame = infer_rst["disp_frame"]
+            results    = infer_rst["result"]
+            disp_frame.end_infer()                                      # 推論処理終了時刻      --------------------------------
             
-            if model_lm5 :
-                model_lm5.post_process(disp_frame, result["landmark5"], result["pt1_ex"], result["pt2_ex"])
+            # 検出結果の解析 =============================================================================
+            disp_frame.start_postprocess()                              # 後処理開始時刻            --------------------------------
             
-            if model_lm35 :
-                model_lm35.post_process(disp_frame, result["landmark35"], result["pt1_ex"], result["pt2_ex"])
+            for i, result in enumerate(results) :
+                with model_fd.profile("post_process", frame=disp_frame.frame_number, index=i) :
+                    model_fd.post_process(disp_frame, result)
+                
+                if model_lm5 :
+                    with model_lm5.profile("post_process", frame=disp_frame.frame_number, index=i) :
+                        model_lm5.post_process(disp_frame, result["landmark5"], result.pt1_ex, result.pt2_ex)
+                
+                if model_lm35 :
+                    with model_lm35.profile("post_process", frame=disp_frame.frame_number, index=i) :
+                        model_lm35.post_process(disp_frame, result["landmark35"], result.pt1_ex, result.pt2_ex)
+                
+                if model_hp :
+                    with model_hp.profile("post_process", frame=disp_frame.frame_number, index=i) :
+                        model_hp.post_process(disp_frame,  result["head_pose"], result.pt1_ex, result.pt2_ex)
             
-            if model_hp :
-                model_hp.post_process(disp_frame,  result["head_pose"], result["pt1_ex"], result["pt2_ex"])
-        
-        disp_frame.end_postprocess()                                # 後処理終了時刻            --------------------------------
-        
-        # フレーム処理時間を保存
-        cur_time = time.perf_counter()                              # 現在のフレーム処理完了時刻
-        frame_time = cur_time - prev_time                           # 1フレームの処理時間
-        disp_frame.set_frame_time(frame_time)
-        prev_time = cur_time
-        
-        # 結果の表示 =============================================================================
-        # 測定データの表示
-        disp_frame.disp_status()
-        
-        # 処理時間記録
-        disp_frame.write_time_data(time_f)
+            # 検出結果の出力(列の作成だけ行い、変換と書き込みは書き込みスレッドで行う)
+            if result_writer :
+                columns = model_fd.result_columns(results)
+                for key, model in (("landmark5", model_lm5), ("landmark35", model_lm35), ("head_pose", model_hp)) :
+                    if model :
+                        columns.update(model.result_columns(results, key))
+                result_writer.write(disp_frame.frame_number, columns)
+            
+            disp_frame.end_postprocess()                                # 後処理終了時刻            --------------------------------
+            
+            # フレーム処理時間を保存
+            cur_time = time.perf_counter()                              # 現在のフレーム処理完了時刻
+            frame_time = cur_time - prev_time                           # 1フレームの処理時間
+            disp_frame.set_frame_time(frame_time)
+            prev_time = cur_time
+            
+            # 結果の表示 =============================================================================
+            # 測定データの表示
+            disp_frame.disp_status()
+            
+            # 処理時間記録
+            disp_frame.write_time_data(time_f)
+            
+            # 画面表示
+            if not no_disp :
+                disp_frame.disp_image()        # 表示
+            
+            # 画像の保存
+            # 保存が設定されているか否か、MPEGかJPEGかはメソッド内でチェック
+            img_save.write_image(disp_frame)
+            
+            # 表示フレーム更新
+            disp_frame_number += 1
+            
+            # 最後のフレームチェック
+            if not capture_flag and (disp_frame_number >= infer_frame_number) :
+                # 最後のフレームを表示した
+                break;
         
-        # 画面表示
+        # キー入力取得(非表示のときはウィンドウがないのでキー入力も待たない)
         if not no_disp :
-            disp_frame.disp_image()        # 表示
-        
-        # 画像の保存
-        # 保存が設定されているか否か、MPEGかJPEGかはメソッド内でチェック
-        img_save.write_image(disp_frame)
-        
-        # キー入力取得
-        key = cv2.waitKey(wait_key_time)
-        if key == 27:
-            # ESCキー
-            break
-        
-        # フレーム番号更新
-        frame_number += 1
+            with profiler.span("main/wait_key") :
+                key = cv2.waitKey(wait_key_time)
+            if key == 27:
+                # ESCキー
+                break
         
+    # キュー内の残りのデータが処理されるのを待つ(これをやらないと中断時にプログラムが終了しない)
+    scheduler.wait_all()
+    
     # 後片付け
+    cap.release()
+    
     if time_f :
         time_f.close()
     
@@ -304,8 +438,22 @@ def main():
     # 保存が設定されていか否かはメソッド内でチェック
     img_save.release_writer()
     
+    # 検出結果の出力ファイルを閉じる(書き込みスレッドの終了を待つ)
+    if result_writer :
+        result_writer.close()
+    
+    # プロファイル結果の出力(書き込みスレッドの終了後)
+    if profiler.enabled :
+        for line in profiler.summary_lines() :
+            print(line)
+        if args.profile_json :
+            profiler.save_json(args.profile_json)
+        if args.profile_trace :
+            profiler.save_chrome_trace(args.profile_trace)
+    
     # 表示ウィンドウを破棄
-    cv2.destroyAllWindows()
+    if not no_disp :
+        cv2.destroyAllWindows()
 # ================================================================================
 
 if __name__ == '__main__':
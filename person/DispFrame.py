@@ -2,10 +2,16 @@
 import sys
 import os
 import time
+import threading
+import queue
+import json
 import logging as log
 import cv2
 import numpy as np
 import math
+from collections import OrderedDict
+
+from Profiler import profiler
 
 class COLORS() :
                     #   B    G    R 
@@ -115,6 +121,345 @@ class DispBitmap() :
         clip_img[ptn] = color                                       # Trueの位置をcolorで置換(塗りつぶし)
         image[y : y + len(ptn), x : x + len(ptn[0])] = clip_img     # 変更した描画領域を戻す
         
+# 文字列の描画キャッシュ ===========================================================
+# 文字列(と色、背景色)毎に1回だけ cv2.putText で描画したタイル(BGRとマスク)を作っておき、
+# 2回目以降はタイルをマスク付きでコピーするだけにする(描画結果は cv2.putText と同じ)。
+# 背景なしのタイルは黒の上に描画したもの(cv2.putText はアンチエイリアスするため)なので、
+# 黒い領域(ステータス表示領域)に書き込む場合だけ cv2.putText と同じ結果になる。
+# クラス名やIDのラベル、ステータス表示の文字のように同じ文字列が繰り返し描画されることを想定し、
+# 最大 max_size 個を超えたら最も長く使われていないものから捨てる(LRU)。
+class TextCache() :
+    FONT_FACE       = cv2.FONT_HERSHEY_COMPLEX      # フォントの種類
+    FONT_SCALE      = 0.5                           # 文字のスケール
+    FONT_THICKNESS  = 1                             # 文字の太さ
+    
+    def __init__(self, max_size=1024) :
+        self.max_size   = max_size
+        self.tiles      = OrderedDict()     # {(文字列, 色, 背景色) : TextTile}
+        self.hit_count  = 0
+        self.miss_count = 0
+    
+    # タイルの取り出し(なければ作成)
+    def get(self, text, color, background=None) :
+        key = (text, tuple(color), None if background is None else tuple(background))
+        tile = self.tiles.get(key)
+        if tile is None :
+            self.miss_count += 1
+            tile = self.make_tile(text, color, background)
+            self.tiles[key] = tile
+            if len(self.tiles) > self.max_size :
+                self.tiles.popitem(last=False)          # 最も長く使われていないものを捨てる
+        else :
+            self.hit_count += 1
+            self.tiles.move_to_end(key)
+        return tile
+    
+    # タイルの作成
+    # 文字列の左下を原点として、background を指定すると背景(文字列の矩形)を塗りつぶして黒で描画
+    @classmethod
+    def make_tile(cls, text, color, background) :
+        (w, h), baseline = cv2.getTextSize(text, cls.FONT_FACE, cls.FONT_SCALE, cls.FONT_THICKNESS)
+        margin = h                                  # 字形が文字列の矩形からはみ出す分の余白
+        ox, oy = margin, margin + h                 # 原点(文字列の左下)
+        image = np.zeros((h + baseline + 1 + margin * 2, w + 1 + margin * 2, 3), dtype=np.uint8)
+        mask  = np.zeros(image.shape[:2], dtype=np.uint8)
+        cv2.putText(mask, text, (ox, oy), cls.FONT_FACE, cls.FONT_SCALE, 255, cls.FONT_THICKNESS)
+        exact = True
+        if not background is None :
+            # 字形が背景の矩形からはみ出す場合(先頭の'j'など)ははみ出した画素が下地と合成されるので、
+            # タイルでは cv2.putText と同じ結果にならない
+            outside = mask.copy()
+            outside[oy - h : oy + baseline + 1, ox : ox + w + 1] = 0
+            exact = not outside.any()
+            cv2.rectangle(image, (ox, oy - h), (ox + w, oy + baseline), background, thickness=-1)
+            cv2.rectangle(mask,  (ox, oy - h), (ox + w, oy + baseline), 255,        thickness=-1)
+            color = (0, 0, 0)
+        cv2.putText(image, text, (ox, oy), cls.FONT_FACE, cls.FONT_SCALE, color, cls.FONT_THICKNESS)
+        
+        # 描画した範囲だけ切り出す
+        ys, xs = np.nonzero(mask)
+        if len(ys) == 0 :
+            return TextTile(image[:0, :0], mask[:0, :0], 0, 0, w, h, baseline, exact)      # 空白だけの文字列
+        x1, y1, x2, y2 = xs.min(), ys.min(), xs.max() + 1, ys.max() + 1
+        return TextTile(image[y1:y2, x1:x2].copy(), mask[y1:y2, x1:x2].copy(), ox - x1, oy - y1, w, h, baseline, exact)
+# ================================================================================
+
+# 文字列のタイル ==================================================================
+class TextTile() :
+    __slots__ = ("image", "mask", "ox", "oy", "width", "height", "baseline", "exact")
+    
+    def __init__(self, image, mask, ox, oy, width, height, baseline, exact=True) :
+        self.image    = image       # 描画した文字列(BGR)
+        self.mask     = mask        # 描画した画素(0以外)
+        self.ox       = ox          # タイル内の原点(文字列の左下)の位置
+        self.oy       = oy
+        self.width    = width       # cv2.getTextSize の文字列の幅と高さ、ベースライン
+        self.height   = height
+        self.baseline = baseline
+        self.exact    = exact       # cv2.putText と同じ結果になるか
+    
+    # タイルの範囲 (原点を(x, y)に置いたときの (x1, y1, x2, y2))
+    def rect(self, x, y) :
+        return (x - self.ox, y - self.oy, x - self.ox + self.image.shape[1], y - self.oy + self.image.shape[0])
+    
+    # 原点を(x, y)に置いて書き込む(画像の範囲外は切り捨て)
+    def blit(self, image, x, y) :
+        x1, y1, x2, y2 = self.rect(x, y)
+        cx1, cy1 = max(x1, 0), max(y1, 0)
+        cx2, cy2 = min(x2, image.shape[1]), min(y2, image.shape[0])
+        if cx1 >= cx2 or cy1 >= cy2 :
+            return
+        ty, tx = slice(cy1 - y1, cy2 - y1), slice(cx1 - x1, cx2 - x1)
+        cv2.copyTo(self.image[ty, tx], self.mask[ty, tx], image[cy1 : cy2, cx1 : cx2])     # 画像のビューに直接書き込む
+# ================================================================================
+
+# 全モジュールで共有する文字列の描画キャッシュ(描画はメインスレッドだけで行う)
+text_cache = TextCache()
+
+# ステータス表示領域 ==============================================================
+# 前回描画したステータス表示を保持しておき、変化した文字だけ描画し直す。
+# 文字単位のタイル(text_cache)を文字の送り幅で並べて描画するので、
+# 文字列全体を cv2.putText で描画した場合と字形の位置が1画素ずれることがある。
+class StatusPanel() :
+    def __init__(self, width, height) :
+        self.canvas  = np.zeros((height, width, 3), dtype=np.uint8)
+        self.lines   = []           # 描画済みの行 [(x, y, 文字列, 色)]
+        self.layouts = []           # 行毎の描画済みの文字 [[(文字, 原点x, 原点y, 色, TextTile)]]
+        self.glyphs  = {}           # 文字のタイル {(文字, 色) : TextTile} (text_cache から取り出したもの)
+    
+    # 1行分の文字の配置
+    def layout(self, x, y, text, color) :
+        glyphs = []
+        for char in text :
+            tile = self.glyphs.get((char, color))
+            if tile is None :
+                tile = text_cache.get(char, color)
+                self.glyphs[(char, color)] = tile
+            glyphs.append((char, x, y, color, tile))
+            x += tile.width - TextCache.FONT_THICKNESS          # 文字の送り幅
+        return glyphs
+    
+    # ステータス表示の更新
+    # lines : [(x, y, 文字列, 色)] (x, y は文字列の左下)
+    def update(self, lines) :
+        if lines == self.lines :
+            return self.canvas
+        
+        # 変化した行だけ配置し直す
+        layouts = []
+        for i, line in enumerate(lines) :
+            if i < len(self.lines) and line == self.lines[i] :
+                layouts.append(self.layouts[i])
+            else :
+                layouts.append(self.layout(*line))
+        
+        # 変化した文字の範囲を消去
+        dirty = []
+        for i in range(max(len(layouts), len(self.layouts))) :
+            old = self.layouts[i] if i < len(self.layouts) else []
+            new = layouts[i] if i < len(layouts) else []
+            if old is new :
+                continue
+            changed = set(glyph[:4] for glyph in old) ^ set(glyph[:4] for glyph in new)
+            rects = [tile.rect(x, y) for char, x, y, color, tile in old + new if (char, x, y, color) in changed]
+            if rects :
+                rects = np.array(rects)
+                rect = (*rects[:, :2].min(axis=0), *rects[:, 2:].max(axis=0))
+                self.canvas[max(rect[1], 0) : rect[3], max(rect[0], 0) : rect[2]] = 0
+                dirty.append(rect)
+        self.lines   = list(lines)
+        self.layouts = layouts
+        
+        # 消去した範囲にかかる文字を描画し直す(隣の文字や行にはみ出した字形も含む)
+        for x1, y1, x2, y2 in dirty :
+            for glyphs in layouts :
+                for char, x, y, color, tile in glyphs :
+                    gx1, gy1, gx2, gy2 = tile.rect(x, y)
+                    if gx1 < x2 and x1 < gx2 and gy1 < y2 and y1 < gy2 :
+                        tile.blit(self.canvas, x, y)
+        return self.canvas
+# ================================================================================
+
+# 描画リスト ======================================================================
+# 検出枠/線/特徴点/文字列/マークの描画を種類毎に記録しておき、まとめて描画する。
+#   ・検出枠と線は色毎に1回の cv2.polylines で描画
+#   ・特徴点は円のパターンを作っておき、全点分をNumPyのインデックス指定で一度に書き込む
+#   ・XYZ軸は全軸の回転/投影をNumPyでまとめて計算して線として描画
+#   ・背景付きの文字列(ラベル)は文字列の描画キャッシュ(text_cache)のタイルを書き込む
+# 描画順は種類毎(検出枠 → 特徴点 → 線 → 文字列 → マーク)なので、文字列が他の検出の枠に隠れない。
+# to_dict で描画せずにJSONにできる形式で取り出せる。
+class RenderList() :
+    # 特徴点の円(半径2, 太さ2)のパターンを中心からのオフセットで保持
+    POINT_RADIUS    = 2
+    POINT_THICKNESS = 2
+    _pattern = np.zeros((2 * (POINT_RADIUS + POINT_THICKNESS) + 1, ) * 2, dtype=np.uint8)
+    cv2.circle(_pattern, (POINT_RADIUS + POINT_THICKNESS, ) * 2, POINT_RADIUS, 1, POINT_THICKNESS)
+    POINT_OFFSET_Y, POINT_OFFSET_X = np.nonzero(_pattern)
+    POINT_OFFSET_Y = POINT_OFFSET_Y - (POINT_RADIUS + POINT_THICKNESS)
+    POINT_OFFSET_X = POINT_OFFSET_X - (POINT_RADIUS + POINT_THICKNESS)
+    del _pattern
+    
+    # XYZ軸のパラメータ
+    AXIS_CAMERA_DISTANCE = 950                      # カメラ位置
+    AXIS_LENGTH          = 50                       # 軸の長さ
+    AXIS_TIP_LENGTH      = 0.3                      # Z軸の矢印の長さ(軸の長さに対する比率)
+    
+    def __init__(self) :
+        self.boxes  = []        # 検出枠   [(x1, y1, x2, y2, B, G, R, 太さ)]
+        self.lines  = []        # 線       [(x1, y1, x2, y2, B, G, R, 太さ, 矢印の長さ(0なら矢印なし))]
+        self.axes   = []        # XYZ軸    [(yaw, pitch, roll, 中心x, 中心y)]
+        self.points = []        # 特徴点   [(x, y, B, G, R)]
+        self.texts  = []        # 文字列   [(x, y, 文字列, 色, 背景色(Noneなら背景なし))]
+        self.marks  = []        # マーク   [(x, y, マーク名)]
+    
+    def __len__(self) :
+        return len(self.boxes) + len(self.lines) + len(self.axes) + len(self.points) + len(self.texts) + len(self.marks)
+    
+    # ==== 記録 ====================================================================
+    def add_box(self, x1, y1, x2, y2, color, thickness=2) :
+        self.boxes.append((int(x1), int(y1), int(x2), int(y2), *color, thickness))
+    
+    def add_line(self, pt1, pt2, color, thickness=2, tip_length=0) :
+        self.lines.append((int(pt1[0]), int(pt1[1]), int(pt2[0]), int(pt2[1]), *color, thickness, tip_length))
+    
+    def add_axis(self, yaw, pitch, roll, center_pt) :
+        self.axes.append((float(yaw), float(pitch), float(roll), float(center_pt[0]), float(center_pt[1])))
+    
+    def add_point(self, pt, color) :
+        self.points.append((int(pt[0]), int(pt[1]), *color))
+    
+    # 文字列 (background を指定すると背景を塗りつぶして黒で描画。(x, y)は文字列の左下)
+    def add_text(self, x, y, text, color, background=None) :
+        self.texts.append((int(x), int(y), text, color, background))
+    
+    def add_mark(self, x, y, mark) :
+        self.marks.append((int(x), int(y), mark))
+    
+    # ==== 描画 ====================================================================
+    def render(self, image) :
+        if self.boxes :
+            boxes = np.array(self.boxes, dtype=np.int32)
+            corners = boxes[:, [0, 1, 2, 1, 2, 3, 0, 3]].reshape(-1, 4, 2)         # 4隅の座標
+            self.render_polylines(image, corners, boxes[:, 4:8], True)
+        if self.points :
+            self.render_points(image, np.array(self.points, dtype=np.int32))
+        lines = self.axis_lines()
+        if self.lines :
+            lines.append(self.arrow_lines(np.array(self.lines, dtype=np.float64)))
+        if lines :
+            lines = np.concatenate(lines)
+            self.render_polylines(image, lines[:, 0:4].astype(np.int32).reshape(-1, 2, 2), lines[:, 4:8].astype(np.int32), False)
+        for x, y, text, color, background in self.texts :
+            self.render_text(image, x, y, text, color, background)
+        for x, y, mark in self.marks :
+            DispBitmap.disp_mark_bmp(image, x, y, mark)
+    
+    # 色と太さが同じものをまとめて cv2.polylines で描画
+    # polygons : (N,頂点数,2)の座標, styles : (N,4)の(B, G, R, 太さ)
+    @staticmethod
+    def render_polylines(image, polygons, styles, is_closed) :
+        styles, inverse = np.unique(styles, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        for i, (b, g, r, thickness) in enumerate(styles.tolist()) :
+            cv2.polylines(image, list(polygons[inverse == i]), is_closed, (b, g, r), thickness)
+    
+    # 特徴点の円のパターンを全点分まとめて書き込む (cv2.circle と同じ画素になる)
+    # points : (N,5)の(x, y, B, G, R)
+    @classmethod
+    def render_points(cls, image, points) :
+        ys = (points[:, 1, None] + cls.POINT_OFFSET_Y).reshape(-1)
+        xs = (points[:, 0, None] + cls.POINT_OFFSET_X).reshape(-1)
+        colors = np.repeat(points[:, 2:5], len(cls.POINT_OFFSET_Y), axis=0)
+        inside = (ys >= 0) & (ys < image.shape[0]) & (xs >= 0) & (xs < image.shape[1])
+        image[ys[inside], xs[inside]] = colors[inside]
+    
+    # 文字列の描画
+    # 背景付き(ラベル)はキャッシュしたタイルを書き込む。
+    # 背景なし(特徴点の番号など)は下地とアンチエイリアスで合成されるので cv2.putText で描画する(短い文字列なので速い)
+    @staticmethod
+    def render_text(image, x, y, text, color, background) :
+        if background is None :
+            cv2.putText(image, text, (x, y), TextCache.FONT_FACE, TextCache.FONT_SCALE, color, TextCache.FONT_THICKNESS)
+            return
+        tile = text_cache.get(text, color, background)
+        y = y if y >= tile.height else tile.height      # 画面からはみ出ないように調整
+        if tile.exact :
+            tile.blit(image, x, y)
+            return
+        
+        # 字形が背景からはみ出す文字列は従来通り描画する
+        cv2.rectangle(image, (x, y - tile.height), (x + tile.width, y + tile.baseline), background, thickness=-1)
+        cv2.putText(image, text, (x, y), TextCache.FONT_FACE, TextCache.FONT_SCALE, (0, 0, 0), TextCache.FONT_THICKNESS)
+    
+    # 矢印付きの線を線分に展開 (cv2.arrowedLine と同じ座標になる)
+    # lines : (N,9)の(x1, y1, x2, y2, B, G, R, 太さ, 矢印の長さ)
+    # 戻り値 : (M,8)の(x1, y1, x2, y2, B, G, R, 太さ)
+    @staticmethod
+    def arrow_lines(lines) :
+        result = [lines[:, 0:8]]
+        arrows = lines[lines[:, 8] > 0]
+        if len(arrows) > 0 :
+            pt1 = arrows[:, 0:2]
+            pt2 = arrows[:, 2:4]
+            delta = pt1 - pt2
+            tip_size = np.hypot(delta[:, 0], delta[:, 1]) * arrows[:, 8]
+            angle = np.arctan2(delta[:, 1], delta[:, 0])
+            for sign in (1, -1) :
+                tip = np.stack((np.rint(pt2[:, 0] + tip_size * np.cos(angle + sign * np.pi / 4)),
+                                np.rint(pt2[:, 1] + tip_size * np.sin(angle + sign * np.pi / 4))), axis=1)
+                result.append(np.hstack((tip, pt2, arrows[:, 4:8])))
+        return np.concatenate(result)
+    
+    # XYZ軸を全軸まとめて回転/投影して線分にする
+    # 戻り値 : [(M,8)の(x1, y1, x2, y2, B, G, R, 太さ)] (軸がなければ空のリスト)
+    def axis_lines(self) :
+        if not self.axes :
+            return []
+        axes = np.array(self.axes, dtype=np.float64)
+        yaw, pitch, roll = np.radians(axes[:, 0:3]).T          # 度→ラジアン変換
+        center_pt = axes[:, 3:5]
+        zeros = np.zeros(len(axes))
+        ones  = np.ones(len(axes))
+        
+        # 各軸に対する回転マトリックス
+        yaw_matrix   = np.stack([np.cos(yaw),   zeros,          -np.sin(yaw),
+                                 zeros,         ones,           zeros,
+                                 np.sin(yaw),   zeros,          np.cos(yaw)],   axis=1).reshape(-1, 3, 3)   # Y軸回転
+        pitch_matrix = np.stack([ones,          zeros,          zeros,
+                                 zeros,         np.cos(pitch),  -np.sin(pitch),
+                                 zeros,         np.sin(pitch),  np.cos(pitch)], axis=1).reshape(-1, 3, 3)   # X軸回転
+        roll_matrix  = np.stack([np.cos(roll),  -np.sin(roll),  zeros,
+                                 np.sin(roll),  np.cos(roll),   zeros,
+                                 zeros,         zeros,          ones],          axis=1).reshape(-1, 3, 3)   # Z軸回転
+        
+        # 合成回転マトリックスで各座標軸を回転 (X軸:左耳方向がプラス, Y軸:頭上方向がマイナス, Z軸:顔前方向がマイナス)
+        rotation_matrix = yaw_matrix @ pitch_matrix @ roll_matrix
+        axis_vectors = np.diag([self.AXIS_LENGTH, -self.AXIS_LENGTH, -self.AXIS_LENGTH]).astype(np.float32)
+        rotated = rotation_matrix @ axis_vectors                            # (N,3,3) 列がX/Y/Z軸
+        rotated[:, 2, :] += self.AXIS_CAMERA_DISTANCE
+        
+        # 画面上に投影した座標軸の座標(整数化)
+        end_pts = (rotated[:, 0:2, :] / rotated[:, 2:3, :]).transpose(0, 2, 1) * self.AXIS_CAMERA_DISTANCE + center_pt[:, None, :]
+        end_pts = end_pts.astype(int)
+        center_pt = center_pt.astype(int)
+        
+        lines = []
+        for i, (color, tip_length) in enumerate(((COLORS.red, 0), (COLORS.green, 0), (COLORS.blue, self.AXIS_TIP_LENGTH))) :
+            style = np.tile((*color, 2, tip_length), (len(axes), 1))
+            lines.append(np.hstack((center_pt, end_pts[:, i], style)))
+        return [self.arrow_lines(np.concatenate(lines).astype(np.float64))]
+    
+    # ==== 取り出し ================================================================
+    # 描画せずにJSONにできる形式(リストの辞書)で取り出す
+    def to_dict(self) :
+        return {"boxes"  : self.boxes,
+                "lines"  : self.lines,
+                "axes"   : self.axes,
+                "points" : self.points,
+                "texts"  : [(x, y, text, list(color), None if background is None else list(background)) for x, y, text, color, background in self.texts],
+                "marks"  : self.marks}
+# ================================================================================
+
 # 表示フレームクラス ==================================================================
 class DispFrame() :
     # カラーパレット(8bitマシン風。ちょっと薄目)
@@ -133,15 +478,31 @@ class DispFrame() :
     
     # ステータス領域サイズ
     STATUS_LINE_HIGHT   = 15                            # ステータス行の1行あたりの高さ
-    STATUS_LINES        =  6                            # ステータス行数
+    STATUS_BASE_LINES   =  5                            # 標準のステータス行数(追加のステータス文字列はその後の行)
+    STATUS_LINES        =  6                            # ステータス行数(最小)
     STATUS_PADDING      =  8                            # ステータス領域の余白
-    STATUS_AREA_HIGHT   = STATUS_LINE_HIGHT * STATUS_LINES + STATUS_PADDING # ステータス領域の高さ
+    STATUS_AREA_HIGHT   = STATUS_LINE_HIGHT * STATUS_LINES + STATUS_PADDING # ステータス領域の高さ(最小)
+    
+    # ステータス領域の高さ(追加のステータス文字列が収まるように行数を増やす)
+    @classmethod
+    def status_area_height(cls, extra_lines=0) :
+        return cls.STATUS_LINE_HIGHT * max(cls.STATUS_LINES, cls.STATUS_BASE_LINES + extra_lines) + cls.STATUS_PADDING
+    
+    # ステータス表示領域(前回の描画を保持して変化した文字だけ描画し直す。画像幅が変わったら作り直す)
+    status_panel = None
     
     def __init__(self, image, frame_number, all_frames) :
         # 画像にステータス表示領域を追加
         # self.image = cv2.copyMakeBorder(image, 0, self.STATUS_AREA_HIGHT, 0, 0, cv2.BORDER_CONSTANT, (0,0,0))
-        self.image = image.copy()       # コピーして保持
+        # 元画像は参照だけ保持し(コピーしない)、検出枠などの描画は描画リストに記録しておく。
+        # 表示/保存するときに初めて表示/保存用のバッファ(画像の下にステータス表示領域を付けたもの)を確保し、
+        # 元画像をその上部にコピーして描画リストとステータスを描画する(表示も保存もしなければコピーも描画もしない)
+        self.source = image             # 元画像(変更しない)
+        self.render_list = RenderList() # 描画リスト
+        self.status_enabled = False     # ステータス表示領域を付けるか(disp_statusで設定)
+        self.buffer = None
         self.status_frame = None
+        self.status_lines = []          # ステータス表示の行 [(x, y, 文字列, 色)]
         self.image_v = None
         
         # イメージサイズ
@@ -158,19 +519,61 @@ class DispFrame() :
         self.postprocess_start    = 0
         
         self.frame_time          = 0
+        self.decode_time         = 0
         self.preprocess_time     = 0
         self.infer_time          = 0
         self.postprocess_time    = 0
+        self.draw_time           = 0    # 描画リストの描画時間
+        
+        # 追加のステータス文字列(標準のステータスの後に表示)
+        self.status_messages = []
         
+        # 処理時間記録の追加の列(標準の列の後に出力)
+        self.time_data = []
+        
+    # 描画済みの画像(ステータス表示領域を除く)
+    @property
+    def image(self) :
+        return self.render()[:self.img_height]
+    
+    # 記録した描画の実行 =================================================
+    # 最初に呼ばれたときにバッファを確保して元画像をコピーし、描画リストとステータス文字列を描画する
+    # (ステータス表示領域は追加のステータス文字列の行数に合わせた高さにする)
+    # 戻り値はバッファ全体
+    def render(self) :
+        if self.buffer is None :
+            with profiler.span("frame/render", frame=self.frame_number) :
+                status_height = self.status_area_height(len(self.status_messages))
+                self.buffer = np.empty((self.img_height + status_height, *self.source.shape[1:]), dtype=self.source.dtype)
+                image = self.buffer[:self.img_height]
+                image[:] = self.source          # ここで初めてコピー
+                
+                # 描画リストの描画(描画時間はステータス表示に出す)
+                start_time = time.perf_counter()
+                self.render_list.render(image)
+                end_time = time.perf_counter()
+                self.draw_time = (end_time - start_time) * 1000                 # msec単位に変換
+                profiler.record("frame/draw", start_time, end_time, frame=self.frame_number, count=len(self.render_list))
+                
+                if self.status_enabled :
+                    self.render_status()
+        return self.buffer
+    
+    # 描画済みのバッファを破棄(描画後に描画が追加されたら次の render で描画し直す)
+    def invalidate(self) :
+        self.buffer  = None
+        self.image_v = None
+    
     # 画像フレーム表示
     def make_disp_image(self, force_update=False) :
         if force_update or self.image_v is None :
-            if self.status_frame is None :
+            buffer = self.render()
+            if not self.status_enabled :
                 # statusフレームがなければイメージだけ
-                self.image_v = self.image
+                self.image_v = buffer[:self.img_height]
             else :
-                # statusフレームがあったら連結
-                self.image_v = cv2.vconcat([self.image, self.status_frame])
+                # statusフレームがあったらバッファ全体(イメージとstatusフレームは連結済み)
+                self.image_v = buffer
         return self.image_v
 
     def disp_image(self) :
@@ -180,11 +583,12 @@ class DispFrame() :
         image_v = self.make_disp_image()
         
         # 表示
-        cv2.namedWindow(window_name, cv2.WINDOW_NORMAL)
-        cv2.imshow(window_name, image_v)                  # 表示
-        
-        # 画像サイズに合わせてウィンドウサイズ変更
-        cv2.resizeWindow(window_name, image_v.shape[1], image_v.shape[0])
+        with profiler.span("frame/display", frame=self.frame_number) :
+            cv2.namedWindow(window_name, cv2.WINDOW_NORMAL)
+            cv2.imshow(window_name, image_v)                  # 表示
+            
+            # 画像サイズに合わせてウィンドウサイズ変更
+            cv2.resizeWindow(window_name, image_v.shape[1], image_v.shape[0])
     
     # 検出枠の描画
     def draw_box(self, pt1, pt2, color=None, text=None, mark=None) :
@@ -196,33 +600,18 @@ class DispFrame() :
         if color is None :
             color=COLORS.cyan
         
-        # 対象物の枠の描画
-        cv2.rectangle(self.image,    (left, top     ), (right,      bottom), color,  2)
+        # 対象物の枠
+        self.render_list.add_box(left, top, right, bottom, color, 2)
         if text :
-            # ラベルの描画
-            # 文字列表示パラメータ
-            fontface = cv2.FONT_HERSHEY_COMPLEX # フォントの種類
-            fontscale = 0.5                     # 文字のスケール
-            thickness = 1                       # 文字の太さ
-
-            # 文字列を描画した際の矩形の大きさを取得する。
-            (w, h), baseline = cv2.getTextSize(text, fontface, fontscale, thickness)
-            
-            # 描画位置
-            x = left
-            y = top if top >= h else h          # 画面からはみ出ないように調整
-            
-            # 文字を囲む矩形を描画する。
-            cv2.rectangle(self.image, (x, y - h), (x + w, y + baseline), color, thickness=-1)
-            
-            # 文字列を描画する
-            cv2.putText(self.image, text, (x, y), fontface, fontscale, (0, 0, 0), thickness)
+            # ラベル(枠の色で塗りつぶした背景に黒で描画)
+            self.render_list.add_text(left, top, text, (0, 0, 0), background=color)
         
         if mark :
-            # マークの描画
-            DispBitmap.disp_mark_bmp(self.image, right - 20, top, mark)         # 右上の少し左に表示
+            # マーク
+            self.render_list.add_mark(right - 20, top, mark)         # 右上の少し左に表示
         
-        return
+        if not self.buffer is None :
+            self.invalidate()
     
     # 特徴点の描画
     def draw_point(self, pt1,  color=None, text=None) :
@@ -230,77 +619,19 @@ class DispFrame() :
         if color is None :
             color=COLORS.yellow
         
-        cv2.circle(self.image, pt1, 2, color, 2)
+        self.render_list.add_point(pt1, color)
         if text :
-            cv2.putText(self.image, text, pt1, cv2.FONT_HERSHEY_COMPLEX, 0.5, color)
+            self.render_list.add_text(pt1[0], pt1[1], text, color)
         
-        return
+        if not self.buffer is None :
+            self.invalidate()
     
-    # XYZ軸の描画
+    # XYZ軸の描画 (回転/投影の計算も描画時に全軸まとめて行う)
     def draw_xyz_axis(self, yaw, pitch, roll, center_pt) :
-        # カメラ位置
-        camera_distance  = 950
-        
-        # 度→ラジアン変換
-        yaw   = math.radians(yaw)
-        pitch = math.radians(pitch)
-        roll  = math.radians(roll)
-        
-        # 各軸に対する回転マトリックス
-        yawMatrix   = np.matrix([   [ math.cos(yaw ),                0, -math.sin(yaw  )], 
-                                    [              0,                1,                0], 
-                                    [ math.sin(yaw ),                0,  math.cos(yaw  )]   ])      # Y軸回転
-        
-        pitchMatrix = np.matrix([   [              1,                0,                0],
-                                    [              0,  math.cos(pitch), -math.sin(pitch)], 
-                                    [              0,  math.sin(pitch),  math.cos(pitch)]   ])      # X軸回転
-        
-        rollMatrix  = np.matrix([   [ math.cos(roll), -math.sin(roll ),                0],
-                                    [ math.sin(roll),  math.cos(roll ),                0], 
-                                    [              0,                0,                1]   ])      # Z軸回転
-        
-        # 合成回転マトリックス
-        rotationMatrix = yawMatrix * pitchMatrix * rollMatrix
+        self.render_list.add_axis(yaw, pitch, roll, center_pt)
         
-        
-        # 描画する座標軸
-        xAxis  = np.matrix([ [               50, ],
-                             [                0, ],
-                             [                0, ]  ], dtype=np.float32)         # X軸        左耳方向がプラス
-        
-        yAxis  = np.matrix([ [                0, ],
-                             [              -50, ],
-                             [                0, ]  ], dtype=np.float32)         # Y軸        頭上方向がマイナス
-        
-        zAxis  = np.matrix([ [                0, ],
-                             [                0, ],
-                             [              -50, ]  ], dtype=np.float32)         # Z軸        顔前方向がマイナス
-        
-        offset = np.matrix([ [                0, ],
-                             [                0, ],
-                             [  camera_distance, ]  ], dtype=np.float32)
-        
-        
-        # 各座標軸を回転し、1次元配列化(計算結果はMatrixなので)
-        xAxis  = np.asarray(rotationMatrix * xAxis  + offset).flatten()
-        yAxis  = np.asarray(rotationMatrix * yAxis  + offset).flatten()
-        zAxis  = np.asarray(rotationMatrix * zAxis  + offset).flatten()
-        
-        # 画面上に投影した座標軸の座標
-        x_pt = np.array([xAxis[0] / xAxis[2], xAxis[1] / xAxis[2]]) * camera_distance + center_pt
-        y_pt = np.array([yAxis[0] / yAxis[2], yAxis[1] / yAxis[2]]) * camera_distance + center_pt
-        z_pt = np.array([zAxis[0] / zAxis[2], zAxis[1] / zAxis[2]]) * camera_distance + center_pt
-        
-        # 整数化
-        center_pt = center_pt.astype(int)
-        x_pt      = x_pt.astype(int)
-        y_pt      = y_pt.astype(int)
-        z_pt      = z_pt.astype(int)
-        
-        # 座標軸の描画
-        cv2.line(       self.image, center_pt, x_pt, COLORS.red,   2)
-        cv2.line(       self.image, center_pt, y_pt, COLORS.green, 2)
-        cv2.arrowedLine(self.image, center_pt, z_pt, COLORS.blue,  2, tipLength=0.3)
+        if not self.buffer is None :
+            self.invalidate()
     
     
     # ==== ステータス表示関連 ====================================================
@@ -308,14 +639,25 @@ class DispFrame() :
     def STATUS_LINE_Y(self, line) : 
         return self.STATUS_LINE_HIGHT * (line + 1)
     
-    # ステータス文字列出力
+    # ステータス文字列出力(行の登録だけ行い、描画は render_status でまとめて行う)
     def status_puts(self, line, message, color=(255, 128, 128)) :
-        cv2.putText(self.status_frame, message, (10, self.STATUS_LINE_Y(line)), cv2.FONT_HERSHEY_COMPLEX, 0.5, color, 1)
+        self.status_lines.append((10, self.STATUS_LINE_Y(line), message, tuple(color)))
     
     # ステータス表示
+    # ステータス表示領域を付けることだけ記録する(文字列の作成と描画は render で行う)
     def disp_status(self) :
-        # ステータス領域用のイメージ作成
-        self.status_frame = np.zeros((self.STATUS_AREA_HIGHT, self.img_width, 3), np.uint8)
+        self.status_enabled = True
+        if not self.buffer is None :
+            self.invalidate()
+    
+    # ステータス文字列の作成と描画(バッファの下部)
+    # 描画リストの描画時間を含めるため、描画リストの描画後に呼ぶ
+    def render_status(self) :
+        start_time = time.perf_counter()
+        
+        # ステータス領域用のイメージ(バッファの下部)
+        self.status_frame = self.buffer[self.img_height:]
+        self.status_lines = []
         
         # ステータス文字列生成
         frame_number_message    = f'frame_number     : {self.frame_number:5d} / {self.all_frames}'
@@ -323,9 +665,9 @@ class DispFrame() :
             frame_time_message  =  'Frame time       : ---'
         else :
             frame_time_message      = f'Frame time       : {      self.frame_time:.3f} ms'
-        preprocess_time_message     = f'preprocess time  : { self.preprocess_time:.3f} ms'
+        preprocess_time_message     = f'preprocess time  : { self.preprocess_time:.3f} ms (decode {self.decode_time:.3f} ms)'
         infer_time_message          = f'Inference time   : {      self.infer_time:.3f} ms'
-        postprocess_time_message    = f'postprocess time : {self.postprocess_time:.3f} ms'
+        postprocess_time_message    = f'postprocess time : {self.postprocess_time:.3f} ms (draw {self.draw_time:.3f} ms)'
         
         # 文字列の書き込み
         self.status_puts(0, frame_number_message)
@@ -333,11 +675,34 @@ class DispFrame() :
         self.status_puts(2, preprocess_time_message)
         self.status_puts(3, infer_time_message)
         self.status_puts(4, postprocess_time_message)
+        for i, message in enumerate(self.status_messages) :
+            self.status_puts(self.STATUS_BASE_LINES + i, message)
+        
+        # 前回から変化した文字だけ描画し直したステータス表示領域をコピー
+        panel = DispFrame.status_panel
+        if panel is None or panel.canvas.shape != self.status_frame.shape :
+            panel = StatusPanel(self.status_frame.shape[1], self.status_frame.shape[0])
+            DispFrame.status_panel = panel
+        self.status_frame[:] = panel.update(self.status_lines)
+        
+        profiler.record("frame/status", start_time, time.perf_counter(), frame=self.frame_number)
+    
+    # 追加のステータス文字列の登録(disp_statusの前に呼ぶ)
+    def add_status(self, message) :
+        self.status_messages.append(message)
+    
+    # 処理時間記録の追加の列の登録(write_time_dataの前に呼ぶ)
+    def add_time_data(self, *values) :
+        self.time_data.extend(values)
 
     # ==== 処理時間関連処理 ====================================================
     def set_frame_time(self, frame_time) :
         self.frame_time = frame_time * 1000     # msec単位に変換
     
+    # キャプチャ(デコード)時間の設定(キャプチャスレッドで測定済み, msec単位)
+    def set_decode_time(self, decode_time) :
+        self.decode_time = decode_time
+    
     def start_preprocess(self, cur_time=None) :
         if cur_time is None :
             cur_time = time.perf_counter()
@@ -346,6 +711,7 @@ class DispFrame() :
         if cur_time is None :
             cur_time = time.perf_counter()
         self.preprocess_time     = (cur_time - self.preprocess_start) * 1000     # msec単位に変換
+        profiler.record("frame/preprocess", self.preprocess_start, cur_time, frame=self.frame_number)
     
     def start_infer(self, cur_time=None) :
         if cur_time is None :
@@ -355,6 +721,7 @@ class DispFrame() :
         if cur_time is None :
             cur_time = time.perf_counter()
         self.infer_time         = (cur_time - self.infer_start) * 1000           # msec単位に変換
+        profiler.record("frame/infer", self.infer_start, cur_time, frame=self.frame_number)
     
     def start_postprocess(self, cur_time=None) :
         if cur_time is None :
@@ -364,11 +731,13 @@ class DispFrame() :
         if cur_time is None :
             cur_time = time.perf_counter()
         self.postprocess_time    = (cur_time - self.postprocess_start) * 1000    # msec単位に変換
+        profiler.record("frame/postprocess", self.postprocess_start, cur_time, frame=self.frame_number)
     
     # 処理時間記録
     def write_time_data(self, time_f) :
         if time_f :
-            time_f.write(f'{self.frame_number:5d}, {self.frame_time:.3f}, {self.preprocess_time:.3f}, {self.infer_time:.3f}, {self.postprocess_time:.3f}\n')
+            time_data = ''.join(f', {value}' for value in self.time_data)
+            time_f.write(f'{self.frame_number:5d}, {self.frame_time:.3f}, {self.preprocess_time:.3f}, {self.infer_time:.3f}, {self.postprocess_time:.3f}, {self.decode_time:.3f}{time_data}\n')
 
 # ================================================================================
 
@@ -377,38 +746,131 @@ class ImageSave() :
     # 初期化
     def __init__(self, img_height, img_width) :
         # イメージ領域サイズ
+        # (ステータス領域の高さは追加のステータス文字列の行数で変わるので、最初のフレームで決める)
         self.disp_width  = img_width
-        self.disp_height = img_height + DispFrame.STATUS_AREA_HIGHT # ステータス領域分を加算しておく
+        self.disp_height = None
         
         # JPEGファイル名
         self.jpeg_file = None
-        # 保存用ライタ
-        self.writer    = None
+        # 保存用ライタ(最初のフレームの書き込み時に生成する)
+        self.writer      = None
+        self.writer_args = None         # (ファイル名, フレームレート)
+        # 描画リストの保存ファイル
+        self.overlay_f = None
+        
+        # 書き込みスレッドと書き込み待ちのキュー
+        self.write_queue  = None
+        self.write_thread = None
+        self.error        = None        # 書き込みスレッドで起きた例外
+        
+        # 書き込み待ちの統計情報
+        self.write_count  = 0           # 書き込んだフレーム数
+        self.full_count   = 0           # キューが一杯で待ったフレーム数
+        self.wait_time    = 0           # キューが一杯で待った時間の合計(msec)
+        self.max_depth    = 0           # キューに溜まったフレーム数の最大値
     
     # JPEGファイル名の設定
     def set_jpeg(self, filename) :
         self.jpeg_file = filename
     
+    # 描画リストの保存ファイルの設定
+    # フレーム毎の描画リストを描画せずにJSON Lines形式(1フレーム1行)で保存する
+    def set_overlay(self, filename) :
+        self.overlay_f = open(filename, mode='w')
+    
     # 動画ファイルのライタ生成
-    def create_writer(self, filename, frame_rate) :
-        # フォーマット
-        # fmt = cv2.VideoWriter_fourcc('m', 'p', '4', 'v')
-        fmt = cv2.VideoWriter_fourcc(*'mp4v')
-        self.writer = cv2.VideoWriter(filename, fmt, frame_rate, (self.disp_width, self.disp_height))
+    # ライタは最初のフレームの書き込み時に、そのフレームの表示イメージ(ステータス領域を含む)の大きさで生成する
+    # queue_size が1以上なら、書き込み(エンコード)は書き込みスレッドで行い、
+    # フレームは最大 queue_size 個までキューに溜めておく(一杯なら空くまで待つ)
+    # 書き込みスレッドで起きた例外は保持しておき、次の write_image / release_writer で送出する
+    # (エラー後の書き込みスレッドはキューを読み捨てるだけにして、メインスレッドを待たせない)
+    def create_writer(self, filename, frame_rate, queue_size=0) :
+        self.writer_args = (filename, frame_rate)
+        
+        if queue_size > 0 :
+            self.write_queue  = queue.Queue(maxsize=queue_size)
+            self.write_thread = threading.Thread(target=self.write_loop, daemon=True)
+            self.write_thread.start()
+    
+    # 書き込みスレッド(Noneを受け取ったら終了)
+    def write_loop(self) :
+        while True :
+            image_v = self.write_queue.get()
+            if image_v is None :
+                break
+            if not self.error is None :
+                continue                # エラー後は読み捨てる
+            try :
+                with profiler.span("save/encode") :
+                    self.writer.write(image_v)
+            except Exception as e :
+                self.error = e
+    
+    # 書き込みスレッドで例外が起きていたら送出する
+    def check_error(self) :
+        if not self.error is None :
+            raise RuntimeError(f'failed to write video : {self.writer_args[0]}') from self.error
     
     # 動画ファイル書き込み
+    # (保存が設定されていなければフレームの描画(render)も行わない)
     def write_image(self, frame) :
-        if self.jpeg_file :
-            cv2.imwrite(self.jpeg_file, frame.image)
-        if self.writer:
-            # 表示イメージの作成
-            image_v = frame.make_disp_image()
-            self.writer.write(image_v)
+        self.check_error()
+        with profiler.span("save/write", frame=frame.frame_number) :
+            if self.overlay_f :
+                self.overlay_f.write(json.dumps({"frame": frame.frame_number, **frame.render_list.to_dict()}) + '\n')
+            if self.jpeg_file :
+                cv2.imwrite(self.jpeg_file, frame.image)
+            if self.writer_args :
+                # 表示イメージの作成
+                image_v = frame.make_disp_image()
+                if self.writer is None :
+                    # 最初のフレームの大きさでライタを生成
+                    filename, frame_rate = self.writer_args
+                    self.disp_height = image_v.shape[0]
+                    # fmt = cv2.VideoWriter_fourcc('m', 'p', '4', 'v')
+                    fmt = cv2.VideoWriter_fourcc(*'mp4v')
+                    self.writer = cv2.VideoWriter(filename, fmt, frame_rate, (self.disp_width, self.disp_height))
+                elif image_v.shape[0] != self.disp_height :
+                    # 途中でステータス領域の高さが変わったら最初のフレームの大きさに合わせる
+                    fitted = np.zeros((self.disp_height, *image_v.shape[1:]), dtype=image_v.dtype)
+                    height = min(self.disp_height, image_v.shape[0])
+                    fitted[:height] = image_v[:height]
+                    image_v = fitted
+                self.write_count += 1
+                if self.write_queue is None :
+                    self.writer.write(image_v)
+                    return
+                
+                # 書き込みスレッドに渡す(フレームのバッファはこれ以降変更されないのでコピーしない)
+                if self.write_queue.full() :
+                    # エンコードが追いついていない
+                    self.full_count += 1
+                    start_time = time.perf_counter()
+                    self.write_queue.put(image_v)
+                    self.wait_time += (time.perf_counter() - start_time) * 1000     # msec単位に変換
+                else :
+                    self.write_queue.put(image_v)
+                self.max_depth = max(self.max_depth, self.write_queue.qsize())
+    
+    # 書き込み待ちの状態
+    def write_status(self) :
+        return f'save : {self.write_count} frames, queue full {self.full_count} times (waited {self.wait_time:.3f} ms), max depth {self.max_depth}'
     
     # 動画ファイルのライタ解放
+    # 書き込みスレッドで例外が起きていたら、解放した後に送出する
     def release_writer(self) :
+        if self.write_thread :
+            # キューに残ったフレームを書き込んでから終了
+            self.write_queue.put(None)
+            self.write_thread.join()
+            self.write_thread = None
+            log.info(self.write_status())
         if self.writer:
             self.writer.release()
+        if self.overlay_f :
+            self.overlay_f.close()
+            self.overlay_f = None
+        self.check_error()
 # ================================================================================
 
 # コンソールとログファイルへの出力 ===============================================
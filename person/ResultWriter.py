@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+import sys
+import os
+import time
+import json
+import struct
+import threading
+import queue
+import functools
+import logging as log
+import numpy as np
+
+from Profiler import profiler
+
+# 検出結果の出力(機械可読形式) ===================================================
+# フレーム毎の検出結果を列(検出数 N を先頭の次元に持つ NumPy 配列)単位で受け取り、
+# 書き込みスレッドで JSON Lines 形式またはバイナリ形式に変換してファイルに書き込む。
+# メインスレッドはフレームを溜めて batch_frames 毎にキューに入れるだけ(キューが一杯なら空くまで待つ)で、
+# 文字列化や変換は行わない。フレーム毎に書き込みスレッドを起こすとスレッド切り替えのコストの方が大きい
+# (特にCPUコア数が少なく推論スレッドと取り合う場合)ので、まとめて渡す。
+# 渡した配列は書き込みまで参照するので、渡した後に変更しないこと。
+# 書き込みスレッドで起きた例外(ディスクの空き不足など)は保持しておき、次の write / close で送出する
+# (エラー後の書き込みスレッドはキューを読み捨てるだけにして、メインスレッドを待たせない)。
+#
+# 先頭のレコードはヘッダ(パイプライン名、コマンドライン、画像サイズ、ラベル名など)で、以降はフレーム毎に1レコード。
+#   jsonl  : 1レコード1行のJSON。フレームは {"frame": フレーム番号, 列名: 値のリスト, ...}、
+#            ヘッダは {"header": {...}}
+#            float32 の値は有効数字9桁(float32 に戻すと元の値と一致する桁数)で出力する
+#   binary : レコード毎に [長さ(uint32)][種類(uint8)][内容] (リトルエンディアン。長さは種類と内容のバイト数)
+#            種類 0 (ヘッダ) : 内容は UTF-8 の JSON
+#            種類 1 (フレーム) : 内容は [フレーム番号(uint32)][列数(uint16)][列]...
+#            列 : [名前の長さ(uint8)][名前][dtypeの長さ(uint8)][dtype(numpy の dtype.str)][次元数(uint8)][各次元の大きさ(uint32)]...[データ(C順)]
+# read_results で両形式とも読み出せる。
+class ResultWriter() :
+    FORMATS       = ("jsonl", "binary")    # 出力形式
+    
+    # バイナリ形式のレコードの種類
+    RECORD_HEADER = 0
+    RECORD_FRAME  = 1
+    
+    # 初期化
+    # batch_frames : 書き込みスレッドにまとめて渡すフレーム数
+    # queue_size   : 書き込み待ちのまとまり(batch_frames フレーム)の数の最大値
+    def __init__(self, filename, format="jsonl", header=None, batch_frames=32, queue_size=8) :
+        if not format in self.FORMATS :
+            raise ValueError(f'results format unknown : {format}')
+        self.format   = format
+        self.filename = filename
+        self.file     = open(filename, mode='wb', buffering=1024 * 1024)
+        
+        # 書き込み待ちの統計情報
+        self.write_count  = 0           # 書き込んだフレーム数
+        self.full_count   = 0           # キューが一杯で待った回数
+        self.wait_time    = 0           # キューが一杯で待った時間の合計(msec)
+        self.error        = None        # 書き込みスレッドで起きた例外
+        
+        self.write_record(self.encode_header(header or {}))
+        
+        # 書き込みスレッドと書き込み待ちのキュー
+        self.batch_frames = max(1, batch_frames)
+        self.pending      = []          # まだキューに入れていないフレーム [(フレーム番号, 列)]
+        self.write_queue  = queue.Queue(maxsize=queue_size)
+        self.write_thread = threading.Thread(target=self.write_loop, daemon=True)
+        self.write_thread.start()
+        
+    # フレームの検出結果の書き込み(溜めておき batch_frames 毎に書き込みスレッドに渡す)
+    # columns : {列名 : 配列}
+    def write(self, frame_number, columns) :
+        self.check_error()
+        with profiler.span("results/write", frame=frame_number) :
+            self.write_count += 1
+            self.pending.append((frame_number, columns))
+            if len(self.pending) >= self.batch_frames :
+                self.flush()
+                
+    # 溜めたフレームを書き込みスレッドに渡す
+    def flush(self) :
+        if not self.pending :
+            return
+        self.check_error()
+        batch, self.pending = self.pending, []
+        if self.write_queue.full() :
+            # 書き込みが追いついていない
+            self.full_count += 1
+            start_time = time.perf_counter()
+            self.write_queue.put(batch)
+            self.wait_time += (time.perf_counter() - start_time) * 1000         # msec単位に変換
+        else :
+            self.write_queue.put(batch)
+            
+    # 書き込みスレッド(Noneを受け取ったら終了)
+    def write_loop(self) :
+        encode = self.encode_jsonl if self.format == "jsonl" else self.encode_binary
+        while True :
+            batch = self.write_queue.get()
+            if batch is None :
+                break
+            if not self.error is None :
+                continue                # エラー後は読み捨てる
+            try :
+                for frame_number, columns in batch :
+                    with profiler.span("results/encode", frame=frame_number) :
+                        self.write_record(encode(frame_number, {name: np.asarray(value) for name, value in columns.items()}))
+            except Exception as e :
+                self.error = e
+                
+    # 書き込みスレッドで例外が起きていたら送出する
+    def check_error(self) :
+        if not self.error is None :
+            raise RuntimeError(f'failed to write results : {self.filename}') from self.error
+                
+    # レコードの書き込み(バイナリ形式は長さを前に付ける)
+    def write_record(self, record) :
+        if self.format == "binary" :
+            self.file.write(struct.pack('<I', len(record)))
+        self.file.write(record)
+        
+    # ヘッダの変換
+    def encode_header(self, header) :
+        if self.format == "jsonl" :
+            return json.dumps({"header": header}).encode() + b'\n'
+        return struct.pack('<B', self.RECORD_HEADER) + json.dumps(header).encode()
+        
+    # フレームの変換(JSON Lines形式)
+    @classmethod
+    def encode_jsonl(cls, frame_number, columns) :
+        parts = [f'{{"frame":{frame_number}']
+        for name, value in columns.items() :
+            parts.append(f',{json.dumps(name)}:{cls.jsonl_value(value)}')
+        parts.append('}\n')
+        return ''.join(parts).encode()
+    
+    # 列のJSON文字列化
+    # 整数と float32 の配列(特徴点の座標、矩形、confidenceなど)は1検出分の書式を % で埋める
+    # (json.dumps の約2倍速い。float32 を tolist() した float64 の長い表記にもならない)
+    @classmethod
+    def jsonl_value(cls, value) :
+        if value.ndim >= 1 and len(value) > 0 :
+            item_format = None
+            if value.dtype.kind in 'iu' :
+                item_format = '%d'
+            elif value.dtype == np.float32 and np.isfinite(value).all() :     # nan/inf は json.dumps に任せる
+                item_format = '%.9g'
+            if item_format :
+                row_format = cls.row_format(value.shape[1:], item_format)
+                return '[' + ','.join([row_format % tuple(row) for row in value.reshape(len(value), -1).tolist()]) + ']'
+        return json.dumps(value.tolist(), separators=(',', ':'))
+    
+    # 1検出分(shape の配列)の書式 (例 : (2,) の整数なら '[%d,%d]')
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def row_format(shape, item_format='%d') :
+        row_format = item_format
+        for size in reversed(shape) :
+            row_format = '[' + ','.join([row_format] * size) + ']'
+        return row_format
+        
+    # フレームの変換(バイナリ形式)
+    @classmethod
+    def encode_binary(cls, frame_number, columns) :
+        chunks = [struct.pack('<BIH', cls.RECORD_FRAME, frame_number, len(columns))]
+        for name, value in columns.items() :
+            value = np.asarray(value, order='C')                 # C順に(0次元はそのまま)
+            if value.dtype.byteorder == '>' :
+                value = value.astype(value.dtype.newbyteorder('<'))
+            name  = name.encode()
+            dtype = value.dtype.str.encode()
+            chunks.append(struct.pack(f'<B{len(name)}sB{len(dtype)}sB{value.ndim}I',
+                                      len(name), name, len(dtype), dtype, value.ndim, *value.shape))
+            chunks.append(value.tobytes())
+        return b''.join(chunks)
+        
+    # 書き込み待ちの状態
+    def write_status(self) :
+        return f'results : {self.write_count} frames, queue full {self.full_count} times (waited {self.wait_time:.3f} ms)'
+        
+    # 終了(溜めたフレームとキューに残ったフレームを書き込んでから閉じる)
+    # 書き込みスレッドで例外が起きていたら、閉じた後に送出する
+    def close(self) :
+        if self.write_thread :
+            if self.error is None :
+                self.flush()
+            self.write_queue.put(None)
+            self.write_thread.join()
+            self.write_thread = None
+            self.file.close()
+            self.check_error()
+            log.info(self.write_status())
+            log.info(f'results saved : {self.filename}')
+# ================================================================================
+
+# 検出結果の読み出し =============================================================
+# ResultWriter で書き込んだファイルのレコードを順に返す
+# 最初はヘッダの辞書、以降はフレーム毎の {"frame": フレーム番号, 列名: 配列} (jsonl は列を np.asarray で変換する)
+def read_results(filename) :
+    with open(filename, mode='rb') as f :
+        head = f.read(1)
+        f.seek(0)
+        if head == b'{' :
+            # JSON Lines形式
+            for line in f :
+                record = json.loads(line)
+                if "header" in record :
+                    yield record["header"]
+                    continue
+                yield {name: (value if name == "frame" else np.asarray(value)) for name, value in record.items()}
+            return
+            
+        # バイナリ形式
+        while True :
+            size = f.read(4)
+            if len(size) < 4 :
+                break
+            record = memoryview(f.read(struct.unpack('<I', size)[0]))
+            if record[0] == ResultWriter.RECORD_HEADER :
+                yield json.loads(bytes(record[1:]))
+                continue
+            _, frame_number, num_columns = struct.unpack_from('<BIH', record)
+            result = {"frame": frame_number}
+            pos = struct.calcsize('<BIH')
+            for _ in range(num_columns) :
+                name_len = record[pos]
+                name = bytes(record[pos + 1 : pos + 1 + name_len]).decode()
+                pos += 1 + name_len
+                dtype_len = record[pos]
+                dtype = np.dtype(bytes(record[pos + 1 : pos + 1 + dtype_len]).decode())
+                pos += 1 + dtype_len
+                ndim = record[pos]
+                shape = struct.unpack_from(f'<{ndim}I', record, pos + 1)
+                pos += 1 + 4 * ndim
+                count = int(np.prod(shape))
+                result[name] = np.frombuffer(record, dtype=dtype, count=count, offset=pos).reshape(shape)
+                pos += count * dtype.itemsize
+            yield result
+# ================================================================================
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+import sys
+import os
+import time
+import logging as log
+from argparse import ArgumentParser, SUPPRESS, RawTextHelpFormatter
+import numpy as np
+
+# 自作モジュール
+from model.reid_gallery import reid_gallery
+from model.model_person_reid import model_person_reid
+
+# reidギャラリ照合処理のベンチマーク
+# 以前のリスト+cosineSimilarityによる照合と、reid_gallery による照合の
+# 1フレームあたりの処理時間を比較する
+
+# コマンドラインパーサの構築 =====================================================
+def build_argparser():
+    parser = ArgumentParser(add_help=False, formatter_class=RawTextHelpFormatter)
+    parser.add_argument('-h', '--help', action='help', default=SUPPRESS,
+                        help='Show this help message and exit.')
+    parser.add_argument("--sizes", default=[10000, 100000], type=int, nargs='+',
+                        help="Optional.\n"
+                             "Number of identities in the gallery")
+    parser.add_argument("--queries", default=10, type=int,
+                        help="Optional.\n"
+                             "Number of persons per frame")
+    parser.add_argument("--frames", default=5, type=int,
+                        help="Optional.\n"
+                             "Number of frames per measurement")
+    parser.add_argument("--dim", default=256, type=int,
+                        help="Optional.\n"
+                             "Dimension of reid vectors")
+    parser.add_argument("-t_reid", "--threshold_reid", default=0.8, type=float,
+                        help="Optional.\n"
+                             "Probability threshold for person reidentification")
+    return parser
+# ================================================================================
+
+# 以前の照合処理(1ベクトルずつ、最初に閾値を超えたものを採用) ===================
+def identify_list(ReIdVectors, newReIdVec, threshold) :
+    reid = len(ReIdVectors)
+    for i, vec in enumerate(ReIdVectors) :
+        cossim = model_person_reid.cosineSimilarity(newReIdVec, vec)
+        if cossim > threshold :
+            reid = i
+            ReIdVectors[i] = newReIdVec
+            break
+    else :
+        ReIdVectors.append(newReIdVec)
+    return reid
+# ================================================================================
+
+# テストデータ作成 ===============================================================
+# 登録済みベクトルと、半分は登録済みのベクトルに近いクエリを作る
+def make_data(size, num_queries, num_frames, dim, rng) :
+    identities = rng.standard_normal((size, dim)).astype(np.float32)
+    frames = []
+    for _ in range(num_frames) :
+        queries = rng.standard_normal((num_queries, dim)).astype(np.float32)
+        known = rng.choice(size, num_queries // 2, replace=False)
+        queries[:len(known)] = identities[known] + rng.standard_normal((len(known), dim)).astype(np.float32) * 0.1
+        frames.append(queries)
+    return identities, frames
+# ================================================================================
+
+# メイン処理 =====================================================================
+def main():
+    log.basicConfig(format="[ %(levelname)s ] %(message)s", level=log.INFO, stream=sys.stdout)
+    
+    # コマンドラインオプションの解析
+    args = build_argparser().parse_args()
+    
+    rng = np.random.default_rng(0)
+    
+    print(f'queries/frame : {args.queries}   frames : {args.frames}   dim : {args.dim}   threshold : {args.threshold_reid}')
+    print(f'      size,    add[us/id],   list[ms/frame], gallery[ms/frame],  speedup')
+    for size in args.sizes :
+        identities, frames = make_data(size, args.queries, args.frames, args.dim, rng)
+        
+        # 登録(容量拡張を含む)
+        gallery = reid_gallery(args.dim, args.threshold_reid)
+        start = time.perf_counter()
+        for vec in reid_gallery.normalize(identities) :
+            gallery.add(vec)
+        add_time = (time.perf_counter() - start) / size * 1000 * 1000          # usec単位に変換
+        ReIdVectors = [vec for vec in identities]
+        
+        # 以前の照合処理
+        start = time.perf_counter()
+        for queries in frames :
+            for vec in queries :
+                identify_list(ReIdVectors, vec, args.threshold_reid)
+        list_time = (time.perf_counter() - start) / args.frames * 1000          # msec単位に変換
+        
+        # ギャラリによる照合処理
+        start = time.perf_counter()
+        for queries in frames :
+            gallery.identify(queries)
+        gallery_time = (time.perf_counter() - start) / args.frames * 1000       # msec単位に変換
+        
+        print(f'{size:10d}, {add_time:13.3f}, {list_time:16.3f}, {gallery_time:17.3f}, {list_time / gallery_time:7.1f}x')
+# ================================================================================
+
+if __name__ == '__main__':
+    sys.exit(main() or 0)
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+import sys
+import os
+import time
+import logging as log
+from argparse import ArgumentParser, SUPPRESS, RawTextHelpFormatter
+import numpy as np
+
+# 自作モジュール
+from model.reid_gallery import reid_gallery
+
+# reidギャラリ探索インデックスのベンチマーク
+# 全件探索(exact)に対するivfの recall(1位の候補が一致した割合)と
+# 1フレームあたりの探索時間を nprobe 毎に比較する
+# (recall はクエリ全体と、登録済み(known)/未登録(unknown)の人物のクエリ毎にも出力する)
+
+# コマンドラインパーサの構築 =====================================================
+def build_argparser():
+    parser = ArgumentParser(add_help=False, formatter_class=RawTextHelpFormatter)
+    parser.add_argument('-h', '--help', action='help', default=SUPPRESS,
+                        help='Show this help message and exit.')
+    parser.add_argument("--sizes", default=[10000, 100000], type=int, nargs='+',
+                        help="Optional.\n"
+                             "Number of identities in the gallery")
+    parser.add_argument("--nlist", default=64, type=int,
+                        help="Optional.\n"
+                             "Number of clusters for ivf index")
+    parser.add_argument("--nprobes", default=[1, 2, 4, 8, 16, 32], type=int, nargs='+',
+                        help="Optional.\n"
+                             "Number of clusters searched per query")
+    parser.add_argument("--queries", default=10, type=int,
+                        help="Optional.\n"
+                             "Number of persons per frame")
+    parser.add_argument("--frames", default=20, type=int,
+                        help="Optional.\n"
+                             "Number of frames per measurement")
+    parser.add_argument("--dim", default=256, type=int,
+                        help="Optional.\n"
+                             "Dimension of reid vectors")
+    parser.add_argument("--clusters", default=200, type=int,
+                        help="Optional.\n"
+                             "Number of clusters in the synthetic identities")
+    parser.add_argument("--separation", default=0.5, type=float,
+                        help="Optional.\n"
+                             "Spread of cluster centers relative to the spread of\n"
+                             "identities in a cluster (smaller value makes clusters overlap)")
+    parser.add_argument("--noise", default=1.0, type=float,
+                        help="Optional.\n"
+                             "Noise of queries relative to the spread of identities in a cluster")
+    parser.add_argument("--unknown", default=0.2, type=float,
+                        help="Optional.\n"
+                             "Ratio of queries of persons not in the gallery")
+    return parser
+# ================================================================================
+
+# テストデータ作成 ===============================================================
+# 実際のreidベクトルのように偏りを持たせるため、登録済みベクトルは
+# いくつかの中心の周りに分布させる(separation が小さいほどクラスタが重なり、ivfの探索漏れが起きやすい)
+# クエリは登録済みのベクトルにノイズを加えたもの(known)と、
+# 未登録の人物(登録済みと同じ分布から新たに作ったもの。unknown)を混ぜる
+# 戻り値 : (登録済みベクトル, フレーム毎のクエリのリスト, クエリ毎の登録済みかどうか)
+def make_data(size, num_queries, num_frames, dim, num_clusters, separation, noise, unknown, rng) :
+    centers    = rng.standard_normal((num_clusters, dim)).astype(np.float32) * separation
+    identities = centers[rng.integers(0, num_clusters, size)] + rng.standard_normal((size, dim)).astype(np.float32)
+    num_unknown = int(round(num_queries * unknown))
+    num_known   = num_queries - num_unknown
+    frames = []
+    for _ in range(num_frames) :
+        known   = identities[rng.choice(size, num_known, replace=False)] + rng.standard_normal((num_known, dim)).astype(np.float32) * noise
+        unknown = centers[rng.integers(0, num_clusters, num_unknown)] + rng.standard_normal((num_unknown, dim)).astype(np.float32)
+        frames.append(reid_gallery.normalize(np.concatenate((known, unknown))))
+    is_known = np.tile(np.arange(num_queries) < num_known, num_frames)
+    return reid_gallery.normalize(identities), frames, is_known
+# ================================================================================
+
+# ギャラリの作成 =================================================================
+def make_gallery(identities, index_type, nlist=64, nprobe=8) :
+    gallery = reid_gallery(identities.shape[1], index_type=index_type, nlist=nlist, nprobe=nprobe)
+    for vec in identities :
+        gallery.add(vec)
+        
+    # ivfのクラスタ学習は最初の探索時に行われるので、その時間は別に測定する
+    start = time.perf_counter()
+    gallery.search(identities[:1], 1)
+    train_time = (time.perf_counter() - start) * 1000                   # msec単位に変換
+    return gallery, train_time
+    
+# 測定 ===========================================================================
+def measure(gallery, frames) :
+    best_rows = []
+    start = time.perf_counter()
+    for queries in frames :
+        rows, _ = gallery.search(queries, 1)
+        best_rows.append(rows[:, 0])
+    search_time = (time.perf_counter() - start) / len(frames) * 1000    # msec単位に変換
+    return np.concatenate(best_rows), search_time
+# ================================================================================
+
+# メイン処理 =====================================================================
+def main():
+    log.basicConfig(format="[ %(levelname)s ] %(message)s", level=log.INFO, stream=sys.stdout)
+    
+    # コマンドラインオプションの解析
+    args = build_argparser().parse_args()
+    
+    rng = np.random.default_rng(0)
+    
+    print(f'queries/frame : {args.queries}   frames : {args.frames}   dim : {args.dim}   nlist : {args.nlist}')
+    print(f'clusters : {args.clusters}   separation : {args.separation}   noise : {args.noise}   unknown : {args.unknown}')
+    print(f'      size, index, nprobe,  train[ms], search[ms/frame], recall@1,    known,  unknown,  speedup')
+    for size in args.sizes :
+        identities, frames, is_known = make_data(size, args.queries, args.frames, args.dim, args.clusters, 
+                                                 args.separation, args.noise, args.unknown, rng)
+        
+        # 全件探索
+        gallery, _ = make_gallery(identities, "exact")
+        exact_rows, exact_time = measure(gallery, frames)
+        print(f'{size:10d}, exact, {"-":>6s}, {"-":>10s}, {exact_time:16.3f}, {1.0:8.3f}, {1.0:8.3f}, {1.0:8.3f}, {1.0:7.1f}x')
+        
+        # ivf
+        for nprobe in args.nprobes :
+            gallery, train_time = make_gallery(identities, "ivf", args.nlist, nprobe)
+            ivf_rows, ivf_time = measure(gallery, frames)
+            match  = ivf_rows == exact_rows
+            recall = [np.mean(m) if len(m) > 0 else float('nan') for m in (match, match[is_known], match[~is_known])]
+            print(f'{size:10d},   ivf, {nprobe:6d}, {train_time:10.3f}, {ivf_time:16.3f}, {recall[0]:8.3f}, {recall[1]:8.3f}, {recall[2]:8.3f}, {exact_time / ivf_time:7.1f}x')
+# ================================================================================
+
+if __name__ == '__main__':
+    sys.exit(main() or 0)
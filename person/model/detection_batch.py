@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+import sys
+import os
+import time
+import logging as log
+import cv2
+import numpy as np
+
+# 検出結果の構造化配列の型
+DETECTION_DTYPE = np.dtype([
+                    ("conf",     np.float32    ),       # confidence
+                    ("box",      np.int32, (4,)),       # 検出枠 (x1, y1, x2, y2)
+                    ("box_ex",   np.int32, (4,)),       # 拡張した切り取り範囲 (x1, y1, x2, y2)
+                    ("track_id", np.int32      ),       # トラックID (追跡しない場合は-1)
+                ])
+                
+# 1フレーム分の検出結果 ==========================================================
+# 全検出の confidence と検出枠/切り取り範囲を構造化配列(列単位)で保持し、
+# 切り取り画像は元画像のビューとして必要になったときに作成する(コピーしない)。
+# 二次モデルの入力サイズにリサイズした切り取り画像はサイズ毎に1回だけ作成し、
+# 入力サイズが同じ二次モデル同士で共有する。
+# 二次推論の結果は結果格納キー毎に検出数の長さのリストで保持する。
+# インデックスや for で取り出す detection は1検出分のビュー。
+class detection_batch() :
+    def __init__(self, image, data) :
+        self.image       = image        # 元画像
+        self.data        = data         # DETECTION_DTYPE の構造化配列
+        self.sub_results = {}           # 二次推論の結果 {結果格納キー : 検出毎の結果のリスト}
+        self.resized     = {}           # リサイズ済みの切り取り画像 {(幅, 高さ) : ((N,高さ,幅,C)の配列, 作成済みフラグ)}
+        
+    # 検出枠(画像座標)から作成 =========================================
+    # confs : (N,)の confidence, boxes : (N,4)の(x1, y1, x2, y2)
+    # 切り取り範囲は検出枠を clip_ratio 倍に拡張して元画像の範囲に収めたもの
+    @classmethod
+    def from_boxes(cls, image, confs, boxes, clip_ratio) :
+        img_height, img_width = image.shape[:2]
+        boxes = np.asarray(boxes).reshape(-1, 4).astype(int)               # 整数化
+        size  = boxes[:, 2:] - boxes[:, :2]                                 # 範囲のサイズ
+        
+        # 検出範囲の拡張比率で切り取り範囲を決定
+        margin = (size / 2) * (clip_ratio - 1)
+        box_ex = np.hstack((boxes[:, :2] - margin, boxes[:, 2:] + margin)).astype(int)
+        
+        # 元画像範囲に収まるように調整
+        box_ex = np.clip(box_ex, 0, (img_width, img_height, img_width, img_height))
+        
+        data = np.empty(len(boxes), dtype=DETECTION_DTYPE)
+        data["conf"]     = confs
+        data["box"]      = boxes
+        data["box_ex"]   = box_ex
+        data["track_id"] = -1
+        return cls(image, data)
+        
+    def __len__(self) :
+        return len(self.data)
+        
+    def __getitem__(self, index) :
+        return detection(self, index)
+        
+    def __iter__(self) :
+        return (detection(self, i) for i in range(len(self.data)))
+        
+    # 切り取り画像(元画像のビュー)
+    def crop(self, index) :
+        x1, y1, x2, y2 = self.data["box_ex"][index].tolist()
+        return self.image[y1:y2, x1:x2, :]
+        
+    # リサイズした切り取り画像 (size は (幅, 高さ))
+    # 元画像のビューから直接リサイズし、同じサイズの2回目以降は作成済みの画像を返す
+    def resized_crop(self, index, size) :
+        entry = self.resized.get(size)
+        if entry is None :
+            entry = (np.empty((len(self.data), size[1], size[0], self.image.shape[2]), dtype=self.image.dtype), np.zeros(len(self.data), dtype=bool))
+            self.resized[size] = entry
+        images, done = entry
+        if not done[index] :
+            cv2.resize(self.crop(index), size, dst=images[index])
+            done[index] = True
+        return images[index]
+        
+    # 複数の切り取り画像 (indices が None なら全検出、size を指定するとリサイズした画像)
+    def crops(self, indices=None, size=None) :
+        if indices is None :
+            indices = range(len(self.data))
+        if size is None :
+            return [self.crop(i) for i in indices]
+        return [self.resized_crop(i, size) for i in indices]
+        
+    # 切り取り範囲基準の座標(0～1)を画像の座標に変換
+    # points : (N,K,2)の検出毎のK点の座標
+    def crop_to_image(self, points) :
+        pt1_ex  = self.data["box_ex"][:, None, :2]
+        size_ex = self.data["box_ex"][:, None, 2:] - pt1_ex
+        return (points * size_ex + pt1_ex).astype(np.int32)
+        
+    # 結果格納キーの二次推論の結果のリスト(なければ作成)
+    def results_of(self, key) :
+        results = self.sub_results.get(key)
+        if results is None :
+            results = [None] * len(self.data)
+            self.sub_results[key] = results
+        return results
+# ================================================================================
+
+# 1検出分のビュー ================================================================
+# 検出結果は属性で、二次推論の結果は結果格納キーで取り出す
+class detection() :
+    __slots__ = ("batch", "index")
+    
+    def __init__(self, batch, index) :
+        self.batch = batch
+        self.index = index
+        
+    @property
+    def conf(self) :
+        return self.batch.data["conf"][self.index]
+        
+    @property
+    def pt1(self) :
+        return self.batch.data["box"][self.index, :2]
+        
+    @property
+    def pt2(self) :
+        return self.batch.data["box"][self.index, 2:]
+        
+    @property
+    def pt1_ex(self) :
+        return self.batch.data["box_ex"][self.index, :2]
+        
+    @property
+    def pt2_ex(self) :
+        return self.batch.data["box_ex"][self.index, 2:]
+        
+    @property
+    def track_id(self) :
+        return int(self.batch.data["track_id"][self.index])
+        
+    # 切り取り画像(元画像のビュー)
+    @property
+    def image(self) :
+        return self.batch.crop(self.index)
+        
+    # 二次推論の結果
+    def __getitem__(self, key) :
+        return self.batch.sub_results[key][self.index]
+        
+    def __setitem__(self, key, value) :
+        self.batch.results_of(key)[self.index] = value
+        
+    def __contains__(self, key) :
+        return key in self.batch.sub_results
+# ================================================================================
@@ -39,9 +39,9 @@ class model_person_attr(sync_model_base) :
                 ]
         }
 
-    def __init__(self, core, model_xml, device="CPU", threshold=0.5, log_f=None) :
+    def __init__(self, core, model_xml, device="CPU", threshold=0.5, batch_size=1, queue_num=1, log_f=None, ppp=False) :
         # 親クラスの初期化をcall
-        super().__init__(core, model_xml, device=device, threshold=threshold, log_f=log_f)
+        super().__init__(core, model_xml, device=device, threshold=threshold, batch_size=batch_size, queue_num=queue_num, log_f=log_f, ppp=ppp)
         
     # output blobの確認 ===============================================
     def check_output_blob(self) :
@@ -70,21 +70,42 @@ class model_person_attr(sync_model_base) :
             raise RuntimeError(f"Unsupported {len(outputs)} output layers '.")
     
     # 結果の解析 ===============================================
-    def analyze_result(self, res, params) :
+    def analyze_result(self, res, params, batch_index=0) :
         # params未使用
         
-        # output tensorの取り出し
-        indicators = res.get_tensor(self.output_blob_name).data.flatten()
+        # output tensorの取り出し(batch_index番目の画像の結果)
+        indicators = res.get_tensor(self.output_blob_name).data[batch_index].flatten()
         
-        result = {"result": {}, "raw_result":{}}
-        for i, indicator in enumerate(indicators) :
-            result["raw_result"][self.AttrNames[self.output_blob_type][i]] = indicator
+        return self.make_result(dict(zip(self.AttrNames[self.output_blob_type], indicators)))
+    
+    # 属性値から結果を作成 (count は raw_result の平均に使った推論回数)
+    def make_result(self, raw_result, count=1) :
+        result = {"result": {}, "raw_result": raw_result, "count": count}
+        for name, indicator in raw_result.items() :
             if indicator > self.threshold :               # 閾値以上
-                result["result"][self.AttrNames[self.output_blob_type][i]] = True
+                result["result"][name] = True
             else :
-                result["result"][self.AttrNames[self.output_blob_type][i]] = False
+                result["result"][name] = False
         
         return result
+    
+    # トラック毎の結果の統合 ========================================
+    # 同じトラックの属性値(raw_result)の平均で判定することで、フレーム毎の判定のばらつきを抑える
+    def merge_track_result(self, prev_result, result) :
+        count = prev_result["count"] + 1
+        raw_result = {name: prev + (result["raw_result"][name] - prev) / count for name, prev in prev_result["raw_result"].items()}
+        return self.make_result(raw_result, count)
+    # ================================================================================
+    
+    # 検出結果の出力用の列 ===========================================
+    # 属性名のリスト(列の並び順)
+    def attr_names(self) :
+        return self.AttrNames[self.output_blob_type]
+    
+    # 戻り値 : {key : (N,属性数)の属性値(raw_result。threshold より大きければその属性あり)}
+    def result_columns(self, batch, key) :
+        names = self.attr_names()
+        return {key: np.array([[result["raw_result"][name] for name in names] for result in batch.results_of(key)], dtype=np.float32).reshape(-1, len(names))}
     # ================================================================================
     
     # 後処理 =======================================================
@@ -12,17 +12,21 @@ import numpy as np
 # from openvino.runtime import AsyncInferQueue    as ov_AsyncInferQueue
 
 from .sync_model_base import sync_model_base
+from .reid_gallery import reid_gallery
 from DispFrame import console_print
 
 
 # Person reidentification (人物同定) model
 class model_person_reid(sync_model_base) :
-    def __init__(self, core, model_xml, device="CPU", threshold=0.8, log_f=None) :
+    def __init__(self, core, model_xml, device="CPU", threshold=0.8, batch_size=1, queue_num=1, log_f=None, max_size=0, ttl=0, ema=1.0, index_type="exact", nlist=64, nprobe=8, ppp=False) :
         # 親クラスの初期化をcall
-        super().__init__(core, model_xml, device=device, threshold=threshold, log_f=log_f)
+        super().__init__(core, model_xml, device=device, threshold=threshold, batch_size=batch_size, queue_num=queue_num, log_f=log_f, ppp=ppp)
         
-        # reidベクトルの配列
-        self.ReIdVectors = []
+        # reidベクトルのギャラリ
+        # (max_size : 最大登録数, ttl : 削除までのフレーム数, ema : ベクトル更新の重み)
+        # (index_type : 探索インデックスの種類, nlist/nprobe : ivfのクラスタ数/探索クラスタ数)
+        self.gallery = reid_gallery(self.output_blob_shape[1], threshold, max_size=max_size, ttl=ttl, ema=ema, 
+                                    index_type=index_type, nlist=nlist, nprobe=nprobe)
     
     # output blobの確認 ===============================================
     def check_output_blob(self) :
@@ -35,30 +39,37 @@ class model_person_reid(sync_model_base) :
         assert tuple(self.output_blob_shape) == (1, 256), f"output shape must be (1, 256), but it is {self.output_blob_shape}" # 出力レイヤのshape確認
     
     # 結果の解析 ===============================================
-    def analyze_result(self, res, params) :
+    def analyze_result(self, res, params, batch_index=0) :
         # params未使用
         
-        # output tensorの取り出し
-        newReIdVec = res.get_tensor(self.output_blob_name).data[0].copy()
+        # output tensorの取り出し(batch_index番目の画像の結果)
+        newReIdVec = res.get_tensor(self.output_blob_name).data[batch_index].copy()
         
-        # 見つからなかったらappendしたときのindex(=現在のサイズ)を返すので初期値とする
-        reid = len(self.ReIdVectors)
+        # reidベクトルとの照合はフレーム順に行うので、ここではベクトルだけ返す
+        result = {"vector": newReIdVec}
         
-        for i, vec in enumerate(self.ReIdVectors) :
-            cossim = self.cosineSimilarity(newReIdVec, vec);
-            # print(f'{i} : cossim = {cossim}')
-            if cossim > self.threshold :                # 閾値以上
-                # 以前のreidベクトルと類似していると判定
-                reid = i
-                self.ReIdVectors[i] = newReIdVec        # 現在のベクトルで置き換え
-                break
-        else :  # forループをbreakせずに抜けてきた
-            # 新しいベクトルとして登録
-            self.ReIdVectors.append(newReIdVec)
-        
-        result = {"result": reid}
-
         return result
+    
+    # フレーム順の解析 ==============================================
+    # reidベクトルの照合と登録(推論完了順によらず結果が決まるようにフレーム順で行う)
+    # 1フレーム分のベクトルをまとめてギャラリと照合する
+    def analyze_result_ordered(self, results) :
+        reids = self.gallery.identify([result["vector"] for result in results])
+        for result, reid in zip(results, reids) :
+            result["result"] = reid
+        
+        return results
+    
+    # ギャラリの状態(ステータス表示用)
+    def gallery_status(self) :
+        gallery = self.gallery
+        return f'reid gallery     : {gallery.size:5d} ids (evicted {gallery.evict_count}) lookup {gallery.lookup_time:.3f} ms'
+    # ================================================================================
+    
+    # 検出結果の出力用の列 ===========================================
+    # 戻り値 : {key : (N,)の再識別ID}
+    def result_columns(self, batch, key) :
+        return {key: np.array([result["result"] for result in batch.results_of(key)], dtype=np.int32)}
     # ================================================================================
     
     # 後処理 =======================================================
@@ -70,7 +81,7 @@ class model_person_reid(sync_model_base) :
     
     # ================================================================================
     
-    # cos類似度の計算 =====================================================================
+    # cos類似度の計算(ベクトル1組) ======================================================
     # https://atmarkit.itmedia.co.jp/ait/articles/2112/08/news020.html
     # https://qiita.com/Qiitaman/items/fa393d93ce8e61a857b1
     @staticmethod
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+import sys
+import os
+import time
+import logging as log
+import numpy as np
+
+from .reid_index import create_reid_index
+
+# 保存ファイルの管理情報の構造化配列の型
+REID_META_DTYPE = np.dtype([
+                    ("id",        np.int64),        # reid
+                    ("last_seen", np.int64),        # 最後に照合されたフレーム
+                    ("hits",      np.int64),        # 照合された回数
+                ])
+                
+# reidベクトルのギャラリ ==========================================================
+# 登録済みのreidベクトルをL2正規化したfloat32の行列で保持し、
+# 1フレーム分の全クエリとの cos類似度を1回の行列積で計算する。
+# 行列は容量が足りなくなったら倍に拡張する(償却O(1)で登録できる)
+#
+# 長時間の運用でギャラリが増え続けないように、以下の管理を行う
+#   max_size : 最大登録数(超えたら最後に照合されたのが最も古いものを削除する)
+#   ttl      : 指定フレーム数の間照合されなかったものを削除する
+#   ema      : 照合されたときのベクトル更新の重み(1.0なら現在のベクトルで置き換え)
+# (0 なら制限なし)
+# 類似候補の探索は index_type で指定したインデックス(reid_index.py)で行う
+#   exact : 全件探索
+#   ivf   : クラスタ(nlist個)に分けて、クエリに近いnprobe個のクラスタだけ探索する近似探索
+#
+# save()/load() でギャラリをディレクトリに保存/読み込みできる
+#   vectors.npy : ベクトル (登録数, dim) float32
+#   meta.npy    : 管理情報 (登録数,) REID_META_DTYPE
+#   state.npy   : [次に割り当てるreid, 照合したフレーム数] int64
+# 読み込んだベクトルはコピーオンライトでメモリマップし(ベース領域)、
+# 以降に登録したベクトルはメモリ上の領域に追加する。
+# 行番号はベース領域→メモリ上の領域の順に通しで付ける。
+class reid_gallery() :
+    def __init__(self, dim=256, threshold=0.8, max_size=0, ttl=0, ema=1.0, index_type="exact", nlist=64, nprobe=8, capacity=1024) :
+        self.dim       = dim
+        self.threshold = threshold
+        self.max_size  = max_size
+        self.ttl       = ttl
+        self.ema       = ema
+        
+        if max_size > 0 :
+            capacity = min(capacity, max_size)
+            
+        # 登録済みベクトル(L2正規化済み)と管理情報
+        # 先頭 self.size 行だけが有効(削除時は最終行を詰める)
+        self.base      = np.zeros((0, dim), dtype=np.float32)   # 読み込んだベクトル(ベース領域)
+        self.vectors   = np.zeros((capacity, dim), dtype=np.float32)
+        self.ids       = np.zeros(capacity, dtype=np.int64)     # reid
+        self.last_seen = np.zeros(capacity, dtype=np.int64)     # 最後に照合されたフレーム
+        self.hits      = np.zeros(capacity, dtype=np.int64)     # 照合された回数
+        self.size      = 0
+        
+        self.next_id     = 0        # 次に割り当てるreid
+        self.frame_count = 0        # 照合したフレーム数
+        self.evict_count = 0        # 削除した数
+        self.lookup_time = 0        # 直近の照合時間(msec)
+        
+        # 探索インデックス
+        self.index = create_reid_index(index_type, nlist, nprobe)
+        
+    # L2正規化 =======================================================
+    @staticmethod
+    def normalize(vectors) :
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        return vectors / np.maximum(norms, np.finfo(np.float32).tiny)
+        
+    # ベクトルの参照 =================================================
+    # row行のベクトル(ベース領域/メモリ上の領域のビュー)
+    def vector(self, row) :
+        if row < len(self.base) :
+            return self.base[row]
+        return self.vectors[row - len(self.base)]
+        
+    # 有効な行を行番号順に並べた領域のリスト(連結すると全ベクトルの行列になる)
+    def segments(self) :
+        num_base = min(self.size, len(self.base))
+        return [self.base[:num_base], self.vectors[:self.size - num_base]]
+        
+    # 登録/削除 ======================================================
+    def grow(self) :
+        # メモリ上の領域の容量を倍に拡張(ベース領域はそのまま)
+        capacity = len(self.vectors) * 2
+        if self.max_size > 0 :
+            capacity = min(capacity, max(self.max_size - len(self.base), 1))
+        num_vectors = self.size - len(self.base)
+        vectors = np.zeros((capacity, self.dim), dtype=np.float32)
+        vectors[:num_vectors] = self.vectors[:num_vectors]
+        self.vectors = vectors
+        for name in ("ids", "last_seen", "hits") :
+            old = getattr(self, name)
+            new = np.zeros(len(self.base) + capacity, dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, name, new)
+            
+    def add(self, vector) :
+        if self.max_size > 0 and self.size >= self.max_size :
+            # 最後に照合されたのが最も古いものを削除
+            self.remove(int(self.last_seen[:self.size].argmin()))
+        if self.size == len(self.base) + len(self.vectors) :
+            self.grow()
+            
+        row = self.size
+        self.vector(row)[:] = vector
+        self.ids[row]       = self.next_id
+        self.last_seen[row] = self.frame_count
+        self.hits[row]      = 1
+        self.index.add(row, self.vector(row))
+        self.size    += 1
+        self.next_id += 1
+        return int(self.ids[row])
+        
+    def remove(self, row) :
+        # 最終行を削除した行に移動
+        last = self.size - 1
+        if row != last :
+            self.vector(row)[:] = self.vector(last)
+            for array in (self.ids, self.last_seen, self.hits) :
+                array[row] = array[last]
+        self.index.remove(row, last)
+        self.size -= 1
+        self.evict_count += 1
+        
+    def expire(self) :
+        # ttlフレームの間照合されなかったものを削除
+        if self.ttl <= 0 :
+            return
+        rows = np.nonzero(self.last_seen[:self.size] < self.frame_count - self.ttl)[0]
+        for row in rows[::-1] :         # 後ろから削除すれば詰めた行が削除対象になることはない
+            self.remove(int(row))
+            
+    # 類似候補の探索 =================================================
+    # queries : (クエリ数, dim) L2正規化済み
+    # 戻り値  : クエリ毎に cos類似度の高い順にk個の (行, 類似度)
+    def search(self, queries, k) :
+        return self.index.search(queries, self.segments(), k)
+        
+    # 照合 ===========================================================
+    # 1フレーム分のreidベクトルを照合し、それぞれのreidを返す。
+    # (検出がなかったフレームも空のリストで呼ぶこと。ttlのフレーム数に数える)
+    # 類似度の高いクエリから順に、閾値を超える最も類似したreidを割り当てる。
+    # (同じフレーム内で同じreidは1回しか割り当てない)
+    # 割り当てたreidのベクトルはemaの重みで現在のベクトルに近づけ、
+    # 割り当てられなかったものは新しいreidとして登録する。
+    def identify(self, vectors) :
+        start_time = time.perf_counter()
+        
+        self.frame_count += 1
+        self.expire()
+        
+        if len(vectors) == 0 :
+            self.lookup_time = (time.perf_counter() - start_time) * 1000        # msec単位に変換
+            return []
+            
+        queries = self.normalize(vectors)
+        rows = [None] * len(queries)
+        
+        if self.size > 0 :
+            # 他のクエリに割り当て済みの候補を除いても1個は残るようにクエリ数分の候補を探す
+            cand_rows, cand_sims = self.search(queries, len(queries))
+            
+            assigned = set()
+            for i in np.argsort(-cand_sims[:, 0], kind="stable") :
+                # 割り当て済みでない最も類似した候補を割り当てる
+                for row, sim in zip(cand_rows[i], cand_sims[i]) :
+                    if not sim > self.threshold :
+                        break
+                    if row not in assigned :
+                        rows[i] = int(row)
+                        assigned.add(rows[i])
+                        break
+                        
+        # 照合できたものを更新(新規登録で行が詰められる前に行う)
+        reids = [None] * len(queries)
+        for i, row in enumerate(rows) :
+            if row is not None :
+                if self.ema < 1.0 :
+                    vector = self.vector(row) * (1.0 - self.ema) + queries[i] * self.ema
+                    self.vector(row)[:] = self.normalize(vector)
+                else :
+                    self.vector(row)[:] = queries[i]
+                self.index.update(row, self.vector(row))
+                self.last_seen[row] = self.frame_count
+                self.hits[row]     += 1
+                reids[i] = int(self.ids[row])
+                
+        # 照合できなかったものを新しいreidとして登録
+        for i, row in enumerate(rows) :
+            if row is None :
+                reids[i] = self.add(queries[i])
+                
+        self.lookup_time = (time.perf_counter() - start_time) * 1000            # msec単位に変換
+        return reids
+        
+    # 保存/読み込み ==================================================
+    def save(self, path) :
+        os.makedirs(path, exist_ok=True)
+        
+        # ベクトルは領域毎に書き込む(ベース領域を全部メモリに読み込まないように)
+        # 読み込み元と同じファイルに保存できるように、一時ファイルに書いてから置き換える
+        vectors_file = os.path.join(path, "vectors.npy")
+        vectors = np.lib.format.open_memmap(vectors_file + ".tmp", mode="w+", dtype=np.float32, shape=(self.size, self.dim))
+        offset = 0
+        for segment in self.segments() :
+            vectors[offset : offset + len(segment)] = segment
+            offset += len(segment)
+        vectors.flush()
+        del vectors
+        os.replace(vectors_file + ".tmp", vectors_file)
+        
+        # 管理情報
+        meta = np.empty(self.size, dtype=REID_META_DTYPE)
+        meta["id"]        = self.ids[:self.size]
+        meta["last_seen"] = self.last_seen[:self.size]
+        meta["hits"]      = self.hits[:self.size]
+        with open(os.path.join(path, "meta.npy"), "wb") as f :
+            np.save(f, meta)
+        with open(os.path.join(path, "state.npy"), "wb") as f :
+            np.save(f, np.array([self.next_id, self.frame_count], dtype=np.int64))
+        log.info(f"reid gallery saved : {path} ({self.size} ids)")
+        
+    def load(self, path) :
+        # ベクトルはコピーオンライトでメモリマップする
+        # (アクセスした部分だけ読み込まれ、更新してもファイルは変更されない。
+        #   更新していないページは同じファイルを読み込んだプロセス間で共有される)
+        vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode="c")
+        if vectors.ndim != 2 or vectors.shape[1] != self.dim or vectors.dtype != np.float32 :
+            raise ValueError(f'reid gallery vectors mismatch : shape={vectors.shape} dtype={vectors.dtype}, expected (N, {self.dim}) float32')
+        meta  = np.load(os.path.join(path, "meta.npy"))
+        state = np.load(os.path.join(path, "state.npy"))
+        if len(meta) != len(vectors) :
+            raise ValueError(f'reid gallery meta mismatch : {len(meta)} entries for {len(vectors)} vectors')
+            
+        # 管理情報はメモリ上に持つ(メモリ上の領域の容量分も確保)
+        self.base = vectors
+        self.size = len(vectors)
+        for name, field in (("ids", "id"), ("last_seen", "last_seen"), ("hits", "hits")) :
+            array = np.zeros(len(self.base) + len(self.vectors), dtype=np.int64)
+            array[:self.size] = meta[field]
+            setattr(self, name, array)
+        self.next_id, self.frame_count = (int(x) for x in state)
+        
+        # インデックスは作り直す
+        self.index.clear(self.size)
+        log.info(f"reid gallery loaded : {path} ({self.size} ids)")
+# ================================================================================
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+import sys
+import os
+import time
+import logging as log
+import numpy as np
+
+# reidベクトルの検索インデックス =================================================
+# reid_gallery の行(登録済みベクトル)からクエリに類似した候補を探す。
+# ギャラリのベクトル行列そのものは reid_gallery が持ち、インデックスは
+# 行の追加/更新/削除の通知を受けて自分の管理情報だけを更新する。
+#   add(row, vector)    : row行に登録された
+#   update(row, vector) : row行のベクトルが更新された
+#   remove(row, last)   : row行が削除され、last行がrow行に移動した
+#   clear(size)         : 全行が入れ替わった(ギャラリの読み込み)
+#   search(queries, segments, k) : クエリ毎に類似度の高い順にk個の(行, 類似度)を返す
+#                                  (候補がk個に満たなければ行=-1, 類似度=-infで埋める)
+# segments はギャラリの有効なベクトルを行番号順に分割した行列のリスト
+# (ベース領域とメモリ上の領域。連結すると全ベクトルの行列になる)
+
+# 類似度行列から上位k個を取り出す ================================================
+# sims : (クエリ数, 候補数)  rows : 候補の行番号(Noneなら候補のindexをそのまま使う)
+def top_k(sims, k, rows=None) :
+    num_queries, num_cands = sims.shape
+    k_rows = np.full((num_queries, k), -1, dtype=np.int64)
+    k_sims = np.full((num_queries, k), -np.inf, dtype=np.float32)
+    n = min(k, num_cands)
+    if n == 0 :
+        return k_rows, k_sims
+        
+    if n < num_cands :
+        part = np.sort(np.argpartition(-sims, n - 1, axis=1)[:, :n], axis=1)     # 同じ類似度なら若い番号を優先
+    else :
+        part = np.broadcast_to(np.arange(num_cands), (num_queries, num_cands))
+    part_sims = np.take_along_axis(sims, part, axis=1)
+    order = np.argsort(-part_sims, axis=1, kind="stable")
+    idx = np.take_along_axis(part, order, axis=1)
+    
+    k_rows[:, :n] = idx if rows is None else rows[idx]
+    k_sims[:, :n] = np.take_along_axis(part_sims, order, axis=1)
+    return k_rows, k_sims
+    
+# 領域毎の類似度を連結
+def similarity(queries, segments) :
+    return np.concatenate([queries @ segment.T for segment in segments], axis=1)
+    
+# 行番号を指定してベクトルを取り出す
+def take_rows(segments, rows) :
+    vectors = np.empty((len(rows), segments[0].shape[1]), dtype=np.float32)
+    offset = 0
+    for segment in segments :
+        mask = (rows >= offset) & (rows < offset + len(segment))
+        vectors[mask] = segment[rows[mask] - offset]
+        offset += len(segment)
+    return vectors
+# ================================================================================
+
+# 全件探索(厳密なcos類似度) ======================================================
+class reid_index_exact() :
+    def add(self, row, vector) :
+        pass
+        
+    def update(self, row, vector) :
+        pass
+        
+    def remove(self, row, last) :
+        pass
+        
+    def clear(self, size) :
+        pass
+        
+    def search(self, queries, segments, k) :
+        return top_k(similarity(queries, segments), k)
+# ================================================================================
+
+# IVF(転置ファイル)による近似探索 ================================================
+# 登録済みベクトルを球面k-meansで nlist 個のクラスタに分け、
+# クエリに近い nprobe 個のクラスタに属する行だけ類似度を計算する。
+# クラスタ毎にベクトルのコピーを連続した配列(転置リスト)で持つので、
+# 探索時に候補のベクトルを集める必要がない(その分メモリは倍になる)。
+# 登録数が nlist * train_factor に達するまでは全件探索を行い、
+# 以降は登録数が前回学習時の倍になる毎にクラスタを学習し直す。
+class reid_index_ivf() :
+    def __init__(self, nlist=64, nprobe=8, train_factor=8, kmeans_iter=10, seed=0) :
+        self.nlist        = nlist
+        self.nprobe       = min(nprobe, nlist)
+        self.train_factor = train_factor
+        self.kmeans_iter  = kmeans_iter
+        self.rng          = np.random.default_rng(seed)
+        
+        self.centroids    = None                        # クラスタ中心(L2正規化済み)
+        self.trained_size = 0                           # 前回学習時の登録数
+        
+        # 行毎の所属クラスタと転置リスト内の位置
+        self.assign       = np.zeros(0, dtype=np.int32)
+        self.pos          = np.zeros(0, dtype=np.int64)
+        
+        # 転置リスト(クラスタ毎の行番号とベクトル、先頭 list_size 個が有効)
+        self.list_rows    = []
+        self.list_vecs    = []
+        self.list_size    = []
+        
+    # 所属クラスタの計算
+    def nearest(self, vectors) :
+        return (vectors @ self.centroids.T).argmax(axis=1).astype(np.int32)
+        
+    # 全行の所属クラスタの計算(一度に計算する行数を制限する)
+    def nearest_all(self, segments, chunk=65536) :
+        labels = [np.zeros(0, dtype=np.int32)]
+        for segment in segments :
+            for start in range(0, len(segment), chunk) :
+                labels.append(self.nearest(segment[start : start + chunk]))
+        return np.concatenate(labels)
+        
+    # 転置リストへの追加/削除 ========================================
+    def list_insert(self, row, vector, l) :
+        n = self.list_size[l]
+        if n == len(self.list_rows[l]) :
+            # 容量を倍に拡張
+            rows = np.zeros(max(n * 2, 16), dtype=np.int64)
+            vecs = np.zeros((len(rows), len(vector)), dtype=np.float32)
+            rows[:n] = self.list_rows[l][:n]
+            vecs[:n] = self.list_vecs[l][:n]
+            self.list_rows[l] = rows
+            self.list_vecs[l] = vecs
+        self.list_rows[l][n] = row
+        self.list_vecs[l][n] = vector
+        self.list_size[l]    = n + 1
+        self.assign[row]     = l
+        self.pos[row]        = n
+        
+    def list_delete(self, row) :
+        # リストの最後の要素を削除した位置に移動
+        l, p = self.assign[row], self.pos[row]
+        last = self.list_size[l] - 1
+        if p != last :
+            moved = self.list_rows[l][last]
+            self.list_rows[l][p] = moved
+            self.list_vecs[l][p] = self.list_vecs[l][last]
+            self.pos[moved]      = p
+        self.list_size[l] = last
+        
+    # 行の追加/更新/削除 =============================================
+    def reserve(self, size) :
+        if size > len(self.assign) :
+            # 容量を倍に拡張
+            capacity = max(size, len(self.assign) * 2)
+            for name in ("assign", "pos") :
+                old = getattr(self, name)
+                new = np.zeros(capacity, dtype=old.dtype)
+                new[:len(old)] = old
+                setattr(self, name, new)
+                
+    def add(self, row, vector) :
+        self.reserve(row + 1)
+        if self.centroids is not None :
+            self.list_insert(row, vector, self.nearest(vector[np.newaxis])[0])
+            
+    def update(self, row, vector) :
+        if self.centroids is not None :
+            self.list_delete(row)
+            self.list_insert(row, vector, self.nearest(vector[np.newaxis])[0])
+            
+    def remove(self, row, last) :
+        if self.centroids is not None :
+            self.list_delete(row)
+            if row != last :
+                # last行の行番号をrowに付け替え
+                l, p = self.assign[last], self.pos[last]
+                self.list_rows[l][p] = row
+                self.assign[row]     = l
+                self.pos[row]        = p
+                
+    def clear(self, size) :
+        # 次の探索時に学習し直す
+        self.reserve(size)
+        self.centroids    = None
+        self.trained_size = 0
+        self.list_rows    = []
+        self.list_vecs    = []
+        self.list_size    = []
+        
+    # クラスタの学習 =================================================
+    def train(self, segments) :
+        # 学習に使うのは最大 nlist * 64 個
+        size = sum(len(segment) for segment in segments)
+        num_train = min(size, self.nlist * 64)
+        train = take_rows(segments, np.sort(self.rng.choice(size, num_train, replace=False)))
+        
+        # 球面k-means(中心はランダムに選んだベクトルで初期化)
+        centroids = train[self.rng.choice(num_train, self.nlist, replace=False)].copy()
+        for _ in range(self.kmeans_iter) :
+            labels = (train @ centroids.T).argmax(axis=1)
+            order  = np.argsort(labels, kind="stable")
+            counts = np.bincount(labels, minlength=self.nlist)
+            starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+            used   = counts > 0                             # 空のクラスタは中心を変えない
+            centroids[used] = np.add.reduceat(train[order], starts[used], axis=0)
+            centroids /= np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), np.finfo(np.float32).tiny)
+        self.centroids = centroids
+        
+        # 全行を転置リストに振り分け直す
+        labels = self.nearest_all(segments)
+        order  = np.argsort(labels, kind="stable")
+        counts = np.bincount(labels, minlength=self.nlist)
+        starts = np.concatenate(([0], np.cumsum(counts)))
+        self.list_rows = []
+        self.list_vecs = []
+        for l in range(self.nlist) :
+            rows = order[starts[l]:starts[l + 1]]
+            capacity = max(len(rows) * 2, 16)
+            self.list_rows.append(np.zeros(capacity, dtype=np.int64))
+            self.list_vecs.append(np.zeros((capacity, centroids.shape[1]), dtype=np.float32))
+            self.list_rows[l][:len(rows)] = rows
+            self.list_vecs[l][:len(rows)] = take_rows(segments, rows)
+            self.pos[rows] = np.arange(len(rows))
+        self.list_size = counts.tolist()
+        self.assign[:size] = labels
+        self.trained_size = size
+        
+    # 探索 ===========================================================
+    def search(self, queries, segments, k) :
+        size = sum(len(segment) for segment in segments)
+        if size >= max(self.nlist * self.train_factor, self.trained_size * 2) :
+            self.train(segments)
+        if self.centroids is None :
+            # 学習前は全件探索
+            return top_k(similarity(queries, segments), k)
+            
+        # クエリ毎に近いクラスタを選び、その転置リストだけ類似度を計算
+        probes = np.argpartition(-(queries @ self.centroids.T), self.nprobe - 1, axis=1)[:, :self.nprobe]
+        k_rows = np.full((len(queries), k), -1, dtype=np.int64)
+        k_sims = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        for i, probe in enumerate(probes) :
+            sizes = [self.list_size[l] for l in probe]
+            cands = np.concatenate([self.list_rows[l][:n] for l, n in zip(probe, sizes)])
+            sims  = np.concatenate([self.list_vecs[l][:n] @ queries[i] for l, n in zip(probe, sizes)])
+            k_rows[i], k_sims[i] = top_k(sims[np.newaxis], k, cands)
+        return k_rows, k_sims
+# ================================================================================
+
+# インデックスの作成 =============================================================
+REID_INDEX_TYPES = ("exact", "ivf")
+
+def create_reid_index(index_type="exact", nlist=64, nprobe=8) :
+    if index_type == "exact" :
+        return reid_index_exact()
+    elif index_type == "ivf" :
+        return reid_index_ivf(nlist=nlist, nprobe=nprobe)
+    else :
+        raise ValueError(f'reid index type unknown : {index_type}')
+# ================================================================================
@@ -5,16 +5,41 @@ import time
 import logging as log
 import cv2
 import numpy as np
+from collections import deque
 
 # openVINOモジュール
 # from openvino.runtime import get_version        as ov_get_version
 # from openvino.runtime import Core               as ov_Core
 from openvino.runtime import AsyncInferQueue    as ov_AsyncInferQueue
+from openvino.runtime import PartialShape       as ov_PartialShape
+from openvino.runtime import Tensor             as ov_Tensor
+from openvino.runtime import Layout             as ov_Layout
+from openvino.runtime import Type               as ov_Type
+from openvino.preprocess import PrePostProcessor    as ov_PrePostProcessor
+from openvino.preprocess import ResizeAlgorithm     as ov_ResizeAlgorithm
+from openvino.preprocess import ColorFormat         as ov_ColorFormat
+
+from Profiler import profiler, NULL_SPAN
 
 class sync_model_base() :
-    def __init__(self, core, model_xml, device="CPU", threshold=0.5, log_f=None) :
+    def __init__(self, core, model_xml, device="CPU", threshold=0.5, batch_size=1, queue_num=1, log_f=None, ppp=False) :
         self.threshold      = threshold
+        self.batch_size     = batch_size        # バッチサイズ(0なら可変長)
+        self.queue_num      = queue_num         # 推論キュー数(非同期推論時)
         self.log_f          = log_f
+        self.ppp            = ppp               # 前処理をモデルに組み込む
+        
+        # 推論中の入力画像の参照(前処理組み込み時)
+        self.input_refs = deque(maxlen=queue_num + 1)
+        
+        # 入力画像情報の値 (キーは入力画像の(高さ, 幅))
+        self.img_info_cache = {}
+        
+        # 非同期推論の結果通知先
+        self.result_callback = None
+        
+        # プロファイラの区間名の接頭辞
+        self.profile_name = type(self).__name__
 
         # IR(Intermediate Representation ;中間表現)ファイル(.xml & .bin) の読み込み
         self.load_model(core, model_xml)
@@ -34,13 +59,29 @@ class sync_model_base() :
         self.model = core.read_model(model_xml)      # xmlとbinが同名ならbinは省略可能
     
     def make_infer_queue(self, core, device) :
+        # バッチサイズの変更
+        self.reshape_batch()
+        
+        # 前処理の組み込み
+        if self.ppp :
+            self.embed_preprocess()
+        else :
+            self.embed_layout()
+        
         # モデルのコンパイル
         log.info("Loading model to the plugin...")
         self.compiled_model = core.compile_model(self.model, device)
         
         # 推論キューの作成
-        # 同期モードなら1面
-        self.async_queue = ov_AsyncInferQueue(self.compiled_model, 1)
+        # 同期モードなら1面、非同期モードならqueue_num面
+        self.async_queue = ov_AsyncInferQueue(self.compiled_model, self.queue_num)
+        
+        # 推論リクエスト毎の入力テンソルのビューと、書き込み済みの入力画像情報のキー
+        self.input_views    = [None] * len(self.async_queue)
+        self.img_info_keys  = [None] * len(self.async_queue)
+        
+        # callbackの設定(非同期推論時のみ使用される)
+        self.async_queue.set_callback(self.callback)
     
     def check_input_blob(self) :
         # 入力レイヤ数のチェックと名前の取得
@@ -75,38 +116,225 @@ class sync_model_base() :
     
         if self.img_input_blob_name is None :
             raise RuntimeError("Image input blob not found.")
+    
+    def reshape_batch(self) :
+        # バッチサイズ1ならそのまま
+        if self.batch_size == 1 :
+            return
+        
+        if self.batch_size < 0 :
+            raise ValueError(f"batch size must be greater than or equal to 0, but it is {self.batch_size}")
+        if not (self.img_info_blob_name_3 is None and self.img_info_blob_name_6 is None) :
+            raise RuntimeError("Batch mode is not supported for models with image info input.")
+        
+        # 入力レイヤのバッチ次元を変更(0なら可変長)
+        log.info(f"Reshape model to batch size {self.batch_size if self.batch_size > 0 else 'dynamic'}")
+        input_shape = list(self.img_input_blob_shape)
+        input_shape[0] = self.batch_size if self.batch_size > 0 else -1
+        self.model.reshape({self.img_input_blob_name: ov_PartialShape(input_shape)})
         
+    # 前処理のモデルへの組み込み ==================================
+    # リサイズ、レイアウト変換(NHWC→NCHW)、u8→f32変換を PrePostProcessor でモデルに組み込む。
+    # 入力はBGR画像(u8, NHWC, 任意サイズ)をそのまま渡せばよい
+    def embed_preprocess(self) :
+        log.info("Embed preprocessing into the model")
+        ppp = ov_PrePostProcessor(self.model)
+        ppp_input = ppp.input(self.img_input_blob_name)
+        ppp_input.tensor()                                                  \
+                 .set_element_type(ov_Type.u8)                              \
+                 .set_layout(ov_Layout("NHWC"))                             \
+                 .set_color_format(ov_ColorFormat.BGR)                      \
+                 .set_spatial_dynamic_shape()                               # 入力画像のサイズは任意
+        ppp_input.preprocess().resize(ov_ResizeAlgorithm.RESIZE_LINEAR)
+        ppp_input.model().set_layout(ov_Layout("NCHW" if self.img_input_blob_format_NCHW else "NHWC"))
+        self.model = ppp.build()
+    
+    # 入力テンソルのレイアウトの設定 ==============================
+    # 推論リクエストの入力テンソル(u8, NHWC)にリサイズした画像を直接書き込めるように、
+    # u8→f32変換とレイアウト変換(NHWC→NCHW)だけ PrePostProcessor でモデルに組み込む
+    def embed_layout(self) :
+        ppp = ov_PrePostProcessor(self.model)
+        ppp_input = ppp.input(self.img_input_blob_name)
+        ppp_input.tensor()                                                  \
+                 .set_element_type(ov_Type.u8)                              \
+                 .set_layout(ov_Layout("NHWC"))
+        ppp_input.model().set_layout(ov_Layout("NCHW" if self.img_input_blob_format_NCHW else "NHWC"))
+        self.model = ppp.build()
+    
     def is_ready(self) :
         return self.async_queue.is_ready()
     
     def wait_all(self) :
         self.async_queue.wait_all()
     
+    # 非同期推論 ====================================================
+    # 結果は analyze_result で解析した後、
+    # set_result_callback で設定した関数に (params, 開始位置, 結果) で通知される
+    def set_result_callback(self, result_callback) :
+        self.result_callback = result_callback
+    
+    def callback(self, res, userdata) :
+        params, start, count, submit_time = userdata
+        
+        # 投入から完了までの時間(推論キューの待ちを含む)
+        profiler.record(f'{self.profile_name}/infer', submit_time, time.perf_counter(), count=count)
+        
+        with self.profile("analyze_result", count=count) :
+            if start is None :
+                # 単体の推論
+                result = self.analyze_result(res, params)
+            else :
+                # バッチ推論(画像毎の結果のリスト)
+                result = [self.analyze_result(res, params, i) for i in range(count)]
+        self.result_callback(params, start, result)
+    
+    def start_infer(self, feed_dict, params):
+        with self.profile("submit", count=1) :
+            self.async_queue.start_async(feed_dict, (params, None, 1, time.perf_counter()))
+    
+    # 複数画像をまとめて非同期推論
+    def start_infer_batch(self, images, params):
+        with self.profile("submit", count=len(images)) :
+            for start, count, feed_dict in self.pre_process_batch(images) :
+                self.async_queue.start_async(feed_dict, (params, start, count, time.perf_counter()))
+    
+    # プロファイラの区間 ("モデルのクラス名/stage" で計測する)
+    def profile(self, stage, **args) :
+        if not profiler.enabled :
+            return NULL_SPAN
+        return profiler.span(f'{self.profile_name}/{stage}', **args)
+    
+    # 同期推論 ======================================================
     def infer_sync(self, feed_dict, params):
         infer_request = self.async_queue[self.async_queue.get_idle_request_id()]
         infer_request.infer(feed_dict)
-        return self.analyze_result(infer_request, params)
+        result = self.analyze_result(infer_request, params)
+        return self.analyze_result_ordered([result])[0]
+    
+    # 複数画像をまとめて推論し、画像毎の結果のリストを返す
+    def infer_batch(self, images, params):
+        results = []
+        infer_request = self.async_queue[self.async_queue.get_idle_request_id()]
+        for start, count, feed_dict in self.pre_process_batch(images) :
+            infer_request.infer(feed_dict)
+            for i in range(count) :
+                results.append(self.analyze_result(infer_request, params, i))
+        return self.analyze_result_ordered(results)
+    
+    # フレーム順の解析 ==============================================
+    # analyze_result は推論完了順(非同期時は推論スレッド)で呼ばれるのに対し、
+    # こちらはフレーム番号順に、1フレーム分の結果のリストを受け取って呼ばれる。
+    # フレーム間で状態を持つ処理はこちらで行う(デフォルトは何もしない)
+    def analyze_result_ordered(self, results) :
+        return results
+    
+    # トラック毎の結果の統合 ========================================
+    # 同じトラックの前回の結果(prev_result)と今回の結果を統合する(時間方向の平滑化など)
+    # cascade_scheduler で結果をトラック毎にキャッシュする場合に、フレーム番号順に呼ばれる
+    # (デフォルトは今回の結果で置き換える)
+    def merge_track_result(self, prev_result, result) :
+        return result
+    
+    # 入力画像情報 =================================================
+    # 入力画像のサイズ毎に1回だけ計算する {レイヤ名 : 値}
+    def img_info(self, image_shape) :
+        key = image_shape[:2]
+        info = self.img_info_cache.get(key)
+        if info is None :
+            info = {}
+            if not self.img_info_blob_name_3 is None :      # 1x3のタイプ
+                info[self.img_info_blob_name_3] = np.array([[self.img_input_height, self.img_input_width, 1]])
+            if not self.img_info_blob_name_6 is None :      # 1x6のタイプ
+                info[self.img_info_blob_name_6] = np.array([[  self.img_input_height, 
+                                                               self.img_input_width, 
+                                                               self.img_input_width  / image_shape[1], 
+                                                               self.img_input_height / image_shape[0], 
+                                                               self.img_input_width  / image_shape[1], 
+                                                               self.img_input_height / image_shape[0]
+                                                           ]])
+            self.img_info_cache[key] = info
+        return info
+    
+    # 入力テンソルのビュー =========================================
+    # 推論リクエストの入力テンソルのメモリを直接参照する配列 (画像数, H, W, C)
+    # (可変長バッチの場合は画像数に合わせてテンソルのサイズを変更する)
+    def input_view(self, request_id, count) :
+        in_view = self.input_views[request_id]
+        if in_view is None or len(in_view) != count :
+            in_tensor = self.async_queue[request_id].get_tensor(self.img_input_blob_name)
+            if in_tensor.shape[0] != count :
+                in_tensor.shape = [count, self.img_input_height, self.img_input_width, self.img_input_colors]
+            in_view = in_tensor.data
+            self.input_views[request_id] = in_view
+        return in_view
+    
+    # 切り出し画像の入力サイズ =====================================
+    # 二次推論の切り出し画像を事前にリサイズして入力サイズが同じモデル同士で共有する場合のサイズ (幅, 高さ)
+    # 前処理組み込み時はモデル内でリサイズするのでNone
+    def crop_size(self) :
+        if self.ppp :
+            return None
+        return (self.img_input_width, self.img_input_height)
     
     # 前処理 =======================================================
+    # 前処理組み込み時以外は、次に推論を投入する推論リクエストの入力テンソルに直接書き込み、
+    # 空の feed_dict を返す(推論投入までに同じモデルに他の推論を投入しないこと)
     def pre_process(self, image) :
-        # 入力用フレームの作成
-        in_frame = cv2.resize(image, (self.img_input_width, self.img_input_height))     # リサイズ
-        if self.img_input_blob_format_NCHW :
-             in_frame = in_frame.transpose((2, 0, 1))                                       # HWC → CHW
-        in_frame = in_frame.reshape(self.img_input_blob_shape)                              # HWC → BHWC or CHW → BCHW
-        
-        feed_dict = {self.img_input_blob_name: in_frame}
-        if not self.img_info_blob_name_3 is None :      # 1x3のタイプ
-            feed_dict[self.img_info_blob_name_3] = np.array([[self.img_input_height, self.img_input_width, 1]])
-        if not self.img_info_blob_name_6 is None :      # 1x6のタイプ
-            feed_dict[self.img_info_blob_name_6] = np.array([[  self.img_input_height, 
-                                                                self.img_input_width, 
-                                                                self.img_input_width  / image.shape[1], 
-                                                                self.img_input_height / image.shape[0], 
-                                                                self.img_input_width  / image.shape[1], 
-                                                                self.img_input_height / image.shape[0]
-                                                            ]])
-        
-        return feed_dict
+        if self.ppp :
+            # 前処理はモデルに組み込み済みなので、画像をコピーせずにテンソルとして渡す
+            # (推論中に配列が解放されないように、推論キュー数+1個分の参照を保持しておく)
+            in_frame = np.ascontiguousarray(image[np.newaxis])                              # HWC → BHWC (連続した画像ならコピーしない)
+            self.input_refs.append(in_frame)
+            feed_dict = {self.img_input_blob_name: ov_Tensor(in_frame, shared_memory=True)}
+            feed_dict.update(self.img_info(image.shape))
+            return feed_dict
+        
+        # 次に使われる推論リクエスト(空きがなければここで待つ)
+        request_id = self.async_queue.get_idle_request_id()
+        request = self.async_queue[request_id]
+        
+        # 入力テンソルに直接リサイズ
+        in_view = self.input_view(request_id, 1)
+        cv2.resize(image, (self.img_input_width, self.img_input_height), dst=in_view[0])
+        
+        # 入力画像情報は入力画像のサイズが変わったときだけ書き込む
+        if self.img_info_keys[request_id] != image.shape[:2] :
+            for name, value in self.img_info(image.shape).items() :
+                request.get_tensor(name).data[:] = value
+            self.img_info_keys[request_id] = image.shape[:2]
+        
+        return {}
+    
+    # 複数画像の前処理 ============================================
+    # バッチサイズ毎に分割して(開始位置, 画像数, feed_dict)を返すジェネレータ
+    # 推論投入直前に前処理するように、1回分ずつ前処理して返す
+    # (前処理組み込み時に保持する入力画像の参照が推論キュー数+1個分なので。
+    #   それ以外は次に使われる推論リクエストの入力テンソルに書き込むので)
+    def pre_process_batch(self, images) :
+        if len(images) == 0 :
+            return                      # 推論する画像がない(可変長バッチでは分割数が0になるので先に抜ける)
+        if self.batch_size == 1 :
+            for i, image in enumerate(images) :
+                yield i, 1, self.pre_process(image)
+            return
+        
+        # 1回の推論で処理する画像数(可変長なら全画像)
+        chunk_size = self.batch_size if self.batch_size > 0 else len(images)
+        
+        for start in range(0, len(images), chunk_size) :
+            chunk = images[start : start + chunk_size]
+            if self.ppp :
+                # 前処理組み込み時は画像サイズを揃えるためのリサイズだけ行い、レイアウト変換はモデルで行う
+                in_frames = np.zeros((chunk_size, self.img_input_height, self.img_input_width, self.img_input_colors), dtype=np.uint8)
+                feed_dict = {self.img_input_blob_name: in_frames}
+            else :
+                # 次に使われる推論リクエストの入力テンソルに直接リサイズ
+                in_frames = self.input_view(self.async_queue.get_idle_request_id(), chunk_size)
+                feed_dict = {}
+            for i, image in enumerate(chunk) :
+                cv2.resize(image, (self.img_input_width, self.img_input_height), dst=in_frames[i])   # リサイズ
+            # 固定長の場合、余った部分は0にして推論する
+            in_frames[len(chunk):] = 0
+            yield start, len(chunk), feed_dict
     # ================================================================================
     
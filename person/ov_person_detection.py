@@ -15,8 +15,14 @@ from openvino.runtime import Core               as ov_Core
 # 自作モジュール
 from model.model_person_detect import model_person_detect
 from model.model_person_reid import model_person_reid
+from model.reid_index import REID_INDEX_TYPES
 from model.model_person_attr import model_person_attr
+from model.cascade_scheduler import cascade_scheduler
+from model.box_tracker import box_tracker, keyframe_selector
 from DispFrame import DispFrame, ImageSave, console_print
+from FrameCapture import FrameCapture
+from Profiler import profiler
+from ResultWriter import ResultWriter
 
 # コマンドラインパーサの構築 =====================================================
 def build_argparser():
@@ -33,6 +39,16 @@ def build_argparser():
                              "Required for CPU custom layers. \n"
                              "Absolute path to a shared library\n"
                              "with the kernels implementations.")
+    parser.add_argument("--ppp", action='store_true', 
+                        help="Optional.\n"
+                             "Embed resize and layout conversion into the model\n"
+                             "with OpenVINO PrePostProcessor\n"
+                             "(captured frames are passed to the model without copy)")
+    parser.add_argument("--capture_buffer", default=4, type=int, 
+                        help="Optional.\n"
+                             "Number of frames buffered by the capture thread\n"
+                             "(for camera input, the oldest frame is dropped when full)\n"
+                             "Specify 0 to capture in the main thread")
     
     person_args = parser.add_argument_group('person detect Options')
     person_args.add_argument("-m", "--model", required=True, type=str, 
@@ -45,9 +61,27 @@ def build_argparser():
                              "The demo will look for a suitable plugin \n"
                              "for device specified.\n"
                              "Default value is CPU")
+    person_args.add_argument("--queue_num", default=2, type=int, 
+                        help="Optional.\n"
+                             "Number of async infer queues")
     person_args.add_argument("-t_detect", "--threshold_detect", default=0.5, type=float, 
                         help="Optional.\n"
                              "Probability threshold for detections filtering")
+    person_args.add_argument("--detect_interval", default=1, type=int, 
+                        help="Optional.\n"
+                             "Run the detector every N frames and interpolate boxes\n"
+                             "of the frames in between with a Kalman/IoU tracker\n"
+                             "Default value is 1 (detect every frame)")
+    person_args.add_argument("--detect_motion", default=0.0, type=float, 
+                        help="Optional.\n"
+                             "Also run the detector when the mean difference (0-255)\n"
+                             "of the downscaled frame from the last detected frame\n"
+                             "exceeds this value (0 = disabled)")
+    person_args.add_argument("--track_refresh", default=0, type=int, 
+                        help="Optional.\n"
+                             "Track persons across frames and run reid/attributes\n"
+                             "only for new or re-acquired tracks and every N frames\n"
+                             "for the others (0 = run for every detection)")
      
     reid_args = parser.add_argument_group('person reidentification Options')
     reid_args.add_argument("-m_reid", "--model_reid", default=None, type=str, 
@@ -60,6 +94,40 @@ def build_argparser():
     reid_args.add_argument("-t_reid", "--threshold_reid", default=0.8, type=float, 
                         help="Optional.\n"
                              "Probability threshold for person reidentification")
+    reid_args.add_argument("-q_reid", "--queue_num_reid", default=2, type=int, 
+                        help="Optional.\n"
+                             "Number of async infer queues for person reidentification")
+    reid_args.add_argument("--reid_max_size", default=0, type=int, 
+                        help="Optional.\n"
+                             "Maximum number of identities in the reid gallery\n"
+                             "(least recently seen identity is evicted, 0 = unlimited)")
+    reid_args.add_argument("--reid_ttl", default=0, type=int, 
+                        help="Optional.\n"
+                             "Evict identities not seen for the specified number of frames\n"
+                             "(0 = never)")
+    reid_args.add_argument("--reid_ema", default=1.0, type=float, 
+                        help="Optional.\n"
+                             "Weight of the new vector when updating a matched identity\n"
+                             "(exponential moving average, 1.0 = replace with the latest)")
+    reid_args.add_argument("--reid_index", default="exact", choices=REID_INDEX_TYPES, 
+                        help="Optional.\n"
+                             "Search index for the reid gallery\n"
+                             "  exact : exact cosine search over all identities\n"
+                             "  ivf   : approximate search over nearest clusters\n"
+                             "Default value is exact")
+    reid_args.add_argument("--reid_nlist", default=64, type=int, 
+                        help="Optional.\n"
+                             "Number of clusters for ivf index")
+    reid_args.add_argument("--reid_nprobe", default=8, type=int, 
+                        help="Optional.\n"
+                             "Number of clusters searched per query for ivf index")
+    reid_args.add_argument("--reid_load", default=None, type=str, 
+                        help="Optional.\n"
+                             "Load the reid gallery from the specified directory\n"
+                             "(vectors are memory-mapped copy-on-write)")
+    reid_args.add_argument("--reid_save", default=None, type=str, 
+                        help="Optional.\n"
+                             "Save the reid gallery to the specified directory at exit")
     
     attr_args = parser.add_argument_group('person attributes Options')
     attr_args.add_argument("-m_attr", "--model_attr", default=None, type=str, 
@@ -72,14 +140,52 @@ def build_argparser():
     attr_args.add_argument("-t_attr", "--threshold_attr", default=0.5, type=float, 
                         help="Optional.\n"
                              "Probability threshold for person attributes")
+    attr_args.add_argument("-q_attr", "--queue_num_attr", default=2, type=int, 
+                        help="Optional.\n"
+                             "Number of async infer queues for person attributes")
+    attr_args.add_argument("--attr_refresh", default=0, type=int, 
+                        help="Optional.\n"
+                             "Cache attributes per track, re-evaluate them every N frames\n"
+                             "and judge them from the running mean of the raw indicators\n"
+                             "(0 = same as --track_refresh)")
     
     output_args = parser.add_argument_group('Output Options')
     output_args.add_argument("--save", default=None, type=str, 
                         help="Optional.\n"
                              "Save result to specified file")
+    output_args.add_argument("--save_queue", default=8, type=int, 
+                        help="Optional.\n"
+                             "Number of frames queued for the video writer thread\n"
+                             "(the main loop waits only when the queue is full)\n"
+                             "Specify 0 to write in the main thread")
+    output_args.add_argument("--save_overlay", default=None, type=str, 
+                        help="Optional.\n"
+                             "Save overlays (boxes, points, texts, etc.) of each frame\n"
+                             "to specified file in JSON Lines format without drawing")
+    output_args.add_argument("--results", default=None, type=str, 
+                        help="Optional.\n"
+                             "Save detection results of each frame to specified file\n"
+                             "(written by a background thread)")
+    output_args.add_argument("--results_format", default="binary", choices=ResultWriter.FORMATS, 
+                        help="Optional.\n"
+                             "Format of --results file\n"
+                             "  jsonl  : JSON Lines (1 frame per line)\n"
+                             "  binary : length-prefixed binary records\n"
+                             "Default value is binary")
     output_args.add_argument("--time", default=None, type=str, 
                         help="Optional.\n"
                              "Save time log to specified file")
+    output_args.add_argument("--profile", action='store_true', 
+                        help="Optional.\n"
+                             "Record per-stage spans and print p50/p90/p99 at exit")
+    output_args.add_argument("--profile_json", default=None, type=str, 
+                        help="Optional.\n"
+                             "Save profile summary and spans to specified JSON file\n"
+                             "(implies --profile)")
+    output_args.add_argument("--profile_trace", default=None, type=str, 
+                        help="Optional.\n"
+                             "Save spans to specified file in Chrome trace format\n"
+                             "(implies --profile)")
     output_args.add_argument("--log", default=None, type=str,  
                         help="Optional.\n"
                              "Save console log to specified file")
@@ -100,6 +206,55 @@ def main():
     # コマンドラインオプションの解析
     args = build_argparser().parse_args()
     
+    # queue数のチェック
+    for queue_option in ("queue_num", "queue_num_reid", "queue_num_attr") :
+        if getattr(args, queue_option) < 1 :
+            log.warning(f"{queue_option} option must be greater than or equal to 1. use default value(2)")
+            setattr(args, queue_option, 2)
+    
+    # reidギャラリ設定のチェック
+    if args.reid_max_size < 0 :
+        log.warning("reid_max_size option must be greater than or equal to 0. use default value(0)")
+        args.reid_max_size = 0
+    if args.reid_ttl < 0 :
+        log.warning("reid_ttl option must be greater than or equal to 0. use default value(0)")
+        args.reid_ttl = 0
+    if not 0.0 < args.reid_ema <= 1.0 :
+        log.warning("reid_ema option must be in (0.0, 1.0]. use default value(1.0)")
+        args.reid_ema = 1.0
+    if args.reid_nlist < 1 :
+        log.warning("reid_nlist option must be greater than or equal to 1. use default value(64)")
+        args.reid_nlist = 64
+    if args.reid_nprobe < 1 :
+        log.warning("reid_nprobe option must be greater than or equal to 1. use default value(8)")
+        args.reid_nprobe = 8
+    
+    # キャプチャバッファ数/保存キュー数のチェック
+    if args.capture_buffer < 0 :
+        log.warning("capture_buffer option must be greater than or equal to 0. use default value(4)")
+        args.capture_buffer = 4
+    if args.save_queue < 0 :
+        log.warning("save_queue option must be greater than or equal to 0. use default value(8)")
+        args.save_queue = 8
+    
+    # 検出間隔のチェック
+    if args.detect_interval < 1 :
+        log.warning("detect_interval option must be greater than or equal to 1. use default value(1)")
+        args.detect_interval = 1
+    if args.detect_motion < 0 :
+        log.warning("detect_motion option must be greater than or equal to 0. use default value(0.0)")
+        args.detect_motion = 0.0
+    if args.track_refresh < 0 :
+        log.warning("track_refresh option must be greater than or equal to 0. use default value(0)")
+        args.track_refresh = 0
+    if args.attr_refresh < 0 :
+        log.warning("attr_refresh option must be greater than or equal to 0. use default value(0)")
+        args.attr_refresh = 0
+    
+    # プロファイラの有効化
+    if args.profile or args.profile_json or args.profile_trace :
+        profiler.enable()
+    
     # 非表示設定
     no_disp = args.no_disp
     
@@ -117,7 +272,6 @@ def main():
         time_f = open(args.time, mode='w')
         print(f'command :          {" ".join(sys.argv)}', file=time_f)
         print(f'openVINO vertion : {ov_vession_str}', file=time_f)
-        print(f' frame_number, frame_time, preprocess_time, infer_time, postprocess_time', file=time_f)
 
     log_f = None
     if args.log :
@@ -135,16 +289,17 @@ def main():
         core.add_extension(args.cpu_extension)
     
     # キャプチャデバイス
-    cap = cv2.VideoCapture(input_file)
+    # カメラ入力なら古いフレームを破棄して最新のフレームを処理する
+    cap = FrameCapture(input_file, args.capture_buffer, drop=(input_file == 0))
     
     # 幅と高さを取得
-    img_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-    img_width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    img_height = cap.img_height
+    img_width = cap.img_width
     # フレームレート(1フレームの時間単位はミリ秒)の取得
-    org_frame_rate = int(cap.get(cv2.CAP_PROP_FPS))                 # オリジナルのフレームレート
-    org_frame_time = 1.0 / cap.get(cv2.CAP_PROP_FPS)                # オリジナルのフレーム時間
+    org_frame_rate = int(cap.frame_rate)                            # オリジナルのフレームレート
+    org_frame_time = 1.0 / cap.frame_rate                           # オリジナルのフレーム時間
     # フレーム数
-    all_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    all_frames = cap.frame_count
     all_frames = 1 if all_frames != -1 and all_frames < 0 else all_frames   # -1なら静止画
     
     # 画像保存インスタンスの作成
@@ -155,7 +310,9 @@ def main():
         if all_frames == 1 :
             img_save.set_jpeg(args.save)
         else :
-            img_save.create_writer(args.save, org_frame_rate)
+            img_save.create_writer(args.save, org_frame_rate, args.save_queue)
+    if args.save_overlay :
+        img_save.set_overlay(args.save_overlay)
     
     # 1フレーム表示後の待ち時間
     wait_key_time = 1
@@ -166,117 +323,204 @@ def main():
         wait_key_time = 0           # 永久待ち
     
     # モデルの作成
-    model_fd = model_person_detect(core, args.model, device=args.device, threshold=args.threshold_detect, clip_ratio=1.2, log_f=log_f)
+    model_fd = model_person_detect(core, args.model, device=args.device, threshold=args.threshold_detect, clip_ratio=1.2, queue_num=args.queue_num, log_f=log_f, ppp=args.ppp)
     
     model_reid = None
     model_attr = None
     
     if args.model_reid :
-        model_reid = model_person_reid(core, args.model_reid, device=args.device_reid, threshold=args.threshold_reid, log_f=log_f)
+        model_reid = model_person_reid(core, args.model_reid, device=args.device_reid, threshold=args.threshold_reid, queue_num=args.queue_num_reid, log_f=log_f, 
+                                       max_size=args.reid_max_size, ttl=args.reid_ttl, ema=args.reid_ema, 
+                                       index_type=args.reid_index, nlist=args.reid_nlist, nprobe=args.reid_nprobe, ppp=args.ppp)
+        if args.reid_load :
+            # 保存済みのギャラリを読み込む
+            model_reid.gallery.load(args.reid_load)
     
     if args.model_attr :
-        model_attr = model_person_attr(core, args.model_attr, device=args.device_attr, threshold=args.threshold_attr, log_f=log_f)
+        model_attr = model_person_attr(core, args.model_attr, device=args.device_attr, threshold=args.threshold_attr, queue_num=args.queue_num_attr, log_f=log_f, ppp=args.ppp)
+    
+    # 推論スケジューラの作成
+    # 検出結果に対する二次推論(reid, 属性)は結果格納キー毎のモデルで非同期に実行される
+    # reidベクトルの照合はフレーム番号順に行われる
+    # 検出しないフレームの検出枠は追跡で補間して二次推論を行う
+    # track_refresh/attr_refresh を指定すると二次推論は新しいトラックと一定フレーム毎だけ行う
+    refresh_interval = {"reid": args.track_refresh, "attr": args.attr_refresh if args.attr_refresh > 0 else args.track_refresh}
+    selector = keyframe_selector(args.detect_interval, args.detect_motion)
+    tracker  = None
+    if args.detect_interval > 1 or max(refresh_interval.values()) > 0 :
+        tracker = box_tracker()
+    scheduler = cascade_scheduler(model_fd, {"reid": model_reid, "attr": model_attr}, tracker, refresh_interval)
+    
+    # 検出結果の出力
+    result_writer = None
+    if args.results :
+        header = {"pipeline": "person", "command": " ".join(sys.argv), "input": args.input, 
+                  "width": img_width, "height": img_height}
+        if model_attr :
+            header["attributes"]     = model_attr.attr_names()
+            header["attr_threshold"] = model_attr.threshold
+        result_writer = ResultWriter(args.results, args.results_format, header)
+    
+    # 処理時間記録のヘッダ(結果をトラック毎にキャッシュする二次推論はヒット率と省略した推論数を追加)
+    if time_f :
+        time_header = ''.join(f', {key}_hit_ratio, {key}_saved' for key in scheduler.cached_keys())
+        print(f' frame_number, frame_time, preprocess_time, infer_time, postprocess_time, decode_time{time_header}', file=time_f)
     
     # 推論開始
     log.info("Starting inference...")
     print("To close the application, press 'CTRL+C' here or switch to the output window and press ESC key")
     
     # 現在のフレーム番号
-    frame_number = 1
+    infer_frame_number = 1      # 推論用フレーム番号
+    disp_frame_number  = 1      # 表示用フレーム番号
     
     # キャプチャフラグ
     capture_flag = True
     
+    # キャプチャスレッドの開始
+    cap.start()
+    
     # フレーム測定用タイマ
     prev_time = time.perf_counter()
     
     while True:
-        # 画像の前処理 =============================================================================
-        # 現在のフレーム番号表示
-        capture_time = time.perf_counter()
-        if frame_number == 1 :
-            first_capture_time = capture_time
-        capture_time = (capture_time - first_capture_time) * 1000
-        print(f'frame_number: {frame_number:5d} / {all_frames}', end='\r', flush=True)
-        if log_f :
-            console_print(log_f, f'frame_number: {frame_number:5d} / {all_frames}     @{capture_time:10.3f}')
+        if capture_flag and scheduler.is_ready() :
+            # 画像の前処理 =============================================================================
+            # 画像キャプチャ
+            with profiler.span("main/capture") :
+                frame = cap.read()          # キャプチャスレッドでキャプチャ済みのフレームを取り出す
+            if frame is None:
+                # キャプチャ失敗
+                capture_flag = False        # 次からキャプチャしない
+                # キューに残った結果を処理するまでループ継続
+                continue
+            image = frame.image
+            preprocess_start_time = time.perf_counter()                         # 前処理開始時刻        --------------------------------
             
-        # 画像キャプチャ
-        preprocess_start_time = time.perf_counter()                         # 前処理開始時刻        --------------------------------
-        ret, image = cap.read()    # フレームのキャプチャ
-        if not ret:
-            # キャプチャ失敗
-            break;
+            # 現在のフレーム番号表示
+            capture_time = frame.capture_time
+            if infer_frame_number == 1 :
+                first_capture_time = capture_time
+            capture_time = (capture_time - first_capture_time) * 1000
+            print(f'frame_number: {infer_frame_number:5d} / {all_frames}', end='\r', flush=True)
+            if log_f :
+                console_print(log_f, f'frame_number: {infer_frame_number:5d} / {all_frames}     @{capture_time:10.3f}')
+                
+            # 表示用フレームの作成
+            disp_frame = DispFrame(image, infer_frame_number, all_frames)
+            disp_frame.set_decode_time(frame.decode_time)
             
-        # 表示用フレームの作成
-        disp_frame = DispFrame(image, frame_number, all_frames)
-        
-        # 画像キャプチャと表示/入力用画像を作成
-        feed_dict = model_fd.pre_process(image)
-        disp_frame.start_preprocess(preprocess_start_time)
-        disp_frame.end_preprocess()                                 # 前処理終了時刻        --------------------------------
-        
-        disp_frame.start_infer()                                    # 推論処理開始時刻      --------------------------------
-        results = model_fd.infer_sync(feed_dict, (image, ))
-        
-        for result in results :
-            if model_reid :
-                feed_dict = model_reid.pre_process(result["image"])
-                reid_result = model_reid.infer_sync(feed_dict, None)
-                result["reid"] = reid_result
+            # 画像キャプチャと表示/入力用画像を作成
+            keyframe = (tracker is None) or selector.is_keyframe(image)
+            if keyframe :
+                feed_dict = model_fd.pre_process(image)
+            disp_frame.start_preprocess(preprocess_start_time)
+            disp_frame.end_preprocess()                                 # 前処理終了時刻        --------------------------------
             
-            if model_attr :
-                feed_dict = model_attr.pre_process(result["image"])
-                attr_result = model_attr.infer_sync(feed_dict, None)
-                result["attr"] = attr_result
+            disp_frame.start_infer()                                    # 推論処理開始時刻      --------------------------------
+            if keyframe :
+                scheduler.start_infer(feed_dict, disp_frame, image)
+            else :
+                scheduler.skip_detect(disp_frame, image)                # 検出しない
             
-        disp_frame.end_infer()                                      # 推論処理開始時刻      --------------------------------
-
-        # 検出結果の解析 =============================================================================
-        disp_frame.start_postprocess()                              # 後処理開始時刻            --------------------------------
+            # フレーム番号更新
+            infer_frame_number += 1
         
-        for result in results :
-            model_fd.post_process(disp_frame, result)
+        # 推論結果待ち =============================================================================
+        # 検出が終わったフレームの二次推論もここで投入される
+        # (結果が出たときだけ区間を記録する)
+        infer_rst = profiler.poll("main/get_result", scheduler.get_infer_result, disp_frame_number, frame=disp_frame_number)   # まだ結果が出てなければNoneが返る
+        if infer_rst :
+            disp_frame = infer_rst["disp_frame"]
+            results    = infer_rst["result"]
+            disp_frame.end_infer()                                      # 推論処理終了時刻      --------------------------------
+            
+            # 検出結果の解析 =============================================================================
+            disp_frame.start_postprocess()                              # 後処理開始時刻            --------------------------------
+            
+            for i, result in enumerate(results) :
+                with model_fd.profile("post_process", frame=disp_frame.frame_number, index=i) :
+                    model_fd.post_process(disp_frame, result)
+                
+                if model_reid :
+                    with model_reid.profile("post_process", frame=disp_frame.frame_number, index=i) :
+                        model_reid.post_process(disp_frame, result["reid"], result.pt1_ex, result.pt2_ex)
+                
+                if model_attr :
+                    with model_attr.profile("post_process", frame=disp_frame.frame_number, index=i) :
+                        model_attr.post_process(disp_frame, result["attr"], result.pt1_ex, result.pt2_ex)
+            
+            # 検出結果の出力(列の作成だけ行い、変換と書き込みは書き込みスレッドで行う)
+            if result_writer :
+                columns = model_fd.result_columns(results)
+                for key, model in (("reid", model_reid), ("attr", model_attr)) :
+                    if model :
+                        columns.update(model.result_columns(results, key))
+                result_writer.write(disp_frame.frame_number, columns)
             
+            disp_frame.end_postprocess()                                # 後処理終了時刻            --------------------------------
+            
+            # フレーム処理時間を保存
+            cur_time = time.perf_counter()                              # 現在のフレーム処理完了時刻
+            frame_time = cur_time - prev_time                           # 1フレームの処理時間
+            disp_frame.set_frame_time(frame_time)
+            prev_time = cur_time
+            
+            # 結果の表示 =============================================================================
+            # 測定データの表示
             if model_reid :
-                model_reid.post_process(disp_frame, result["reid"], result["pt1_ex"], result["pt2_ex"])
+                disp_frame.add_status(model_reid.gallery_status())      # reidギャラリのサイズと照合時間
+            if args.detect_interval > 1 :
+                disp_frame.add_status(selector.selector_status())       # 検出モデルの稼働率
+            for key in scheduler.cached_keys() :
+                disp_frame.add_status(scheduler.cache_status(key))      # キャッシュのヒット率
+                ratio, saved = scheduler.cache_stats(key)
+                disp_frame.add_time_data(f'{ratio:.1f}', saved)
+            disp_frame.disp_status()
             
-            if model_attr :
-                model_attr.post_process(disp_frame, result["attr"], result["pt1_ex"], result["pt2_ex"])
+            # 処理時間記録
+            disp_frame.write_time_data(time_f)
             
-        disp_frame.end_postprocess()                                # 後処理終了時刻            --------------------------------
-        
-        # フレーム処理時間を保存
-        cur_time = time.perf_counter()                              # 現在のフレーム処理完了時刻
-        frame_time = cur_time - prev_time                           # 1フレームの処理時間
-        disp_frame.set_frame_time(frame_time)
-        prev_time = cur_time
-        
-        # 結果の表示 =============================================================================
-        # 測定データの表示
-        disp_frame.disp_status()
-        
-        # 処理時間記録
-        disp_frame.write_time_data(time_f)
+            # 画面表示
+            if not no_disp :
+                disp_frame.disp_image()        # 表示
+            
+            # 画像の保存
+            # 保存が設定されているか否か、MPEGかJPEGかはメソッド内でチェック
+            img_save.write_image(disp_frame)
+            
+            # 表示フレーム更新
+            disp_frame_number += 1
+            
+            # 最後のフレームチェック
+            if not capture_flag and (disp_frame_number >= infer_frame_number) :
+                # 最後のフレームを表示した
+                break;
         
-        # 画面表示
+        # キー入力取得(非表示のときはウィンドウがないのでキー入力も待たない)
         if not no_disp :
-            disp_frame.disp_image()        # 表示
-        
-        # 画像の保存
-        # 保存が設定されているか否か、MPEGかJPEGかはメソッド内でチェック
-        img_save.write_image(disp_frame)
-        
-        # キー入力取得
-        key = cv2.waitKey(wait_key_time)
-        if key == 27:
-            # ESCキー
-            break
-        
-        # フレーム番号更新
-        frame_number += 1
+            with profiler.span("main/wait_key") :
+                key = cv2.waitKey(wait_key_time)
+            if key == 27:
+                # ESCキー
+                break
         
+    # キュー内の残りのデータが処理されるのを待つ(これをやらないと中断時にプログラムが終了しない)
+    scheduler.wait_all()
+    
+    # 検出モデルの稼働率
+    if args.detect_interval > 1 :
+        console_print(log_f, selector.selector_status(), True)
+    for key in scheduler.cached_keys() :
+        console_print(log_f, scheduler.cache_status(key), True)
+    
+    # reidギャラリの保存
+    if model_reid and args.reid_save :
+        model_reid.gallery.save(args.reid_save)
+    
     # 後片付け
+    cap.release()
+    
     if time_f :
         time_f.close()
     
@@ -286,8 +530,22 @@ def main():
     # 保存が設定されていか否かはメソッド内でチェック
     img_save.release_writer()
     
+    # 検出結果の出力ファイルを閉じる(書き込みスレッドの終了を待つ)
+    if result_writer :
+        result_writer.close()
+    
+    # プロファイル結果の出力(書き込みスレッドの終了後)
+    if profiler.enabled :
+        for line in profiler.summary_lines() :
+            print(line)
+        if args.profile_json :
+            profiler.save_json(args.profile_json)
+        if args.profile_trace :
+            profiler.save_chrome_trace(args.profile_trace)
+    
     # 表示ウィンドウを破棄
-    cv2.destroyAllWindows()
+    if not no_disp :
+        cv2.destroyAllWindows()
 # ================================================================================
 
 if __name__ == '__main__':
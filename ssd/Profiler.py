@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+import sys
+import os
+import time
+import json
+import threading
+import contextlib
+import collections
+import logging as log
+import numpy as np
+
+# 処理区間の計測(プロファイラ) ====================================================
+# 処理区間(span)毎に区間名、スレッド、開始/終了時刻と引数(フレーム番号など)を記録し、
+#   ・区間名毎の処理時間の分布(p50/p90/p99)
+#   ・JSON(区間名毎の集計と直近の区間の記録)
+#   ・Chrome trace形式(chrome://tracing や https://ui.perfetto.dev で表示できる。直近の区間のみ)
+# で出力する。
+# 長時間動かしてもメモリが増え続けないように、区間名毎には回数/合計/最大と直近 SAMPLE_SIZE 個の処理時間
+# (p50/p90/p99 はここから計算する)だけを保持し、区間の記録は直近 MAX_SPANS 個だけ残す(リングバッファ)。
+# 区間名は "モデル名/処理名" のように "/" で階層を表し、同じスレッドの区間は時刻で入れ子になる。
+# enable するまでは何も記録しない(span は何もしないコンテキストマネージャを返す)。
+# 各モジュールからはモジュール変数の profiler を使う。
+class Profiler() :
+    MAX_SPANS   = 50000             # 出力用に残す区間の記録の数
+    SAMPLE_SIZE = 10000             # 区間名毎にパーセンタイルの計算用に残す処理時間の数
+    
+    def __init__(self) :
+        self.enabled     = False
+        self.origin      = time.perf_counter()
+        self.lock        = threading.Lock()
+        self.spans       = collections.deque(maxlen=self.MAX_SPANS)    # 直近の区間 [(区間名, スレッドID, 開始時刻, 終了時刻, 引数)]
+        self.stats       = {}           # 区間名毎の集計 {区間名 : [回数, 合計時間, 最大時間, 直近の処理時間(deque)]} (時間は秒)
+        self.poll_counts = {}           # poll の区間名毎の結果が出るまでの取り出し回数
+        
+    def enable(self) :
+        self.enabled = True
+        self.origin  = time.perf_counter()
+        
+    # 区間の計測 (with で使う。args は区間の引数)
+    def span(self, name, **args) :
+        if not self.enabled :
+            return NULL_SPAN
+        return ProfileSpan(self, name, args)
+        
+    # 結果が出るまで繰り返す取り出しの計測
+    # func(*func_args) の戻り値が偽(まだ結果が出ていない)なら記録せず、結果が出たときだけ区間を記録する
+    # (ビジーループで毎回記録すると区間が大量に増えるため)。args の polls はそれまでの取り出し回数
+    def poll(self, name, func, *func_args, **args) :
+        if not self.enabled :
+            return func(*func_args)
+        start_time = time.perf_counter()
+        result = func(*func_args)
+        polls = self.poll_counts.get(name, 0) + 1
+        if result :
+            self.record(name, start_time, time.perf_counter(), polls=polls, **args)
+            polls = 0
+        self.poll_counts[name] = polls
+        return result
+        
+    # 計測済みの区間の記録 (開始/終了時刻は time.perf_counter() の値)
+    # 推論スレッドなどからも呼ばれるので集計はロックして更新する
+    def record(self, name, start_time, end_time, **args) :
+        if self.enabled :
+            duration = end_time - start_time
+            with self.lock :
+                self.spans.append((name, threading.get_ident(), start_time, end_time, args))
+                stat = self.stats.get(name)
+                if stat is None :
+                    stat = [0, 0.0, 0.0, collections.deque(maxlen=self.SAMPLE_SIZE)]
+                    self.stats[name] = stat
+                stat[0] += 1
+                stat[1] += duration
+                stat[2]  = max(stat[2], duration)
+                stat[3].append(duration)
+                
+    # 区間名毎の集計 (時間はmsec単位。p50/p90/p99 は直近 SAMPLE_SIZE 個から計算)
+    # 戻り値 : {区間名 : {"count", "total", "mean", "p50", "p90", "p99", "max"}} (区間名順)
+    def summary(self) :
+        with self.lock :
+            stats = {name: (count, total, max_time, list(samples)) for name, (count, total, max_time, samples) in self.stats.items()}
+        summary = {}
+        for name in sorted(stats.keys()) :
+            count, total, max_time, samples = stats[name]
+            p50, p90, p99 = np.percentile(np.array(samples) * 1000, (50, 90, 99))     # msec単位に変換
+            summary[name] = {"count": count, "total": total * 1000, "mean": total / count * 1000,
+                             "p50": float(p50), "p90": float(p90), "p99": float(p99), "max": max_time * 1000}
+        return summary
+        
+    # 出力用の直近の区間の記録
+    def recent_spans(self) :
+        with self.lock :
+            return list(self.spans)
+        
+    # 集計結果の文字列のリスト
+    def summary_lines(self) :
+        summary = self.summary()
+        width = max([len(name) for name in summary.keys()] + [len("span")])
+        lines = [f'{"span":{width}} {"count":>7} {"total[ms]":>11} {"mean":>9} {"p50":>9} {"p90":>9} {"p99":>9} {"max":>9}']
+        for name, s in summary.items() :
+            lines.append(f'{name:{width}} {s["count"]:7d} {s["total"]:11.3f} {s["mean"]:9.3f} {s["p50"]:9.3f} {s["p90"]:9.3f} {s["p99"]:9.3f} {s["max"]:9.3f}')
+        return lines
+        
+    # JSONで保存 (区間名毎の集計と直近の区間。時刻は enable してからのmsec)
+    def save_json(self, filename) :
+        spans = [{"name": name, "thread": thread_id, "start": (start_time - self.origin) * 1000, "duration": (end_time - start_time) * 1000, "args": args}
+                 for name, thread_id, start_time, end_time, args in self.recent_spans()]
+        with open(filename, mode='w') as f :
+            json.dump({"summary": self.summary(), "spans": spans}, f, indent=1)
+        log.info(f'profile saved : {filename}')
+        
+    # Chrome trace形式で保存 (直近の区間の完了イベント "X"、時刻はusec)
+    def save_chrome_trace(self, filename) :
+        pid = os.getpid()
+        events = [{"name": name, "cat": name.split("/")[0], "ph": "X", "pid": pid, "tid": thread_id,
+                   "ts": (start_time - self.origin) * 1e6, "dur": (end_time - start_time) * 1e6, "args": args}
+                  for name, thread_id, start_time, end_time, args in self.recent_spans()]
+        with open(filename, mode='w') as f :
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+        log.info(f'trace saved : {filename}')
+# ================================================================================
+
+# 計測中の区間 ===================================================================
+class ProfileSpan() :
+    __slots__ = ("profiler", "name", "args", "start_time")
+    
+    def __init__(self, profiler, name, args) :
+        self.profiler = profiler
+        self.name     = name
+        self.args     = args
+        
+    def __enter__(self) :
+        self.start_time = time.perf_counter()
+        return self
+        
+    def __exit__(self, exc_type, exc_value, traceback) :
+        self.profiler.record(self.name, self.start_time, time.perf_counter(), **self.args)
+        return False
+# ================================================================================
+
+# 無効時の区間(何もしない)
+NULL_SPAN = contextlib.nullcontext()
+
+# 全モジュールで共有するプロファイラ
+profiler = Profiler()
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+import sys
+import os
+import time
+import logging as log
+from argparse import ArgumentParser, SUPPRESS, RawTextHelpFormatter
+import cv2
+import numpy as np
+
+# openVINOモジュール
+from openvino.runtime import Core               as ov_Core
+
+# 自作モジュール
+from model.model_ssd_detect import model_ssd_detect
+from model.box_tracker import box_tracker, keyframe_selector
+
+# 検出のスキップ(--detect_interval / --detect_motion)のベンチマーク
+# 全フレームの検出結果を基準として、検出をスキップして追跡で補間した結果の
+# 検出モデルの稼働率(duty)と精度(基準の検出結果との一致度)を比較する
+# --speeds を指定すると、動画と検出モデルの代わりに指定の速さ(画素/フレーム)で動く検出枠の合成データで比較する
+
+# コマンドラインパーサの構築 =====================================================
+def build_argparser():
+    parser = ArgumentParser(add_help=False, formatter_class=RawTextHelpFormatter)
+    parser.add_argument('-h', '--help', action='help', default=SUPPRESS,
+                        help='Show this help message and exit.')
+    parser.add_argument("-i", "--input", nargs='+', type=str,
+                        default=[os.path.join(os.path.dirname(__file__), "..", "images", "testvideo3.mp4")],
+                        help="Optional.\n"
+                             "Paths to video files\n"
+                             "Default is ../images/testvideo3.mp4")
+    parser.add_argument("-m", "--model", default=None, type=str,
+                        help="Required (unless --speeds is specified).\n"
+                             "Path to an .xml file with a trained model.")
+    parser.add_argument("--speeds", default=None, type=float, nargs='+',
+                        help="Optional.\n"
+                             "Speeds in pixels per frame of synthetic moving boxes\n"
+                             "(compare with synthetic detections instead of -i/-m)")
+    parser.add_argument("-d", "--device", default="CPU", type=str,
+                        help="Optional.\n"
+                             "Specify the target device to infer on; \n"
+                             "CPU, GPU, FPGA, HDDL or MYRIAD is acceptable. \n"
+                             "The demo will look for a suitable plugin \n"
+                             "for device specified.\n"
+                             "Default value is CPU")
+    parser.add_argument("-t_detect", "--threshold_detect", default=0.5, type=float,
+                        help="Optional.\n"
+                             "Probability threshold for detections filtering")
+    parser.add_argument("--intervals", default=[1, 2, 3, 5, 10], type=int, nargs='+',
+                        help="Optional.\n"
+                             "Detection intervals to compare")
+    parser.add_argument("--motions", default=[0.0], type=float, nargs='+',
+                        help="Optional.\n"
+                             "Motion thresholds to compare (0 = disabled)")
+    parser.add_argument("--iou", default=0.5, type=float,
+                        help="Optional.\n"
+                             "IoU threshold to count a box as matching the full-rate detection")
+    return parser
+# ================================================================================
+
+# 検出結果の解析に必要なフレームの情報(DispFrameの代わり) =======================
+class BenchFrame() :
+    def __init__(self, image, frame_number) :
+        self.img_height   = image.shape[0]
+        self.img_width    = image.shape[1]
+        self.frame_number = frame_number
+# ================================================================================
+
+# 全フレームの検出 ===============================================================
+# 戻り値 : (フレーム毎の (検出枠, クラスID, confidence) のリスト, 動き検出用の縮小画像のリスト, 1フレームの検出時間(msec), 画像サイズ(幅, 高さ))
+def detect_all(model, input_file) :
+    cap = cv2.VideoCapture(input_file)
+    detections = []
+    thumbs     = []
+    detect_time = 0
+    image_size  = None
+    while True :
+        ret, image = cap.read()
+        if not ret :
+            break
+        image_size = (image.shape[1], image.shape[0])
+        frame = BenchFrame(image, len(detections) + 1)
+        start = time.perf_counter()
+        model.start_infer(model.pre_process(image), (frame, ))
+        model.wait_all()
+        results = model.get_infer_result(frame.frame_number)["result"]
+        detect_time += time.perf_counter() - start
+        
+        unpacked = [model.unpack_result(result) for result in results]
+        boxes    = np.array([(*pt1, *pt2) for _, _, _, pt1, pt2 in unpacked], dtype=np.float64).reshape(-1, 4)
+        labels   = np.array([class_id for class_id, _, _, _, _ in unpacked], dtype=int)
+        confs    = np.array([conf for _, _, conf, _, _ in unpacked], dtype=np.float64)
+        detections.append((boxes, labels, confs))
+        thumbs.append(keyframe_selector.thumbnail(image))
+    cap.release()
+    return detections, thumbs, detect_time / max(len(detections), 1) * 1000, image_size      # msec単位に変換
+# ================================================================================
+
+# 合成データの検出 ===============================================================
+# 画像内を等速で動いて端で跳ね返る検出枠(一辺30～60画素)を全フレームの検出結果とする
+# (検出をスキップすると、跳ね返る前の速度で予測した検出枠は画像の外に出ることがある)
+# 戻り値 : detect_all と同じ (検出時間は0)
+def synthetic_detections(speed, frames=300, num_objects=8, width=640, height=480, seed=0) :
+    rng    = np.random.default_rng(seed)
+    size   = rng.uniform(30, 60, (num_objects, 2))
+    pos    = rng.random((num_objects, 2)) * ((width, height) - size)
+    angle  = rng.uniform(0, 2 * np.pi, num_objects)
+    vel    = np.stack((np.cos(angle), np.sin(angle)), axis=1) * speed
+    labels = rng.integers(1, 4, num_objects)
+    detections = []
+    thumbs     = []
+    for _ in range(frames) :
+        boxes = np.hstack((pos, pos + size))
+        detections.append((boxes, labels, np.full(num_objects, 0.9)))
+        image = np.zeros((height, width, 3), dtype=np.uint8)
+        for x1, y1, x2, y2 in boxes.astype(int).tolist() :
+            cv2.rectangle(image, (x1, y1), (x2, y2), (255, 255, 255), -1)
+        thumbs.append(keyframe_selector.thumbnail(image))
+        
+        # 移動(画像の端で跳ね返る)
+        pos = pos + vel
+        limit = (width, height) - size
+        bounce = (pos < 0) | (pos > limit)
+        vel[bounce] *= -1
+        pos = np.clip(pos, 0, limit)
+    return detections, thumbs, 0, (width, height)
+# ================================================================================
+
+# 検出のスキップの再現 ===========================================================
+# 予測した検出枠は画像の範囲に収めて取り出し、空の検出枠がないことを確認する
+# 戻り値 : (稼働率, 適合率, 再現率, 一致した検出枠の平均IoU, 1フレームの追跡時間(msec))
+def simulate(detections, thumbs, image_size, interval, motion, iou_threshold) :
+    selector = keyframe_selector(interval, motion)
+    tracker  = box_tracker()
+    tp = fp = fn = 0
+    iou_total = 0
+    track_time = 0
+    for (boxes, labels, confs), thumb in zip(detections, thumbs) :
+        start = time.perf_counter()
+        tracker.predict()
+        if selector.select(thumb if motion > 0 else None) :
+            tracker.update(boxes, labels, confs)
+            track_time += time.perf_counter() - start
+            tp += len(boxes)                # 検出したフレームは基準と同じ
+            iou_total += len(boxes)
+            continue
+        pred_boxes, _, pred_labels, _ = tracker.tracks(image_size)
+        track_time += time.perf_counter() - start
+        int_boxes = pred_boxes.astype(int)
+        assert ((int_boxes[:, 2:] > int_boxes[:, :2]) & (int_boxes[:, :2] >= 0) & (int_boxes[:, 2:] <= image_size)).all(), "predicted box is empty or outside the image"
+        
+        # 基準の検出結果と同じクラスでIoUの大きい組から対応付ける
+        iou = box_tracker.iou_matrix(pred_boxes, boxes)
+        iou[pred_labels[:, None] != labels[None, :]] = 0
+        used_pred = np.zeros(len(pred_boxes), dtype=bool)
+        used_ref  = np.zeros(len(boxes), dtype=bool)
+        for flat in np.argsort(-iou, axis=None, kind="stable") :
+            p, r = divmod(int(flat), len(boxes))
+            if iou[p, r] < iou_threshold :
+                break
+            if used_pred[p] or used_ref[r] :
+                continue
+            used_pred[p] = used_ref[r] = True
+            iou_total += iou[p, r]
+        tp += int(used_ref.sum())
+        fp += int((~used_pred).sum())
+        fn += int((~used_ref).sum())
+        
+    precision = tp / (tp + fp) if tp + fp > 0 else 1.0
+    recall    = tp / (tp + fn) if tp + fn > 0 else 1.0
+    mean_iou  = iou_total / tp if tp > 0 else 0
+    return selector.duty_cycle(), precision, recall, mean_iou, track_time / max(len(detections), 1) * 1000
+# ================================================================================
+
+# メイン処理 =====================================================================
+def main():
+    log.basicConfig(format="[ %(levelname)s ] %(message)s", level=log.INFO, stream=sys.stdout)
+    
+    # コマンドラインオプションの解析
+    args = build_argparser().parse_args()
+    
+    if args.speeds :
+        # 合成データ
+        inputs = [(f'synthetic (speed {speed} px/frame)', synthetic_detections(speed)) for speed in args.speeds]
+    else :
+        assert args.model, "-m is required unless --speeds is specified"
+        core = ov_Core()
+        model = model_ssd_detect(core, args.model, device=args.device, prob_threshold=args.threshold_detect, queue_num=1)
+        inputs = []
+        for input_file in args.input :
+            assert os.path.isfile(input_file), f"Specified input file doesn't exist : {input_file}"
+            inputs.append((input_file, detect_all(model, input_file)))
+    
+    for input_name, (detections, thumbs, detect_time, image_size) in inputs :
+        print(f'input : {input_name}   frames : {len(detections)}   detect : {detect_time:.3f} ms/frame   boxes : {sum(len(d[0]) for d in detections)}')
+        print(f'interval, motion,  duty[%], precision, recall,    F1, mean IoU, track[ms], detect+track[ms]')
+        for motion in args.motions :
+            for interval in args.intervals :
+                duty, precision, recall, mean_iou, track_time = simulate(detections, thumbs, image_size, interval, motion, args.iou)
+                f1 = 2 * precision * recall / (precision + recall) if precision + recall > 0 else 0
+                print(f'{interval:8d}, {motion:6.1f}, {duty * 100:8.1f}, {precision:9.3f}, {recall:6.3f}, {f1:5.3f}, {mean_iou:8.3f}, {track_time:9.3f}, {detect_time * duty + track_time:16.3f}')
+        print()
+# ================================================================================
+
+if __name__ == '__main__':
+    sys.exit(main() or 0)
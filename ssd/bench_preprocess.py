@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+import sys
+import os
+import time
+import tracemalloc
+import logging as log
+from argparse import ArgumentParser, SUPPRESS, RawTextHelpFormatter
+import cv2
+import numpy as np
+
+# openVINOモジュール
+from openvino.runtime import Core               as ov_Core
+
+# 自作モジュール
+from model.model_ssd_detect import model_ssd_detect
+
+# async_model_base.pre_process の前処理のベンチマーク
+# (推論は行わず、前処理の時間と tracemalloc で測定した1フレームあたりのメモリ確保量を測定する)
+# 推論リクエストの入力テンソルに直接書き込む前処理(prealloc)が
+# フレーム毎にメモリを確保していないこと(--limit 以下であること)を確認する
+
+# コマンドラインパーサの構築 =====================================================
+def build_argparser():
+    parser = ArgumentParser(add_help=False, formatter_class=RawTextHelpFormatter)
+    parser.add_argument('-h', '--help', action='help', default=SUPPRESS,
+                        help='Show this help message and exit.')
+    parser.add_argument("-m", "--model", required=True, type=str,
+                        help="Required.\n"
+                             "Path to an .xml file with a trained model.")
+    parser.add_argument("-d", "--device", default="CPU", type=str,
+                        help="Optional.\n"
+                             "Specify the target device to infer on; \n"
+                             "CPU, GPU, FPGA, HDDL or MYRIAD is acceptable. \n"
+                             "The demo will look for a suitable plugin \n"
+                             "for device specified.\n"
+                             "Default value is CPU")
+    parser.add_argument("--repeat", default=500, type=int,
+                        help="Optional.\n"
+                             "Number of pre_process calls per measurement")
+    parser.add_argument("--width", default=1920, type=int,
+                        help="Optional.\n"
+                             "Image width")
+    parser.add_argument("--height", default=1080, type=int,
+                        help="Optional.\n"
+                             "Image height")
+    parser.add_argument("--limit", default=1024, type=int,
+                        help="Optional.\n"
+                             "Allowed allocation per frame in bytes for prealloc")
+    return parser
+# ================================================================================
+
+# 従来の前処理(フレーム毎に入力用の配列と feed_dict を作成する) ================
+def pre_process_numpy(model, image) :
+    in_frame = cv2.resize(image, (model.img_input_width, model.img_input_height))     # リサイズ
+    if model.img_input_blob_format_NCHW :
+        in_frame = in_frame.transpose((2, 0, 1))                                        # HWC → CHW
+    in_frame = in_frame.reshape(model.img_input_blob_shape)                             # HWC → BHWC or CHW → BCHW
+    feed_dict = {model.img_input_blob_name: in_frame}
+    if not model.img_info_blob_name_3 is None :     # 1x3のタイプ
+        feed_dict[model.img_info_blob_name_3] = np.array([[model.img_input_height, model.img_input_width, 1]])
+    if not model.img_info_blob_name_6 is None :     # 1x6のタイプ
+        feed_dict[model.img_info_blob_name_6] = np.array([[ model.img_input_height,
+                                                            model.img_input_width,
+                                                            model.img_input_width  / image.shape[1],
+                                                            model.img_input_height / image.shape[0],
+                                                            model.img_input_width  / image.shape[1],
+                                                            model.img_input_height / image.shape[0]
+                                                        ]])
+    return feed_dict
+# ================================================================================
+
+# 測定 ===========================================================================
+# 戻り値 : (1フレームあたりの前処理時間(usec), 1フレームあたりのメモリ確保量(byte))
+def measure(pre_process, image, repeat) :
+    # 初回の入力テンソルのビューや入力画像情報の作成は除外する
+    pre_process(image)
+
+    # 処理時間
+    start = time.perf_counter()
+    for _ in range(repeat) :
+        pre_process(image)
+    pre_time = (time.perf_counter() - start) / repeat * 1000 * 1000    # usec単位に変換
+
+    # メモリ確保量(1フレームの処理中の最大確保量)
+    tracemalloc.start()
+    base, _ = tracemalloc.get_traced_memory()
+    peak = 0
+    for _ in range(repeat) :
+        tracemalloc.reset_peak()
+        feed_dict = pre_process(image)
+        del feed_dict
+        peak = max(peak, tracemalloc.get_traced_memory()[1] - base)
+    tracemalloc.stop()
+    return pre_time, peak
+# ================================================================================
+
+# メイン処理 =====================================================================
+def main():
+    log.basicConfig(format="[ %(levelname)s ] %(message)s", level=log.INFO, stream=sys.stdout)
+
+    # コマンドラインオプションの解析
+    args = build_argparser().parse_args()
+
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 256, (args.height, args.width, 3), dtype=np.uint8)
+
+    core = ov_Core()
+    model = model_ssd_detect(core, args.model, device=args.device)
+    model_ppp = model_ssd_detect(core, args.model, device=args.device, ppp=True)
+
+    input_size = model.img_input_width * model.img_input_height * model.img_input_colors
+    print(f'image size : {args.width}x{args.height}   input size : {model.img_input_width}x{model.img_input_height}   repeat : {args.repeat}')
+    print(f'    mode, pre_process[us], alloc/frame[byte]')
+    ok = True
+    for name, pre_process in (  ("numpy",    lambda image : pre_process_numpy(model, image)),
+                                ("ppp",      model_ppp.pre_process),
+                                ("prealloc", model.pre_process)) :
+        pre_time, alloc = measure(pre_process, image, args.repeat)
+        print(f'{name:>8s}, {pre_time:15.2f}, {alloc:17d}')
+        if name == "prealloc" and alloc > args.limit :
+            ok = False
+
+    print(f'prealloc allocation per frame <= {args.limit} bytes (input tensor : {input_size} bytes) : {"OK" if ok else "NG"}')
+    return 0 if ok else 1
+# ================================================================================
+
+if __name__ == '__main__':
+    sys.exit(main() or 0)
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+import sys
+import os
+import time
+import logging as log
+from argparse import ArgumentParser, SUPPRESS, RawTextHelpFormatter
+import numpy as np
+
+# 自作モジュール
+from model.model_ssd_detect import model_ssd_detect
+
+# model_ssd_detect.analyze_result のデコード処理のマイクロベンチマーク
+# (推論は行わず、ダミーの出力テンソルをデコードする時間だけを測定する)
+
+# 推論結果のダミー ===============================================================
+class DummyTensor() :
+    def __init__(self, data) :
+        self.data = data
+
+class DummyRequest() :
+    def __init__(self, tensors) :
+        self.tensors = tensors
+
+    def get_tensor(self, name) :
+        return self.tensors[name]
+
+class DummyFrame() :
+    def __init__(self, img_width, img_height) :
+        self.img_width  = img_width
+        self.img_height = img_height
+# ================================================================================
+
+# コマンドラインパーサの構築 =====================================================
+def build_argparser():
+    parser = ArgumentParser(add_help=False, formatter_class=RawTextHelpFormatter)
+    parser.add_argument('-h', '--help', action='help', default=SUPPRESS,
+                        help='Show this help message and exit.')
+    parser.add_argument("--rows", default=[100, 200], type=int, nargs='+',
+                        help="Optional.\n"
+                             "Number of rows of the output tensor")
+    parser.add_argument("--repeat", default=2000, type=int,
+                        help="Optional.\n"
+                             "Number of decode calls per measurement")
+    parser.add_argument("-t_detect", "--threshold_detect", default=0.5, type=float,
+                        help="Optional.\n"
+                             "Probability threshold for detections filtering")
+    parser.add_argument("--width", default=1920, type=int,
+                        help="Optional.\n"
+                             "Image width")
+    parser.add_argument("--height", default=1080, type=int,
+                        help="Optional.\n"
+                             "Image height")
+    return parser
+# ================================================================================
+
+# ダミーモデルの作成 =============================================================
+# IRファイルを読まずにデコードに必要な属性だけ設定する
+def make_model(output_type, decode_mode, threshold) :
+    model = model_ssd_detect.__new__(model_ssd_detect)
+    model.output_type      = output_type
+    model.output_blob_name = 'boxes' if output_type == 2 else 'detection_out'
+    model.label_blob_name  = 'labels'
+    model.img_input_width  = 300
+    model.img_input_height = 300
+    model.prob_threshold   = threshold
+    model.decode_mode      = decode_mode
+    return model
+
+# ダミー出力テンソルの作成
+def make_request(output_type, rows, rng) :
+    if output_type == 1 :
+        res = np.zeros((1, 1, rows, 7), dtype=np.float32)
+        res[0, 0, :, 1] = rng.integers(1, 91, rows)             # class_id
+        res[0, 0, :, 2] = rng.random(rows)                      # conf
+        xy = rng.random((rows, 2)) * 0.8
+        res[0, 0, :, 3:5] = xy
+        res[0, 0, :, 5:7] = xy + rng.random((rows, 2)) * 0.2
+        return DummyRequest({'detection_out': DummyTensor(res)})
+    else :
+        res_box = np.zeros((rows, 5), dtype=np.float32)
+        xy = rng.random((rows, 2)) * 240
+        res_box[:, 0:2] = xy
+        res_box[:, 2:4] = xy + rng.random((rows, 2)) * 60
+        res_box[:, 4] = rng.random(rows)                        # conf
+        res_label = rng.integers(0, 3, rows).astype(np.int64)
+        return DummyRequest({'boxes': DummyTensor(res_box), 'labels': DummyTensor(res_label)})
+# ================================================================================
+
+# 測定 ===========================================================================
+def measure(model, res, frame, repeat) :
+    start = time.perf_counter()
+    for _ in range(repeat) :
+        _, results = model.analyze_result(res, (frame, ))
+    return (time.perf_counter() - start) / repeat * 1000 * 1000        # usec単位に変換
+
+# ループ版とベクトル化版の結果の比較
+def compare_results(loop_results, vector_results) :
+    if len(loop_results) != len(vector_results) :
+        return False
+    for l, v in zip(loop_results, vector_results) :
+        if      int(l["class_id"]) != int(v["class_id"])      \
+            or  np.float32(l["conf"]) != v["conf"]              \
+            or  tuple(l["pt1"]) != (v["x1"], v["y1"])           \
+            or  tuple(l["pt2"]) != (v["x2"], v["y2"]) :
+            return False
+    return True
+# ================================================================================
+
+# メイン処理 =====================================================================
+def main():
+    log.basicConfig(format="[ %(levelname)s ] %(message)s", level=log.INFO, stream=sys.stdout)
+
+    # コマンドラインオプションの解析
+    args = build_argparser().parse_args()
+
+    rng = np.random.default_rng(0)
+    frame = DummyFrame(args.width, args.height)
+
+    print(f'image size : {args.width}x{args.height}   threshold : {args.threshold_detect}   repeat : {args.repeat}')
+    print(f' output_type,  rows, detections,    loop[us],  vector[us],  speedup, match')
+    for output_type in (1, 2) :
+        model_loop   = make_model(output_type, "loop",   args.threshold_detect)
+        model_vector = make_model(output_type, "vector", args.threshold_detect)
+        for rows in args.rows :
+            res = make_request(output_type, rows, rng)
+
+            # 結果が一致することを確認
+            _, loop_results   = model_loop.analyze_result(res, (frame, ))
+            _, vector_results = model_vector.analyze_result(res, (frame, ))
+            match = compare_results(loop_results, vector_results)
+
+            loop_time   = measure(model_loop,   res, frame, args.repeat)
+            vector_time = measure(model_vector, res, frame, args.repeat)
+            print(f' {output_type:11d}, {rows:5d}, {len(vector_results):10d}, {loop_time:11.2f}, {vector_time:11.2f}, {loop_time / vector_time:7.1f}x, {match}')
+# ================================================================================
+
+if __name__ == '__main__':
+    sys.exit(main() or 0)
@@ -2,26 +2,51 @@
 import sys
 import os
 import time
+import threading
 import logging as log
 import cv2
 import numpy as np
+from collections import deque
 
 # openVINOモジュール
 # from openvino.runtime import get_version        as ov_get_version
 # from openvino.runtime import Core               as ov_Core
 from openvino.runtime import AsyncInferQueue    as ov_AsyncInferQueue
+from openvino.runtime import PartialShape       as ov_PartialShape
+from openvino.runtime import Dimension          as ov_Dimension
+from openvino.runtime import Tensor             as ov_Tensor
+from openvino.runtime import Layout             as ov_Layout
+from openvino.runtime import Type               as ov_Type
+from openvino.preprocess import PrePostProcessor    as ov_PrePostProcessor
+from openvino.preprocess import ResizeAlgorithm     as ov_ResizeAlgorithm
+from openvino.preprocess import ColorFormat         as ov_ColorFormat
+
+from Profiler import profiler, NULL_SPAN
 
 class async_model_base() :
-    def __init__(self, core, model_xml, device="CPU", prob_threshold=0.5, queue_num=2, log_f=None) :
+    def __init__(self, core, model_xml, device="CPU", prob_threshold=0.5, queue_num=2, log_f=None, ppp=False, batch_size=1) :
         self.core = core
         self.model_xml = model_xml
         self.device = device
         self.prob_threshold = prob_threshold
         self.queue_num      = queue_num
         self.log_f          = log_f
+        self.ppp            = ppp               # 前処理をモデルに組み込む
+        self.batch_size     = batch_size        # 1回の推論で処理する最大画像数(1以外なら1～batch_sizeの可変長)
+        
+        # 推論中の入力画像の参照(前処理組み込み時)
+        self.input_refs = deque(maxlen=queue_num + 1)
+        
+        # 入力画像情報の値 (キーは入力画像の(高さ, 幅))
+        self.img_info_cache = {}
         
-        # 結果格納辞書
+        # 結果格納辞書 (キーは(ストリーム番号, フレーム番号))
         self.infer_results = {}
+        self.result_cond   = threading.Condition()
+        self.result_count  = 0              # 推論が完了した数
+        
+        # プロファイラの区間名の接頭辞
+        self.profile_name = type(self).__name__
         
         # IR(Intermediate Representation ;中間表現)ファイル(.xml & .bin) の読み込み
         self.load_model()
@@ -75,6 +100,15 @@ class async_model_base() :
             raise RuntimeError("Image input blob not found.")
     
     def make_infer_queue(self) :
+        # バッチサイズの変更
+        self.reshape_batch()
+        
+        # 前処理の組み込み
+        if self.ppp :
+            self.embed_preprocess()
+        else :
+            self.embed_layout()
+        
         # モデルのコンパイル
         log.info("Loading model to the plugin...")
         self.compiled_model = self.core.compile_model(self.model, self.device)
@@ -82,12 +116,87 @@ class async_model_base() :
         # 推論キューの作成
         self.async_queue = ov_AsyncInferQueue(self.compiled_model, self.queue_num)
         
+        # 推論リクエスト毎の入力テンソルのビューと、書き込み済みの入力画像情報のキー
+        self.input_views    = [None] * len(self.async_queue)
+        self.img_info_keys  = [None] * len(self.async_queue)
+        
         # callbackの設定
         self.async_queue.set_callback(self.callback)
     
-    def callback(self, res, params) :
-        disp_frame, results = self.analyze_result(res, params)
-        self.infer_results[disp_frame.frame_number] = {"disp_frame": disp_frame, "result":results}
+    # バッチサイズの変更 ==========================================
+    # 複数の入力(ストリーム)のフレームをまとめて推論できるように、
+    # 入力レイヤのバッチ次元を 1～batch_size の可変長にする
+    def reshape_batch(self) :
+        # バッチサイズ1ならそのまま
+        if self.batch_size == 1 :
+            return
+        
+        if self.batch_size < 1 :
+            raise ValueError(f"batch size must be greater than or equal to 1, but it is {self.batch_size}")
+        if not (self.img_info_blob_name_3 is None and self.img_info_blob_name_6 is None) :
+            raise RuntimeError("Batch mode is not supported for models with image info input.")
+        
+        log.info(f"Reshape model to batch size 1..{self.batch_size}")
+        input_shape = [ov_Dimension(1, self.batch_size)] + [ov_Dimension(d) for d in list(self.img_input_blob_shape)[1:]]
+        self.model.reshape({self.img_input_blob_name: ov_PartialShape(input_shape)})
+    
+    # 入力テンソルのレイアウトの設定 ==============================
+    # 推論リクエストの入力テンソル(u8, NHWC)にリサイズした画像を直接書き込めるように、
+    # u8→f32変換とレイアウト変換(NHWC→NCHW)だけ PrePostProcessor でモデルに組み込む
+    def embed_layout(self) :
+        ppp = ov_PrePostProcessor(self.model)
+        ppp_input = ppp.input(self.img_input_blob_name)
+        ppp_input.tensor()                                                  \
+                 .set_element_type(ov_Type.u8)                              \
+                 .set_layout(ov_Layout("NHWC"))
+        ppp_input.model().set_layout(ov_Layout("NCHW" if self.img_input_blob_format_NCHW else "NHWC"))
+        self.model = ppp.build()
+    
+    # 前処理のモデルへの組み込み ==================================
+    # リサイズ、レイアウト変換(NHWC→NCHW)、u8→f32変換を PrePostProcessor でモデルに組み込む。
+    # 入力はキャプチャしたBGR画像(u8, NHWC, 任意サイズ)をそのまま渡せばよい
+    def embed_preprocess(self) :
+        log.info("Embed preprocessing into the model")
+        ppp = ov_PrePostProcessor(self.model)
+        ppp_input = ppp.input(self.img_input_blob_name)
+        ppp_input.tensor()                                                  \
+                 .set_element_type(ov_Type.u8)                              \
+                 .set_layout(ov_Layout("NHWC"))                             \
+                 .set_color_format(ov_ColorFormat.BGR)                      \
+                 .set_spatial_dynamic_shape()                               # 入力画像のサイズは任意
+        ppp_input.preprocess().resize(ov_ResizeAlgorithm.RESIZE_LINEAR)
+        ppp_input.model().set_layout(ov_Layout("NCHW" if self.img_input_blob_format_NCHW else "NHWC"))
+        self.model = ppp.build()
+    
+    # userdata は (params, 投入時刻)
+    # params は (表示用フレーム, ) または (表示用フレーム, ストリーム番号)
+    # バッチ推論(start_infer_batch)の場合は画像毎の params のリスト
+    def callback(self, res, userdata) :
+        params, submit_time = userdata
+        count = len(params) if isinstance(params, list) else 1
+        
+        # 投入から完了までの時間(推論キューの待ちを含む)
+        profiler.record(f'{self.profile_name}/infer', submit_time, time.perf_counter(), count=count)
+        
+        if isinstance(params, list) :
+            # 結果を画像毎に振り分ける
+            for index, image_params in enumerate(params) :
+                self.store_result(res, image_params, index)
+        else :
+            self.store_result(res, params)
+    
+    # 結果の解析と格納 (index はバッチ内の画像の位置。バッチ推論でなければNone)
+    def store_result(self, res, params, index=None) :
+        with self.profile("analyze_result", frame=params[0].frame_number) :
+            if index is None :
+                disp_frame, results = self.analyze_result(res, params)
+            else :
+                disp_frame, results = self.analyze_result(res, params, index)
+        stream_id = params[1] if len(params) > 1 else 0
+        with self.result_cond :
+            self.infer_results[(stream_id, disp_frame.frame_number)] = {"disp_frame": disp_frame, "result":results}
+            self.result_count += 1
+            self.result_cond.notify_all()
     
     def is_ready(self) :
         return self.async_queue.is_ready()
@@ -96,32 +205,108 @@ class async_model_base() :
         self.async_queue.wait_all()
     
     def start_infer(self, feed_dict, params):
-        self.async_queue.start_async(feed_dict, params)
+        with self.profile("submit", frame=params[0].frame_number) :
+            self.async_queue.start_async(feed_dict, (params, time.perf_counter()))
     
-    def get_infer_result(self, disp_frame_number) :
-        infer_rst = self.infer_results.pop(disp_frame_number, None)     # 辞書から要素を取り出して削除、要素がなければNone
+    # 複数画像をまとめて推論(feed_dict は pre_process_batch の戻り値、params_list は画像毎の params)
+    def start_infer_batch(self, feed_dict, params_list):
+        params_list = list(params_list)
+        with self.profile("submit", count=len(params_list)) :
+            self.async_queue.start_async(feed_dict, (params_list, time.perf_counter()))
+    
+    # プロファイラの区間 ("モデルのクラス名/stage" で計測する)
+    def profile(self, stage, **args) :
+        if not profiler.enabled :
+            return NULL_SPAN
+        return profiler.span(f'{self.profile_name}/{stage}', **args)
+    
+    def get_infer_result(self, disp_frame_number, stream_id=0) :
+        with self.result_cond :
+            infer_rst = self.infer_results.pop((stream_id, disp_frame_number), None)     # 辞書から要素を取り出して削除、要素がなければNone
         return infer_rst
     
+    # 推論が完了した数が result_count から増えるまで待つ(最大 timeout 秒)
+    # (表示の待ち時間(cv2.waitKey)を使わずに結果を待つ場合に使う)
+    def wait_infer_result(self, result_count, timeout=None) :
+        with self.result_cond :
+            return self.result_cond.wait_for(lambda : self.result_count != result_count, timeout)
+    
+    # 入力画像情報 =================================================
+    # 入力画像のサイズ毎に1回だけ計算する {レイヤ名 : 値}
+    def img_info(self, image_shape) :
+        key = image_shape[:2]
+        info = self.img_info_cache.get(key)
+        if info is None :
+            info = {}
+            if not self.img_info_blob_name_3 is None :      # 1x3のタイプ
+                info[self.img_info_blob_name_3] = np.array([[self.img_input_height, self.img_input_width, 1]])
+            if not self.img_info_blob_name_6 is None :      # 1x6のタイプ
+                info[self.img_info_blob_name_6] = np.array([[  self.img_input_height, 
+                                                               self.img_input_width, 
+                                                               self.img_input_width  / image_shape[1], 
+                                                               self.img_input_height / image_shape[0], 
+                                                               self.img_input_width  / image_shape[1], 
+                                                               self.img_input_height / image_shape[0]
+                                                           ]])
+            self.img_info_cache[key] = info
+        return info
+    
+    # 推論リクエストの入力テンソル(NHWC)のビュー ==================
+    # 可変長バッチの場合は入力テンソルのshapeを画像数に合わせてから返す
+    def input_view(self, request_id, count) :
+        in_view = self.input_views[request_id]
+        if in_view is None or len(in_view) != count :
+            in_tensor = self.async_queue[request_id].get_tensor(self.img_input_blob_name)
+            if in_tensor.shape[0] != count :
+                in_tensor.shape = [count, self.img_input_height, self.img_input_width, self.img_input_colors]
+            in_view = in_tensor.data
+            self.input_views[request_id] = in_view
+        return in_view
+    
     # 前処理 =======================================================
+    # 前処理組み込み時以外は、次に推論を投入する推論リクエストの入力テンソルに直接書き込み、
+    # 空の feed_dict を返す(推論投入までに同じモデルに他の推論を投入しないこと)
     def pre_process(self, image) :
-        # 入力用フレームの作成
-        in_frame = cv2.resize(image, (self.img_input_width, self.img_input_height))     # リサイズ
-        if self.img_input_blob_format_NCHW :
-             in_frame = in_frame.transpose((2, 0, 1))                                       # HWC → CHW
-        in_frame = in_frame.reshape(self.img_input_blob_shape)                              # HWC → BHWC or CHW → BCHW
-        
-        feed_dict = {self.img_input_blob_name: in_frame}
-        if not self.img_info_blob_name_3 is None :      # 1x3のタイプ
-            feed_dict[self.img_info_blob_name_3] = np.array([[self.img_input_height, self.img_input_width, 1]])
-        if not self.img_info_blob_name_6 is None :      # 1x6のタイプ
-            feed_dict[self.img_info_blob_name_6] = np.array([[  self.img_input_height, 
-                                                                self.img_input_width, 
-                                                                self.img_input_width  / image.shape[1], 
-                                                                self.img_input_height / image.shape[0], 
-                                                                self.img_input_width  / image.shape[1], 
-                                                                self.img_input_height / image.shape[0]
-                                                            ]])
+        if self.ppp :
+            # 前処理はモデルに組み込み済みなので、画像をコピーせずにテンソルとして渡す
+            # (推論中に配列が解放されないように、推論キュー数+1個分の参照を保持しておく)
+            in_frame = np.ascontiguousarray(image[np.newaxis])                              # HWC → BHWC (連続した画像ならコピーしない)
+            self.input_refs.append(in_frame)
+            feed_dict = {self.img_input_blob_name: ov_Tensor(in_frame, shared_memory=True)}
+            feed_dict.update(self.img_info(image.shape))
+            return feed_dict
+        
+        # 次に使われる推論リクエスト(空きがなければここで待つ)
+        request_id = self.async_queue.get_idle_request_id()
+        request = self.async_queue[request_id]
         
+        # 入力テンソルに直接リサイズ
+        in_view = self.input_view(request_id, 1)
+        cv2.resize(image, (self.img_input_width, self.img_input_height), dst=in_view[0])
+        
+        # 入力画像情報は入力画像のサイズが変わったときだけ書き込む
+        if self.img_info_keys[request_id] != image.shape[:2] :
+            for name, value in self.img_info(image.shape).items() :
+                request.get_tensor(name).data[:] = value
+            self.img_info_keys[request_id] = image.shape[:2]
+        
+        return {}
+    
+    # 複数画像の前処理 ============================================
+    # images(batch_size個以下)をまとめて1回で推論するための feed_dict を返す
+    # (pre_process と同様に、前処理組み込み時以外は次に使われる推論リクエストの入力テンソルに書き込む)
+    def pre_process_batch(self, images) :
+        if self.ppp :
+            # 前処理組み込み時は画像サイズを揃えるためのリサイズだけ行い、レイアウト変換はモデルで行う
+            in_frames = np.empty((len(images), self.img_input_height, self.img_input_width, self.img_input_colors), dtype=np.uint8)
+            self.input_refs.append(in_frames)
+            feed_dict = {self.img_input_blob_name: ov_Tensor(in_frames, shared_memory=True)}
+        else :
+            # 次に使われる推論リクエストの入力テンソルに直接リサイズ
+            in_frames = self.input_view(self.async_queue.get_idle_request_id(), len(images))
+            feed_dict = {}
+        for i, image in enumerate(images) :
+            cv2.resize(image, (self.img_input_width, self.img_input_height), dst=in_frames[i])   # リサイズ
         return feed_dict
     # ================================================================================
     
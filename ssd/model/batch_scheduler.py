@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+import sys
+import os
+import time
+import logging as log
+
+# 動的バッチスケジューラ ==========================================================
+# 複数の入力(ストリーム)から投入されたフレームを溜めておき、
+#   ・溜まったフレームが max_batch 個になった
+#   ・最も古いフレームを溜めてから max_wait_ms 経過した
+# のどちらかで1回の推論(バッチ推論)にまとめて投入する。
+# 結果は推論スレッドで画像毎に振り分けられ、
+# async_model_base.get_infer_result で (ストリーム番号, フレーム番号) 毎に取り出す。
+# max_batch が 1 ならフレーム毎にそのまま投入する(モデルはバッチサイズ1のままでよい)
+class batch_scheduler() :
+    def __init__(self, model, max_batch=1, max_wait_ms=5.0) :
+        self.model       = model
+        self.max_batch   = max_batch
+        self.max_wait    = max_wait_ms / 1000       # sec単位に変換
+        
+        # 投入待ちのフレーム [(画像, params)]
+        self.pending      = []
+        self.pending_time = 0                       # 最も古いフレームを溜めた時刻
+        
+        # 統計情報
+        self.batch_count  = 0                       # 推論の投入回数
+        self.frame_count  = 0                       # 投入したフレーム数
+        self.full_count   = 0                       # max_batch 個溜まって投入した回数
+        
+    # フレームを溜められるか (False なら推論リクエストに空きができるまで待つ)
+    def is_ready(self) :
+        return len(self.pending) < self.max_batch
+        
+    # フレームの追加 (params は (表示用フレーム, ストリーム番号))
+    def submit(self, image, params) :
+        if len(self.pending) == 0 :
+            self.pending_time = time.perf_counter()
+        self.pending.append((image, params))
+        self.poll()
+        
+    # 投入条件を満たしていれば溜まったフレームを推論に投入する (メインループから毎回呼ぶ)
+    # force=True なら待ち時間に関係なく投入する(入力の終わりなど)
+    # 戻り値 : 投入したフレーム数
+    def poll(self, force=False) :
+        if len(self.pending) == 0 or not self.model.is_ready() :
+            return 0
+        if not force and len(self.pending) < self.max_batch and self.wait_remain() > 0 :
+            return 0
+        return self.flush()
+        
+    # 溜まったフレームを投入するまでの残り時間(sec)
+    def wait_remain(self) :
+        if len(self.pending) == 0 :
+            return None
+        return max(self.pending_time + self.max_wait - time.perf_counter(), 0)
+        
+    # 溜まったフレームをまとめて推論に投入
+    def flush(self) :
+        pending = self.pending
+        self.pending = []
+        if self.max_batch == 1 :
+            image, params = pending[0]
+            feed_dict = self.model.pre_process(image)
+            self.model.start_infer(feed_dict, params)
+        else :
+            feed_dict = self.model.pre_process_batch([image for image, _ in pending])
+            self.model.start_infer_batch(feed_dict, [params for _, params in pending])
+        self.batch_count += 1
+        self.frame_count += len(pending)
+        if len(pending) == self.max_batch :
+            self.full_count += 1
+        return len(pending)
+        
+    # 統計情報の文字列
+    def batch_status(self) :
+        mean_batch = self.frame_count / self.batch_count if self.batch_count > 0 else 0
+        return f'batch : {self.batch_count} inferences, {self.frame_count} frames, mean batch size {mean_batch:.2f} / {self.max_batch}, full {self.full_count}'
+# ================================================================================
@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+import sys
+import os
+import time
+import logging as log
+import cv2
+import numpy as np
+
+# 検出するフレーム(キーフレーム)の選択 ============================================
+# 検出モデルを interval フレーム毎に実行する。
+# motion_threshold > 0 なら、縮小したグレー画像の前回のキーフレームとの差分の平均(0～255)が
+# motion_threshold を超えたときも検出する(動きが大きいときだけ検出間隔を詰める)
+class keyframe_selector() :
+    THUMB_SIZE = (64, 36)           # 差分を取る縮小画像のサイズ(幅, 高さ)
+    
+    def __init__(self, interval=1, motion_threshold=0.0) :
+        self.interval         = interval
+        self.motion_threshold = motion_threshold
+        
+        self.key_thumb   = None             # 前回のキーフレームの縮小画像
+        self.skip_count  = interval         # 前回のキーフレームから検出をスキップしたフレーム数(最初のフレームは必ず検出)
+        
+        # 統計情報
+        self.frame_count  = 0               # 全フレーム数
+        self.key_count    = 0               # 検出したフレーム数
+        self.motion_count = 0               # 動きが大きいために検出したフレーム数
+        
+    # 動き検出用の縮小画像
+    @classmethod
+    def thumbnail(cls, image) :
+        thumb = cv2.resize(image, cls.THUMB_SIZE, interpolation=cv2.INTER_AREA)
+        return cv2.cvtColor(thumb, cv2.COLOR_BGR2GRAY)
+        
+    # 検出するフレームか
+    def is_keyframe(self, image) :
+        thumb = self.thumbnail(image) if self.motion_threshold > 0 else None
+        return self.select(thumb)
+        
+    # 検出するフレームか(縮小画像で判定)
+    def select(self, thumb) :
+        self.frame_count += 1
+        key = self.skip_count + 1 >= self.interval
+        if not key and not thumb is None and not self.key_thumb is None :
+            if cv2.absdiff(thumb, self.key_thumb).mean() > self.motion_threshold :
+                key = True
+                self.motion_count += 1
+        if key :
+            self.key_thumb  = thumb
+            self.skip_count = 0
+            self.key_count += 1
+        else :
+            self.skip_count += 1
+        return key
+        
+    # 検出モデルの稼働率(検出したフレームの割合)
+    def duty_cycle(self) :
+        return self.key_count / self.frame_count if self.frame_count > 0 else 0
+        
+    # 統計情報(ステータス表示用)
+    def selector_status(self) :
+        return f'detect duty      : {self.duty_cycle() * 100:5.1f} % ({self.key_count} / {self.frame_count} frames, motion {self.motion_count})'
+# ================================================================================
+
+# 検出枠の追跡 ====================================================================
+# 等速モデルのカルマンフィルタ(状態は中心座標, 幅, 高さとその速度)とIoU/中心間距離による対応付けで検出枠を追跡する。
+# 対応付けは予測した検出枠と行い、中心間距離の閾値は前回対応付いてから予測したフレーム数に比例して広げる
+# (検出をスキップすると、速度が推定できていない新しいトラックは検出フレーム間の移動量だけずれるため)。
+# フレーム毎に predict() を呼び、検出したフレームではその後に update() で検出結果を反映する。
+# 検出しなかったフレームでは tracks() で予測した検出枠を取り出す。
+# 全トラックをまとめてNumPyで処理する。
+class box_tracker() :
+    STD_POSITION = 1 / 20           # 位置の標準偏差(検出枠のサイズに対する比率)
+    STD_VELOCITY = 1 / 160          # 速度の標準偏差(検出枠のサイズに対する比率)
+    
+    def __init__(self, iou_threshold=0.3, max_age=1, centroid_threshold=0.5) :
+        self.iou_threshold      = iou_threshold         # 対応付けるIoUの最小値
+        self.max_age            = max_age               # 検出と対応付かなくても残しておく検出フレーム数
+        self.centroid_threshold = centroid_threshold    # IoUで対応付かなかった組を対応付ける1フレームあたりの中心間距離の最大値(検出枠のサイズに対する比率, 0なら使わない)
+        
+        # 状態遷移行列(等速モデル。観測は状態の先頭4要素)
+        self.F = np.eye(8)
+        self.F[:4, 4:] = np.eye(4)
+        
+        # トラック毎の状態
+        self.mean   = np.zeros((0, 8))          # 状態 (cx, cy, w, h, vcx, vcy, vw, vh)
+        self.cov    = np.zeros((0, 8, 8))       # 共分散
+        self.ids    = np.zeros(0, dtype=int)    # トラックID
+        self.labels = np.zeros(0, dtype=int)    # クラスID
+        self.confs  = np.zeros(0)               # 最後に対応付いた検出のconfidence
+        self.misses = np.zeros(0, dtype=int)    # 検出と対応付かなかった連続の検出フレーム数
+        self.gaps   = np.zeros(0, dtype=int)    # 最後に検出と対応付いてから予測したフレーム数
+        
+        self.next_id = 1
+        
+    @property
+    def size(self) :
+        return len(self.ids)
+        
+    # (x1, y1, x2, y2) → (cx, cy, w, h)
+    @staticmethod
+    def to_xywh(boxes) :
+        boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        wh = boxes[:, 2:] - boxes[:, :2]
+        return np.hstack((boxes[:, :2] + wh / 2, wh))
+        
+    # (cx, cy, w, h) → (x1, y1, x2, y2)
+    @staticmethod
+    def to_xyxy(xywh) :
+        wh = np.maximum(xywh[:, 2:4], 1)
+        return np.hstack((xywh[:, :2] - wh / 2, xywh[:, :2] + wh / 2))
+        
+    # IoU行列 (a : (M,4), b : (N,4) → (M,N))
+    @staticmethod
+    def iou_matrix(a, b) :
+        lt = np.maximum(a[:, None, :2], b[None, :, :2])
+        rb = np.minimum(a[:, None, 2:], b[None, :, 2:])
+        inter = np.prod(np.clip(rb - lt, 0, None), axis=2)
+        area_a = np.prod(a[:, 2:] - a[:, :2], axis=1)
+        area_b = np.prod(b[:, 2:] - b[:, :2], axis=1)
+        union = area_a[:, None] + area_b[None, :] - inter
+        return np.where(union > 0, inter / np.maximum(union, 1e-9), 0)
+        
+    # 検出枠のサイズに比例した標準偏差 (N,4)
+    @staticmethod
+    def size_std(wh, weight) :
+        wh = np.maximum(wh, 1)
+        return weight * np.hstack((wh, wh))
+        
+    # 1フレーム分の予測 ================================================
+    def predict(self) :
+        if self.size == 0 :
+            return
+        std = np.hstack((self.size_std(self.mean[:, 2:4], self.STD_POSITION),
+                         self.size_std(self.mean[:, 2:4], self.STD_VELOCITY)))
+        Q = np.zeros_like(self.cov)
+        Q[:, range(8), range(8)] = std ** 2
+        self.mean = self.mean @ self.F.T
+        self.cov  = self.F @ self.cov @ self.F.T + Q
+        self.gaps += 1
+        
+    # 検出結果の反映 ===================================================
+    # boxes : (N,4)の(x1, y1, x2, y2), labels : クラスID, confs : confidence
+    # 戻り値 : 検出毎のトラックID
+    def update(self, boxes, labels=None, confs=None) :
+        boxes  = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        labels = np.zeros(len(boxes), dtype=int) if labels is None else np.asarray(labels, dtype=int)
+        confs  = np.zeros(len(boxes)) if confs is None else np.asarray(confs, dtype=np.float64)
+        
+        # IoUの大きい組から順に対応付ける(クラスが異なる組は対応付けない)
+        track_idx, det_idx = self.associate(boxes, labels)
+        
+        # 対応付いたトラックの更新
+        if len(track_idx) > 0 :
+            z   = self.to_xywh(boxes[det_idx])
+            P   = self.cov[track_idx]
+            R   = np.zeros((len(z), 4, 4))
+            R[:, range(4), range(4)] = self.size_std(z[:, 2:4], self.STD_POSITION) ** 2
+            S   = P[:, :4, :4] + R
+            K   = np.linalg.solve(S, P[:, :4, :]).transpose(0, 2, 1)       # P H^T S^-1 (Pは対称)
+            innovation = z - self.mean[track_idx, :4]
+            self.mean[track_idx] += (K @ innovation[:, :, None])[:, :, 0]
+            self.cov[track_idx]   = P - K @ P[:, :4, :]
+            self.labels[track_idx] = labels[det_idx]
+            self.confs[track_idx]  = confs[det_idx]
+            
+        # 対応付かなかったトラックは max_age を超えたら削除
+        matched = np.zeros(self.size, dtype=bool)
+        matched[track_idx] = True
+        self.misses[matched]  = 0
+        self.misses[~matched] += 1
+        self.gaps[matched]    = 0
+        
+        ids = np.zeros(len(boxes), dtype=int)
+        ids[det_idx] = self.ids[track_idx]
+        keep = self.misses <= self.max_age
+        self.remove(~keep)
+        
+        # 対応付かなかった検出は新しいトラックにする
+        new_idx = np.setdiff1d(np.arange(len(boxes)), det_idx)
+        ids[new_idx] = self.add(boxes[new_idx], labels[new_idx], confs[new_idx])
+        return ids
+        
+    # 対応付け =========================================================
+    # IoUの大きい組から貪欲に選び、残りを中心間距離の近い組から選ぶ
+    # (動きが速かったり検出枠が小さかったりしてIoUが小さくなる場合の補完)
+    # 戻り値 : (トラックのインデックス, 検出のインデックス)
+    def associate(self, boxes, labels) :
+        track_used = np.zeros(self.size,  dtype=bool)
+        det_used   = np.zeros(len(boxes), dtype=bool)
+        if self.size == 0 or len(boxes) == 0 :
+            return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+        same_label = self.labels[:, None] == labels[None, :]
+        
+        iou = self.iou_matrix(self.to_xyxy(self.mean), boxes)
+        iou[~same_label] = 0
+        pairs = self.greedy_match(iou, self.iou_threshold, track_used, det_used)
+        
+        if self.centroid_threshold > 0 :
+            # 中心間距離(トラックの検出枠のサイズと前回対応付いてからのフレーム数で正規化)が小さいほどスコアが大きい
+            track_size = np.sqrt(np.prod(np.maximum(self.mean[:, 2:4], 1), axis=1)) * np.maximum(self.gaps, 1)
+            dist  = np.linalg.norm(self.mean[:, None, :2] - self.to_xywh(boxes)[None, :, :2], axis=2) / track_size[:, None]
+            score = np.where(same_label, -dist, -np.inf)
+            pairs += self.greedy_match(score, -self.centroid_threshold, track_used, det_used)
+        
+        if len(pairs) == 0 :
+            return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+        track_idx, det_idx = np.array(pairs, dtype=int).T
+        return track_idx, det_idx
+        
+    # スコアの大きい組から貪欲に選ぶ(選んだトラック/検出は track_used/det_used に記録する)
+    @staticmethod
+    def greedy_match(score, min_score, track_used, det_used) :
+        pairs = []
+        for flat in np.argsort(-score, axis=None, kind="stable") :
+            t, d = divmod(int(flat), score.shape[1])
+            if score[t, d] < min_score :
+                break
+            if track_used[t] or det_used[d] :
+                continue
+            track_used[t] = det_used[d] = True
+            pairs.append((t, d))
+        return pairs
+        
+    # トラックの追加 (戻り値 : 追加したトラックのID)
+    def add(self, boxes, labels, confs) :
+        n = len(boxes)
+        z = self.to_xywh(boxes)
+        mean = np.hstack((z, np.zeros((n, 4))))
+        std  = np.hstack((self.size_std(z[:, 2:4], 2 * self.STD_POSITION),
+                          self.size_std(z[:, 2:4], 10 * self.STD_VELOCITY)))
+        cov  = np.zeros((n, 8, 8))
+        cov[:, range(8), range(8)] = std ** 2
+        ids  = np.arange(self.next_id, self.next_id + n)
+        self.next_id += n
+        
+        self.mean   = np.vstack((self.mean, mean))
+        self.cov    = np.concatenate((self.cov, cov))
+        self.ids    = np.concatenate((self.ids, ids))
+        self.labels = np.concatenate((self.labels, labels))
+        self.confs  = np.concatenate((self.confs, confs))
+        self.misses = np.concatenate((self.misses, np.zeros(n, dtype=int)))
+        self.gaps   = np.concatenate((self.gaps,   np.zeros(n, dtype=int)))
+        return ids
+        
+    # トラックの削除 (mask : 削除するトラック)
+    def remove(self, mask) :
+        keep = ~mask
+        self.mean   = self.mean[keep]
+        self.cov    = self.cov[keep]
+        self.ids    = self.ids[keep]
+        self.labels = self.labels[keep]
+        self.confs  = self.confs[keep]
+        self.misses = self.misses[keep]
+        self.gaps   = self.gaps[keep]
+        
+    # 予測した検出枠の取り出し =========================================
+    # 直前の検出フレームで検出と対応付いたトラックだけ返す
+    # image_size(幅, 高さ)を指定すると、検出枠を画像の範囲に収め、整数化して幅か高さが0になる
+    # (予測した位置が画像の外に出た)トラックは返さない(切り取り画像が空にならないように)
+    # 戻り値 : (検出枠(N,4)の(x1, y1, x2, y2), トラックID, クラスID, confidence)
+    def tracks(self, image_size=None) :
+        active = self.misses == 0
+        boxes  = self.to_xyxy(self.mean[active])
+        ids, labels, confs = self.ids[active], self.labels[active], self.confs[active]
+        if not image_size is None :
+            width, height = image_size
+            boxes   = np.clip(boxes, 0, (width, height, width, height))
+            int_box = boxes.astype(int)
+            visible = (int_box[:, 2] > int_box[:, 0]) & (int_box[:, 3] > int_box[:, 1])
+            boxes, ids, labels, confs = boxes[visible], ids[visible], labels[visible], confs[visible]
+        return boxes, ids, labels, confs
+# ================================================================================
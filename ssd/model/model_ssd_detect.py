@@ -14,10 +14,25 @@ import numpy as np
 from .async_model_base import async_model_base
 from DispFrame import console_print
 
+# 検出結果(ベクトル化デコード時)の構造化配列の型
+DETECTION_DTYPE = np.dtype([
+                    ("conf",     np.float32),       # confidence
+                    ("class_id", np.int32  ),       # クラスID
+                    ("x1",       np.int32  ),       # left
+                    ("y1",       np.int32  ),       # top
+                    ("x2",       np.int32  ),       # right
+                    ("y2",       np.int32  ),       # bottom
+                ])
+
 class model_ssd_detect(async_model_base) :
-    def __init__(self, core, model_xml, model_label=None, device="CPU", prob_threshold=0.5, queue_num=2, log_f=None) :
+    def __init__(self, core, model_xml, model_label=None, device="CPU", prob_threshold=0.5, queue_num=2, log_f=None, decode_mode="vector", ppp=False, batch_size=1) :
         # 親クラスの初期化をcall
-        super().__init__(core, model_xml, device, prob_threshold, queue_num, log_f)
+        super().__init__(core, model_xml, device, prob_threshold, queue_num, log_f, ppp, batch_size)
+        
+        # 結果のデコード方法("vector" : NumPyで一括処理, "loop" : 1行ずつ処理)
+        if decode_mode not in ("vector", "loop") :
+            raise ValueError(f'decode mode unknown : {decode_mode}')
+        self.decode_mode = decode_mode
         
         # ラベルファイル読み込み
         self.labels_map = None
@@ -54,13 +69,74 @@ class model_ssd_detect(async_model_base) :
             else :
                 raise ValueError(f'output type unknown : output names={output_names}')
         
+    # バッチサイズの変更 ==========================================
+    # バッチ推論の結果を画像毎に振り分けるには image_id を含む (1,1,N,7) の出力が必要
+    def reshape_batch(self) :
+        if self.batch_size != 1 and self.output_type != 1 :
+            raise RuntimeError("Batch mode is supported only for models with (1,1,N,7) output.")
+        super().reshape_batch()
+        
     # 結果の解析 ===============================================
-    def analyze_result(self, res, params) :
+    # index はバッチ内の画像の位置(バッチ推論でなければNone)
+    def analyze_result(self, res, params, index=None) :
         # paramsをバラす
         disp_frame = params[0]
         img_width  = disp_frame.img_width
         img_height = disp_frame.img_height
         
+        if self.decode_mode == "vector" :
+            results = self.decode_result_vector(res, img_width, img_height, index)
+        else :
+            results = self.decode_result_loop(res, img_width, img_height, index)
+        
+        return disp_frame, results
+    
+    # 結果のデコード(NumPyで一括処理) ==========================
+    # 戻り値はDETECTION_DTYPEの構造化配列
+    def decode_result_vector(self, res, img_width, img_height, index=None) :
+        if self.output_type == 1 :
+            # output tensorの取り出し
+            res_array = res.get_tensor(self.output_blob_name).data.reshape(-1,7)
+            # バッチ推論ならその画像(image_id が index)の結果だけ取り出す
+            if not index is None :
+                res_array = res_array[res_array[:, 0] == index]
+            # 閾値より大きいものだけ取り出す
+            objs  = res_array[res_array[:, 2] > self.prob_threshold]
+            conf     = objs[:, 2]
+            class_id = objs[:, 1]
+            # 座標を画像サイズに変換(ループ版と結果を合わせるためfloat64で計算)
+            scale = np.array((img_width, img_height, img_width, img_height), dtype=np.float64)
+            boxes = objs[:, 3:7].astype(np.float64) * scale
+        elif self.output_type == 2 :
+            # output tensorの取り出し
+            res_box   = res.get_tensor(self.output_blob_name).data.reshape(-1,5)
+            res_label = res.get_tensor(self.label_blob_name).data.reshape(-1)
+            # 閾値より大きいものだけ取り出す
+            mask  = res_box[:, 4] > self.prob_threshold
+            objs  = res_box[mask]
+            conf     = objs[:, 4]
+            class_id = res_label[mask]
+            # 座標を入力サイズ基準から画像サイズに変換
+            input_size = np.array((self.img_input_width, self.img_input_height, self.img_input_width, self.img_input_height), dtype=np.float64)
+            img_size   = np.array((img_width, img_height, img_width, img_height), dtype=np.float64)
+            boxes = objs[:, 0:4].astype(np.float64) / input_size * img_size
+        else :
+            raise ValueError('output type unknown')
+        
+        # 構造化配列に格納(整数フィールドへの代入で切り捨て)
+        results = np.empty(len(objs), dtype=DETECTION_DTYPE)
+        results["conf"]     = conf
+        results["class_id"] = class_id
+        results["x1"]       = boxes[:, 0]
+        results["y1"]       = boxes[:, 1]
+        results["x2"]       = boxes[:, 2]
+        results["y2"]       = boxes[:, 3]
+        
+        return results
+    
+    # 結果のデコード(1行ずつ処理) ==============================
+    # 戻り値は検出結果の辞書のリスト
+    def decode_result_loop(self, res, img_width, img_height, index=None) :
         results = []
         img_size = np.array((img_width,  img_height))
         
@@ -70,6 +146,8 @@ class model_ssd_detect(async_model_base) :
             # バウンディングボックス毎の結果を取得
             res_array = res_array.reshape(-1,7)
             for obj in res_array:
+                if not index is None and int(obj[0]) != index :
+                    continue                    # バッチ推論で他の画像(image_id)の結果
                 conf     = obj[2]           # confidence for the predicted class(スコア)
                 if conf > self.prob_threshold:          # 閾値より大きいものだけ処理
                     class_id = int(obj[1])      # クラスID0
@@ -96,17 +174,24 @@ class model_ssd_detect(async_model_base) :
         else :
             raise ValueError('output type unknown')
         
-        return disp_frame, results
+        return results
     # ================================================================================
     
-    # 後処理 =======================================================
-    def post_process(self, disp_frame, result) :
+    # 検出結果を (クラスID, クラス名, confidence, 左上座標, 右下座標) にバラす
+    def unpack_result(self, result) :
         # 結果を個別の変数にバラす
-        conf     = result["conf"]
-        class_id = result["class_id"]
-        pt1      = result["pt1"]
-        pt2      = result["pt2"]
-        
+        if isinstance(result, dict) :
+            # ループ版デコードの結果
+            conf     = result["conf"]
+            class_id = result["class_id"]
+            pt1      = result["pt1"]
+            pt2      = result["pt2"]
+        else :
+            # ベクトル化デコードの結果(構造化配列の要素)
+            conf     = float(result["conf"])
+            class_id = int(result["class_id"])
+            pt1      = (int(result["x1"]), int(result["y1"]))
+            pt2      = (int(result["x2"]), int(result["y2"]))
         
         # 検出結果の文字列化
         # ラベルが定義されていればラベルを読み出し、なければclass ID
@@ -118,6 +203,46 @@ class model_ssd_detect(async_model_base) :
         else :
             class_name = str(class_id)
         
+        return class_id, class_name, conf, pt1, pt2
+    
+    # 検出結果の出力用の列 ====================================
+    # 1フレーム分の検出結果を ResultWriter に渡す列(先頭の次元が検出数の配列)に変換する
+    # 戻り値 : {"conf" : (N,), "class_id" : (N,), "box" : (N,4)の(x1, y1, x2, y2)}
+    def result_columns(self, results) :
+        if isinstance(results, np.ndarray) :
+            # ベクトル化デコードの結果(構造化配列)はそのまま列を取り出す
+            return {"conf"     : results["conf"],
+                    "class_id" : results["class_id"],
+                    "box"      : np.stack((results["x1"], results["y1"], results["x2"], results["y2"]), axis=1)}
+        
+        # ループ版デコード/追跡で補間した結果(辞書のリスト)
+        unpacked = [self.unpack_result(result) for result in results]
+        return {"conf"     : np.array([conf for _, _, conf, _, _ in unpacked], dtype=np.float32),
+                "class_id" : np.array([class_id for class_id, _, _, _, _ in unpacked], dtype=np.int32),
+                "box"      : np.array([(*pt1, *pt2) for _, _, _, pt1, pt2 in unpacked], dtype=np.int32).reshape(-1, 4)}
+    
+    # 追跡による検出結果の補間 ====================================
+    # 検出したフレームでは検出結果を追跡(box_tracker)に反映してそのまま返し、
+    # 検出しなかったフレーム(results が None)では追跡で予測した検出枠を
+    # ループ版デコードと同じ形式の検出結果として返す
+    # image_size(幅, 高さ)を指定すると、予測した検出枠を画像の範囲に収める(画像の外に出たトラックは除く)
+    # (フレーム番号順に呼ぶこと)
+    def track_result(self, tracker, results, image_size=None) :
+        tracker.predict()
+        if not results is None :
+            unpacked = [self.unpack_result(result) for result in results]
+            boxes    = [(*pt1, *pt2) for _, _, _, pt1, pt2 in unpacked]
+            tracker.update(boxes, [class_id for class_id, _, _, _, _ in unpacked], [conf for _, _, conf, _, _ in unpacked])
+            return results
+        
+        boxes, _, class_ids, confs = tracker.tracks(image_size)
+        return [{"conf": conf, "class_id": int(class_id), "pt1": box[:2].astype(int), "pt2": box[2:].astype(int)}
+                for box, class_id, conf in zip(boxes, class_ids, confs)]
+    
+    # 後処理 =======================================================
+    def post_process(self, disp_frame, result) :
+        class_id, class_name, conf, pt1, pt2 = self.unpack_result(result)
+        
         # 結果をログファイルorコンソールに出力
         console_print(self.log_f, f'{disp_frame.frame_number:3}:Class={class_name:15}({class_id:3}) Confidence={conf:4f} Location=({pt1[0]},{pt1[1]})-({pt2[0]},{pt2[1]})', False)
         
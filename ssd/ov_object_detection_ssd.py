@@ -14,7 +14,11 @@ from openvino.runtime import Core               as ov_Core
 
 # 自作モジュール
 from model.model_ssd_detect import model_ssd_detect
+from model.box_tracker import box_tracker, keyframe_selector
 from DispFrame import DispFrame, ImageSave, console_print
+from FrameCapture import FrameCapture
+from Profiler import profiler
+from ResultWriter import ResultWriter
 
 # コマンドラインパーサの構築 =====================================================
 def build_argparser():
@@ -30,6 +34,16 @@ def build_argparser():
                              "Required for CPU custom layers. \n"
                              "Absolute path to a shared library\n"
                              "with the kernels implementations.")
+    parser.add_argument("--ppp", action='store_true', 
+                        help="Optional.\n"
+                             "Embed resize and layout conversion into the model\n"
+                             "with OpenVINO PrePostProcessor\n"
+                             "(captured frames are passed to the model without copy)")
+    parser.add_argument("--capture_buffer", default=4, type=int, 
+                        help="Optional.\n"
+                             "Number of frames buffered by the capture thread\n"
+                             "(for camera input, the oldest frame is dropped when full)\n"
+                             "Specify 0 to capture in the main thread")
     
     ssd_args = parser.add_argument_group('SSD Options')
     ssd_args.add_argument("-m", "--model", required=True, type=str, 
@@ -53,14 +67,60 @@ def build_argparser():
     ssd_args.add_argument("-t_detect", "--threshold_detect", default=0.5, type=float, 
                         help="Optional.\n"
                              "Probability threshold for detections filtering")
+    ssd_args.add_argument("--decode_mode", default="vector", choices=["vector", "loop"], 
+                        help="Optional.\n"
+                             "Decoding method of the detection results\n"
+                             "  vector : decode all rows at once with NumPy\n"
+                             "  loop   : decode row by row\n"
+                             "Default value is vector")
+    ssd_args.add_argument("--detect_interval", default=1, type=int, 
+                        help="Optional.\n"
+                             "Run the detector every N frames and interpolate boxes\n"
+                             "of the frames in between with a Kalman/IoU tracker\n"
+                             "Default value is 1 (detect every frame)")
+    ssd_args.add_argument("--detect_motion", default=0.0, type=float, 
+                        help="Optional.\n"
+                             "Also run the detector when the mean difference (0-255)\n"
+                             "of the downscaled frame from the last detected frame\n"
+                             "exceeds this value (0 = disabled)")
     
     output_args = parser.add_argument_group('Output Options')
     output_args.add_argument("--save", default=None, type=str, 
                         help="Optional.\n"
                              "Save result to specified file")
+    output_args.add_argument("--save_queue", default=8, type=int, 
+                        help="Optional.\n"
+                             "Number of frames queued for the video writer thread\n"
+                             "(the main loop waits only when the queue is full)\n"
+                             "Specify 0 to write in the main thread")
+    output_args.add_argument("--save_overlay", default=None, type=str, 
+                        help="Optional.\n"
+                             "Save overlays (boxes, points, texts, etc.) of each frame\n"
+                             "to specified file in JSON Lines format without drawing")
+    output_args.add_argument("--results", default=None, type=str, 
+                        help="Optional.\n"
+                             "Save detection results of each frame to specified file\n"
+                             "(written by a background thread)")
+    output_args.add_argument("--results_format", default="binary", choices=ResultWriter.FORMATS, 
+                        help="Optional.\n"
+                             "Format of --results file\n"
+                             "  jsonl  : JSON Lines (1 frame per line)\n"
+                             "  binary : length-prefixed binary records\n"
+                             "Default value is binary")
     output_args.add_argument("--time", default=None, type=str, 
                         help="Optional.\n"
                              "Save time log to specified file")
+    output_args.add_argument("--profile", action='store_true', 
+                        help="Optional.\n"
+                             "Record per-stage spans and print p50/p90/p99 at exit")
+    output_args.add_argument("--profile_json", default=None, type=str, 
+                        help="Optional.\n"
+                             "Save profile summary and spans to specified JSON file\n"
+                             "(implies --profile)")
+    output_args.add_argument("--profile_trace", default=None, type=str, 
+                        help="Optional.\n"
+                             "Save spans to specified file in Chrome trace format\n"
+                             "(implies --profile)")
     output_args.add_argument("--log", default=None, type=str,  
                         help="Optional.\n"
                              "Save console log to specified file")
@@ -100,6 +160,26 @@ def main():
         log.warning("queue_num option must be greater than or equal to 1. use default value(2)")
         queue_num = 2
     
+    # キャプチャバッファ数/保存キュー数のチェック
+    if args.capture_buffer < 0 :
+        log.warning("capture_buffer option must be greater than or equal to 0. use default value(4)")
+        args.capture_buffer = 4
+    if args.save_queue < 0 :
+        log.warning("save_queue option must be greater than or equal to 0. use default value(8)")
+        args.save_queue = 8
+    
+    # 検出間隔のチェック
+    if args.detect_interval < 1 :
+        log.warning("detect_interval option must be greater than or equal to 1. use default value(1)")
+        args.detect_interval = 1
+    if args.detect_motion < 0 :
+        log.warning("detect_motion option must be greater than or equal to 0. use default value(0.0)")
+        args.detect_motion = 0.0
+    
+    # プロファイラの有効化
+    if args.profile or args.profile_json or args.profile_trace :
+        profiler.enable()
+    
     # 非表示設定
     no_disp = args.no_disp
     
@@ -117,7 +197,7 @@ def main():
         time_f = open(args.time, mode='w')
         print(f'command :          {" ".join(sys.argv)}', file=time_f)
         print(f'openVINO version : {ov_version_str}', file=time_f)
-        print(f' frame_number, frame_time, preprocess_time, infer_time, postprocess_time', file=time_f)
+        print(f' frame_number, frame_time, preprocess_time, infer_time, postprocess_time, decode_time', file=time_f)
 
     log_f = None
     if args.log :
@@ -135,16 +215,17 @@ def main():
         core.add_extension(args.cpu_extension)
     
     # キャプチャデバイスの初期化 =========================================================
-    cap = cv2.VideoCapture(input_file)
+    # カメラ入力なら古いフレームを破棄して最新のフレームを処理する
+    cap = FrameCapture(input_file, args.capture_buffer, drop=(input_file == 0))
     
     # 幅と高さを取得
-    img_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-    img_width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    img_height = cap.img_height
+    img_width = cap.img_width
     # フレームレート(1フレームの時間単位はミリ秒)の取得
-    org_frame_rate = int(cap.get(cv2.CAP_PROP_FPS))                 # オリジナルのフレームレート
-    org_frame_time = 1.0 / cap.get(cv2.CAP_PROP_FPS)                # オリジナルのフレーム時間
+    org_frame_rate = int(cap.frame_rate)                            # オリジナルのフレームレート
+    org_frame_time = 1.0 / cap.frame_rate                           # オリジナルのフレーム時間
     # フレーム数
-    all_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    all_frames = cap.frame_count
     all_frames = 1 if all_frames != -1 and all_frames < 0 else all_frames   # -1なら静止画
     
     # 画像保存インスタンスの作成 =========================================================
@@ -155,7 +236,9 @@ def main():
         if all_frames == 1 :
             img_save.set_jpeg(args.save)
         else :
-            img_save.create_writer(args.save, org_frame_rate)
+            img_save.create_writer(args.save, org_frame_rate, args.save_queue)
+    if args.save_overlay :
+        img_save.set_overlay(args.save_overlay)
     
     # 1フレーム表示後の待ち時間 ========================================================================
     wait_key_time = 1
@@ -165,7 +248,22 @@ def main():
         wait_key_time = 0           # 永久待ち
     
     # モデルの作成 =====================================================================================
-    model_ssd = model_ssd_detect(core, model_xml, model_label, args.device, args.threshold_detect, queue_num, log_f)
+    model_ssd = model_ssd_detect(core, model_xml, model_label, args.device, args.threshold_detect, queue_num, log_f, args.decode_mode, args.ppp)
+    
+    # 検出のスキップと追跡 =============================================================================
+    # 検出しないフレームは推論せずに skip_frames に入れておき、表示時に追跡で検出枠を補間する
+    selector = keyframe_selector(args.detect_interval, args.detect_motion)
+    tracker  = None
+    if args.detect_interval > 1 :
+        tracker = box_tracker()
+    skip_frames = {}            # 検出しないフレーム {フレーム番号 : 表示用フレーム}
+    
+    # 検出結果の出力 ===================================================================================
+    result_writer = None
+    if args.results :
+        result_writer = ResultWriter(args.results, args.results_format, 
+                                     {"pipeline": "ssd", "command": " ".join(sys.argv), "input": args.input, 
+                                      "width": img_width, "height": img_height, "labels": model_ssd.labels_map})
     
     # 推論開始 =========================================================================================
     log.info("Starting inference...")
@@ -178,55 +276,76 @@ def main():
     # キャプチャフラグ
     capture_flag = True
     
+    # キャプチャスレッドの開始
+    cap.start()
+    
     # フレーム測定用タイマ
     prev_time = time.perf_counter()
     
     while True:
         if capture_flag and model_ssd.is_ready() :
             # 画像の前処理 =============================================================================
+            # 画像キャプチャ
+            with profiler.span("main/capture") :
+                frame = cap.read()          # キャプチャスレッドでキャプチャ済みのフレームを取り出す
+            if frame is None:
+                # キャプチャ失敗
+                capture_flag = False        # 次からキャプチャしない
+                # ASYNCモードではキューに残った結果を処理するまでループ継続
+                continue
+            image = frame.image
+            preprocess_start_time = time.perf_counter()                         # 前処理開始時刻        --------------------------------
+            
             # 現在のフレーム番号表示
-            capture_time = time.perf_counter()
+            capture_time = frame.capture_time
             if infer_frame_number == 1 :
                 first_capture_time = capture_time
             capture_time = (capture_time - first_capture_time) * 1000       # 最初のキャプチャからの経過時間
             print(f'frame_number: {infer_frame_number:5d} / {all_frames}', end='\r', flush=True)
             if log_f :
                 console_print(log_f, f'frame_number: {infer_frame_number:5d} / {all_frames}     @{capture_time:10.3f}')
-                
-            # 画像キャプチャ
-            preprocess_start_time = time.perf_counter()                         # 前処理開始時刻        --------------------------------
-            ret, image = cap.read()    # フレームのキャプチャ
-            if not ret:
-                # キャプチャ失敗
-                capture_flag = False        # 次からキャプチャしない
-                # ASYNCモードではキューに残った結果を処理するまでループ継続
-                continue
             
             # 表示用フレームの作成
             disp_frame = DispFrame(image, infer_frame_number, all_frames)
+            disp_frame.set_decode_time(frame.decode_time)
             
             # 画像キャプチャと表示/入力用画像を作成
-            feed_dict = model_ssd.pre_process(image)
+            keyframe = (tracker is None) or selector.is_keyframe(image)
+            if keyframe :
+                feed_dict = model_ssd.pre_process(image)
             disp_frame.start_preprocess(preprocess_start_time)
             disp_frame.end_preprocess()                                 # 前処理終了時刻        --------------------------------
         
             disp_frame.start_infer()                                    # 推論処理開始時刻      --------------------------------
-            model_ssd.start_infer(feed_dict, (disp_frame, ))
+            if keyframe :
+                model_ssd.start_infer(feed_dict, (disp_frame, ))
+            else :
+                skip_frames[infer_frame_number] = disp_frame            # 検出しない
             
             # フレーム番号更新
             infer_frame_number += 1
         
         # 推論結果待ち =============================================================================
-        infer_rst = model_ssd.get_infer_result(disp_frame_number)       # まだ結果が出てなければNoneが返る
+        # (結果が出たときだけ区間を記録する)
+        infer_rst = profiler.poll("main/get_result", model_ssd.get_infer_result, disp_frame_number, frame=disp_frame_number)   # まだ結果が出てなければNoneが返る
+        if not infer_rst and disp_frame_number in skip_frames :
+            infer_rst = {"disp_frame": skip_frames.pop(disp_frame_number), "result": None}
         if infer_rst :
             cur_frame = infer_rst["disp_frame"]
             results   = infer_rst["result"]
             cur_frame.end_infer()                                       # 推論処理終了時刻      --------------------------------
             
+            # 検出しなかったフレームの検出枠を追跡で補間
+            if tracker :
+                results = model_ssd.track_result(tracker, results, (cur_frame.img_width, cur_frame.img_height))
+            
             # 検出結果の解析 =============================================================================
             cur_frame.start_postprocess()                               # 後処理開始時刻            --------------------------------
-            for rst in results :
-                model_ssd.post_process(cur_frame, rst)
+            for i, rst in enumerate(results) :
+                with model_ssd.profile("post_process", frame=cur_frame.frame_number, index=i) :
+                    model_ssd.post_process(cur_frame, rst)
+            if result_writer :
+                result_writer.write(cur_frame.frame_number, model_ssd.result_columns(results))
             cur_frame.end_postprocess()                                 # 後処理終了時刻            --------------------------------
             
             # フレーム処理時間を保存
@@ -237,6 +356,8 @@ def main():
             
             # 結果の表示 =============================================================================
             # 測定データの表示
+            if tracker :
+                cur_frame.add_status(selector.selector_status())         # 検出モデルの稼働率
             cur_frame.disp_status()
             
             # 処理時間記録
@@ -258,18 +379,26 @@ def main():
                 # 最後のフレームを表示した
                 break;
         
-        # キー入力取得
-        key = cv2.waitKey(wait_key_time)
-        if key == 27:
-            # ESCキー
-            break
+        # キー入力取得(非表示のときはウィンドウがないのでキー入力も待たない)
+        if not no_disp :
+            with profiler.span("main/wait_key") :
+                key = cv2.waitKey(wait_key_time)
+            if key == 27:
+                # ESCキー
+                break
         
     # キュー内の残りのデータが処理されるのを待つ(これをやらないと中断時にプログラムが終了しない)
     model_ssd.wait_all()
     
     # ESCキーで中断したときの残りは表示しない
     
+    # 検出モデルの稼働率
+    if tracker :
+        console_print(log_f, selector.selector_status(), True)
+    
     # 後片付け
+    cap.release()
+    
     if time_f :
         time_f.close()
     
@@ -279,8 +408,22 @@ def main():
     # 保存が設定されていか否かはメソッド内でチェック
     img_save.release_writer()
     
+    # 検出結果の出力ファイルを閉じる(書き込みスレッドの終了を待つ)
+    if result_writer :
+        result_writer.close()
+    
+    # プロファイル結果の出力(書き込みスレッドの終了後)
+    if profiler.enabled :
+        for line in profiler.summary_lines() :
+            print(line)
+        if args.profile_json :
+            profiler.save_json(args.profile_json)
+        if args.profile_trace :
+            profiler.save_chrome_trace(args.profile_trace)
+    
     # 表示ウィンドウを破棄
-    cv2.destroyAllWindows()
+    if not no_disp :
+        cv2.destroyAllWindows()
 # ================================================================================
 
 if __name__ == '__main__':
@@ -0,0 +1,369 @@
+#!/usr/bin/env python3
+import sys
+import os
+import time
+import logging as log
+from argparse import ArgumentParser, SUPPRESS, RawTextHelpFormatter
+
+# openVINOモジュール
+from openvino.runtime import get_version        as ov_get_version
+from openvino.runtime import Core               as ov_Core
+
+# 自作モジュール
+from model.model_ssd_detect import model_ssd_detect
+from model.batch_scheduler import batch_scheduler
+from DispFrame import console_print
+from FrameCapture import FrameCapture
+from ResultWriter import ResultWriter
+
+# 複数ストリームのSSD検出(表示なし) ==============================================
+# 複数の入力(ファイル/カメラ)を1つのモデル(コンパイル済みモデルと推論キュー)で処理する。
+# 各ストリームのフレームは空いている推論リクエストに順番に投入し、
+# 結果は (ストリーム番号, フレーム番号) 毎に受け取って、ストリーム毎にフレーム番号順に処理する。
+# --max_batch を2以上にすると、複数ストリームのフレームを溜めて1回の推論(バッチ推論)にまとめる。
+# 表示は行わず、ストリーム毎と全体のFPSを定期的に出力する。
+
+# コマンドラインパーサの構築 =====================================================
+def build_argparser():
+    parser = ArgumentParser(add_help=False, formatter_class=RawTextHelpFormatter)
+    parser.add_argument('-h', '--help', action='help', default=SUPPRESS,
+                        help='Show this help message and exit.')
+    parser.add_argument("-i", "--input", required=True, type=str, nargs='+',
+                        help="Required.\n"
+                             "Paths to image/video files. \n"
+                             "(Specify 'cam' or 'camN' to work with camera N)")
+    parser.add_argument("-l", "--cpu_extension", type=str, default=None,
+                        help="Optional.\n"
+                             "Required for CPU custom layers. \n"
+                             "Absolute path to a shared library\n"
+                             "with the kernels implementations.")
+    parser.add_argument("--ppp", action='store_true',
+                        help="Optional.\n"
+                             "Embed resize and layout conversion into the model\n"
+                             "with OpenVINO PrePostProcessor\n"
+                             "(captured frames are passed to the model without copy)")
+    parser.add_argument("--capture_buffer", default=4, type=int,
+                        help="Optional.\n"
+                             "Number of frames buffered by the capture thread\n"
+                             "of each stream\n"
+                             "(for camera input, the oldest frame is dropped when full)")
+    
+    ssd_args = parser.add_argument_group('SSD Options')
+    ssd_args.add_argument("-m", "--model", required=True, type=str,
+                        help="Required.\n"
+                             "Path to an .xml file with a trained model.")
+    ssd_args.add_argument("--labels", default=None, type=str,
+                        help="Optional.\n"
+                             "Labels mapping file\n"
+                             "Default is to change the extension of the modelfile\n"
+                             "to '.labels'.")
+    ssd_args.add_argument("-d", "--device", default="CPU", type=str,
+                        help="Optional\n"
+                             "Specify the target device to infer on; \n"
+                             "CPU, GPU, FPGA, HDDL or MYRIAD is acceptable. \n"
+                             "The demo will look for a suitable plugin \n"
+                             "for device specified.\n"
+                             "Default value is CPU")
+    ssd_args.add_argument("--queue_num", default=0, type=int,
+                        help="Optional.\n"
+                             "Number of async infer queues shared by all streams\n"
+                             "Default is twice the number of streams")
+    ssd_args.add_argument("-t_detect", "--threshold_detect", default=0.5, type=float,
+                        help="Optional.\n"
+                             "Probability threshold for detections filtering")
+    ssd_args.add_argument("--decode_mode", default="vector", choices=["vector", "loop"],
+                        help="Optional.\n"
+                             "Decoding method of the detection results\n"
+                             "  vector : decode all rows at once with NumPy\n"
+                             "  loop   : decode row by row\n"
+                             "Default value is vector")
+    ssd_args.add_argument("--max_batch", default=1, type=int,
+                        help="Optional.\n"
+                             "Maximum number of frames (from all streams)\n"
+                             "batched into one inference\n"
+                             "Default value is 1 (no batching)")
+    ssd_args.add_argument("--max_batch_wait_ms", default=5.0, type=float,
+                        help="Optional.\n"
+                             "Maximum time in msec to wait for frames\n"
+                             "to fill a batch\n"
+                             "Default value is 5.0")
+    
+    output_args = parser.add_argument_group('Output Options')
+    output_args.add_argument("--report_interval", default=5.0, type=float,
+                        help="Optional.\n"
+                             "Interval in seconds to report FPS\n"
+                             "Specify 0 to report only at the end")
+    output_args.add_argument("--results", default=None, type=str,
+                        help="Optional.\n"
+                             "Save detection results of each frame to specified file\n"
+                             "(written by a background thread.\n"
+                             " each record has the stream number in 'stream')")
+    output_args.add_argument("--results_format", default="binary", choices=ResultWriter.FORMATS,
+                        help="Optional.\n"
+                             "Format of --results file\n"
+                             "  jsonl  : JSON Lines (1 frame per line)\n"
+                             "  binary : length-prefixed binary records\n"
+                             "Default value is binary")
+    output_args.add_argument("--log", default=None, type=str,
+                        help="Optional.\n"
+                             "Save console log to specified file")
+    return parser
+# ================================================================================
+
+# ストリームのフレーム ===========================================================
+# 表示しないので DispFrame の代わりに、結果の解析に必要な情報だけ持つ
+class StreamFrame() :
+    def __init__(self, image, stream_id, frame_number, capture_time) :
+        self.img_height   = image.shape[0]
+        self.img_width    = image.shape[1]
+        self.stream_id    = stream_id
+        self.frame_number = frame_number
+        self.capture_time = capture_time        # キャプチャ完了時刻
+        
+# ストリーム =====================================================================
+class Stream() :
+    def __init__(self, stream_id, input_name, input_file, buffer_size) :
+        self.stream_id  = stream_id
+        self.input_name = input_name
+        
+        # カメラ入力なら古いフレームを破棄して最新のフレームを処理する
+        self.cap = FrameCapture(input_file, buffer_size, drop=isinstance(input_file, int))
+        
+        self.capture_flag       = True      # キャプチャ中
+        self.infer_frame_number = 1         # 推論用フレーム番号
+        self.disp_frame_number  = 1         # 結果処理用フレーム番号
+        
+        # FPS測定用
+        self.start_time    = None           # 最初のフレームの結果を処理した時刻
+        self.frame_count   = 0              # 結果を処理したフレーム数
+        self.latency_total = 0              # キャプチャから結果処理までの時間の合計(msec)
+        self.report_count  = 0              # 前回の出力時のフレーム数
+        self.report_time   = None           # 前回の出力時刻
+        
+    # 全フレームの結果を処理した
+    def is_done(self) :
+        return not self.capture_flag and self.disp_frame_number >= self.infer_frame_number
+# ================================================================================
+
+# 入力の解析 =====================================================================
+# 'cam' → カメラ0, 'camN' → カメラN, それ以外はファイル
+def parse_input(input_name) :
+    if input_name == 'cam' :
+        return 0
+    if input_name.startswith('cam') and input_name[3:].isdigit() :
+        return int(input_name[3:])
+    input_file = os.path.abspath(input_name)
+    assert os.path.isfile(input_file), f"Specified input file doesn't exist : {input_name}"
+    return input_file
+# ================================================================================
+
+# FPSの出力 ======================================================================
+def report_fps(log_f, streams, cur_time, final=False) :
+    total_count = 0
+    total_fps   = 0
+    for stream in streams :
+        if stream.start_time is None :
+            console_print(log_f, f'stream {stream.stream_id:2d} : no frames  ({stream.input_name})', True)
+            continue
+        if final :
+            # 全体の平均
+            count   = stream.frame_count
+            elapsed = cur_time - stream.start_time
+        else :
+            # 前回の出力からの平均
+            count   = stream.frame_count - stream.report_count
+            elapsed = cur_time - stream.report_time
+        fps     = count / elapsed if elapsed > 0 else 0
+        latency = stream.latency_total / stream.frame_count if stream.frame_count > 0 else 0
+        console_print(log_f, f'stream {stream.stream_id:2d} : frames {stream.frame_count:6d}  fps {fps:7.2f}  latency {latency:8.3f} ms  dropped {stream.cap.drop_count:5d}  ({stream.input_name})', True)
+        stream.report_count = stream.frame_count
+        stream.report_time  = cur_time
+        total_count += stream.frame_count
+        total_fps   += fps
+    console_print(log_f, f'all       : frames {total_count:6d}  fps {total_fps:7.2f}', True)
+# ================================================================================
+
+# メイン処理 =====================================================================
+def main():
+    log.basicConfig(format="[ %(levelname)s ] %(message)s", level=log.INFO, stream=sys.stdout)
+    
+    # openvino.inference_engine のバージョン取得
+    ov_version_str = ov_get_version()
+    log.info(f"openVINO vertion : {ov_version_str}")
+    
+    # コマンドラインオプションの解析 =================================================
+    args = build_argparser().parse_args()
+    
+    # モデルファイル
+    model_xml = args.model      # モデルファイル名(xml)
+    
+    # ラベルファイル
+    model_label = None
+    if args.labels:
+        model_label = args.labels
+    else:
+        model_label = os.path.splitext(model_xml)[0] + ".labels"
+    if not os.path.isfile(model_label)  :
+        log.warning("label file is not specified")
+        model_label = None
+        
+    # 入力ファイル
+    input_files = [parse_input(input_name) for input_name in args.input]
+    
+    # queue数のチェック(0ならストリーム数の2倍)
+    queue_num = args.queue_num
+    if queue_num < 0 :
+        log.warning("queue_num option must be greater than or equal to 0. use default value(0)")
+        queue_num = 0
+    if queue_num == 0 :
+        queue_num = len(input_files) * 2
+        
+    # キャプチャバッファ数のチェック
+    if args.capture_buffer < 1 :
+        log.warning("capture_buffer option must be greater than or equal to 1. use default value(4)")
+        args.capture_buffer = 4
+        
+    # バッチサイズ/待ち時間のチェック
+    if args.max_batch < 1 :
+        log.warning("max_batch option must be greater than or equal to 1. use default value(1)")
+        args.max_batch = 1
+    if args.max_batch_wait_ms < 0 :
+        log.warning("max_batch_wait_ms option must be greater than or equal to 0. use default value(5.0)")
+        args.max_batch_wait_ms = 5.0
+        
+    # ログファイル類の初期化 ====================================================================
+    log_f = None
+    if args.log :
+        log_f = open(args.log, mode='w')
+        console_print(log_f, f'command :          {" ".join(sys.argv)}')
+        console_print(log_f, f'openVINO vertion : {ov_version_str}')
+        
+    # 推論エンジンの初期化 =========================================================
+    log.info("Creating Inference Engine...")
+    core = ov_Core()
+    
+    # 拡張ライブラリのロード(CPU使用時のみ)
+    if args.cpu_extension and 'CPU' in args.device:
+        log.info("Loading Extension Library...")
+        core.add_extension(args.cpu_extension)
+        
+    # モデルの作成(全ストリームで共有) =================================================================
+    model_ssd = model_ssd_detect(core, model_xml, model_label, args.device, args.threshold_detect, queue_num, log_f, args.decode_mode, args.ppp, args.max_batch)
+    
+    # 推論投入のスケジューラ(複数ストリームのフレームをまとめる)
+    scheduler = batch_scheduler(model_ssd, args.max_batch, args.max_batch_wait_ms)
+    
+    # ストリームの作成 =================================================================================
+    streams = [Stream(stream_id, input_name, input_file, args.capture_buffer) for stream_id, (input_name, input_file) in enumerate(zip(args.input, input_files))]
+    
+    # 検出結果の出力(全ストリームで1ファイル) =========================================================
+    result_writer = None
+    if args.results :
+        result_writer = ResultWriter(args.results, args.results_format, 
+                                     {"pipeline": "ssd_multi", "command": " ".join(sys.argv), "input": args.input, 
+                                      "labels": model_ssd.labels_map})
+    
+    # 推論開始 =========================================================================================
+    log.info(f"Starting inference... ({len(streams)} streams, {queue_num} infer queues, max batch {args.max_batch})")
+    print("To close the application, press 'CTRL+C' here")
+    
+    for stream in streams :
+        stream.cap.start()
+        
+    report_time = time.perf_counter()
+    try :
+        while True :
+            # 推論が完了した数(結果待ちの判定用)
+            result_count = model_ssd.result_count
+            progress = False
+            
+            # 各ストリームから1フレームずつ推論を投入(バッチ推論ならスケジューラに溜める) ==========
+            for stream in streams :
+                if not (stream.capture_flag and scheduler.is_ready()) :
+                    continue
+                # キャプチャ済みのフレームがなければ待たずに次のストリームへ
+                frame = stream.cap.read(timeout=0)
+                if frame is None :
+                    if stream.cap.is_end() :
+                        stream.capture_flag = False        # 次からキャプチャしない
+                    continue
+    
+                stream_frame = StreamFrame(frame.image, stream.stream_id, stream.infer_frame_number, frame.capture_time)
+                scheduler.submit(frame.image, (stream_frame, stream.stream_id))
+                stream.infer_frame_number += 1
+                progress = True
+                
+            # 溜まったフレームの投入(全ストリームのキャプチャが終わっていれば待たずに投入)
+            if scheduler.poll(force=not any(stream.capture_flag for stream in streams)) > 0 :
+                progress = True
+                
+            # 推論結果の処理(ストリーム毎にフレーム番号順) ========================================
+            for stream in streams :
+                while True :
+                    infer_rst = model_ssd.get_infer_result(stream.disp_frame_number, stream.stream_id)      # まだ結果が出てなければNoneが返る
+                    if not infer_rst :
+                        break
+                    cur_frame = infer_rst["disp_frame"]
+                    cur_time  = time.perf_counter()
+    
+                    # 検出結果をログファイルorコンソールに出力
+                    for rst in infer_rst["result"] :
+                        class_id, class_name, conf, pt1, pt2 = model_ssd.unpack_result(rst)
+                        console_print(log_f, f'{stream.stream_id:2}:{cur_frame.frame_number:3}:Class={class_name:15}({class_id:3}) Confidence={conf:4f} Location=({pt1[0]},{pt1[1]})-({pt2[0]},{pt2[1]})', False)
+                    
+                    # 検出結果の出力
+                    if result_writer :
+                        result_writer.write(cur_frame.frame_number, {"stream": stream.stream_id, **model_ssd.result_columns(infer_rst["result"])})
+    
+                    # FPS測定
+                    if stream.start_time is None :
+                        stream.start_time  = cur_time
+                        stream.report_time = cur_time
+                    stream.frame_count   += 1
+                    stream.latency_total += (cur_time - cur_frame.capture_time) * 1000     # msec単位に変換
+    
+                    stream.disp_frame_number += 1
+                    progress = True
+    
+            # 全ストリームの全フレームを処理した
+            if all(stream.is_done() for stream in streams) :
+                break
+                
+            # FPSの定期出力
+            cur_time = time.perf_counter()
+            if args.report_interval > 0 and cur_time - report_time >= args.report_interval :
+                report_fps(log_f, streams, cur_time)
+                report_time = cur_time
+                
+            # 何も進まなければ推論の完了を待つ(キャプチャ待ちやバッチの待ち時間もあるので長くは待たない)
+            # 溜まったフレームの投入時刻を過ぎていても(wait_remain が 0)、推論リクエストに空きがなくて投入できないので
+            # timeout=0 にはせず推論の完了を待つ(推論リクエストが空くのは callback の後なので timeout なしでは待たない)
+            if not progress :
+                wait_remain = scheduler.wait_remain()
+                timeout = min(wait_remain, 0.005) if wait_remain else 0.005
+                model_ssd.wait_infer_result(result_count, timeout=timeout)
+    except KeyboardInterrupt :
+        log.info("Interrupted")
+        
+    # キュー内の残りのデータが処理されるのを待つ(これをやらないと中断時にプログラムが終了しない)
+    model_ssd.wait_all()
+    
+    # 最終結果
+    report_fps(log_f, streams, time.perf_counter(), final=True)
+    if args.max_batch > 1 :
+        console_print(log_f, scheduler.batch_status(), True)
+    
+    # 後片付け
+    for stream in streams :
+        stream.cap.release()
+        
+    if log_f :
+        log_f.close()
+    
+    # 検出結果の出力ファイルを閉じる(書き込みスレッドの終了を待つ)
+    if result_writer :
+        result_writer.close()
+# ================================================================================
+
+if __name__ == '__main__':
+    sys.exit(main() or 0)